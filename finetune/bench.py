@@ -0,0 +1,85 @@
+"""
+Benchmark LoRA / OFT injection and merging on a pretrained GPT-2 model (wall time and peak memory).
+$ python bench.py --init_from=gpt2-xl --method=lora
+"""
+import time
+import torch
+from model import GPT
+from finetuning.modular_lora import inject_trainable_lora, merge_injected_lora, unmerge_injected_lora
+from finetuning.modular_oft import inject_trainable_oft, merge_injected_oft, unmerge_injected_oft
+
+# -----------------------------------------------------------------------------
+init_from = 'gpt2-xl' # a gpt2 variant (e.g. 'gpt2', 'gpt2-xl')
+method = 'lora' # 'lora' or 'oft'
+target_modules = ['CausalSelfAttention', 'MLP'] # inject into every linear layer of these modules
+rank = 4
+merge_chunk_size = 16 # number of same-shaped layers merged with one batched matmul
+merge_rounds = 5 # merge / unmerge round trips to time
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float32' # 'float32' or 'bfloat16' or 'float16'
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+device_type = 'cuda' if 'cuda' in device else 'cpu'
+
+def synchronize():
+    if device_type == 'cuda':
+        torch.cuda.synchronize()
+
+def memory_allocated():
+    return torch.cuda.memory_allocated() if device_type == 'cuda' else 0
+
+model = GPT.from_pretrained(init_from, dict(dropout=0.0))
+model.to(device=device, dtype=ptdtype)
+model.requires_grad_(False)
+synchronize()
+
+if device_type == 'cuda':
+    torch.cuda.reset_peak_memory_stats()
+mem_before = memory_allocated()
+t0 = time.perf_counter()
+
+if method == 'lora':
+    params, names = inject_trainable_lora(model, target_replace_module=set(target_modules), r=rank)
+elif method == 'oft':
+    params, names = inject_trainable_oft(model, target_replace_module=set(target_modules), r=rank)
+else:
+    raise ValueError(f"Unknown method {method}, valid options are 'lora' or 'oft'")
+
+synchronize()
+t1 = time.perf_counter()
+num_layers = len(names)
+num_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+
+print(f"injected {method} into {num_layers} layers ({num_params/1e6:.2f}M trainable params) in {(t1-t0)*1000:.1f}ms")
+if device_type == 'cuda':
+    mem_peak = torch.cuda.max_memory_allocated()
+    print(f"memory: {mem_before/1e6:.1f}MB before, {memory_allocated()/1e6:.1f}MB after, {mem_peak/1e6:.1f}MB peak during injection")
+
+# merge / unmerge every injected layer
+merge, unmerge = {
+    'lora': (merge_injected_lora, unmerge_injected_lora),
+    'oft': (merge_injected_oft, unmerge_injected_oft),
+}[method]
+reference = model.transformer.h[0].mlp.c_fc
+reference = (reference.linear if method == 'lora' else reference.OFT).weight.detach().clone()
+
+merge_times, unmerge_times = [], []
+for _ in range(merge_rounds):
+    t0 = time.perf_counter()
+    merge(model, chunk_size=merge_chunk_size)
+    synchronize()
+    t1 = time.perf_counter()
+    unmerge(model, chunk_size=merge_chunk_size)
+    synchronize()
+    t2 = time.perf_counter()
+    merge_times.append(t1 - t0)
+    unmerge_times.append(t2 - t1)
+
+restored = model.transformer.h[0].mlp.c_fc
+restored = (restored.linear if method == 'lora' else restored.OFT).weight
+print(f"merge: {min(merge_times)*1000:.1f}ms, unmerge: {min(unmerge_times)*1000:.1f}ms (best of {merge_rounds})")
+print(f"max abs error after {merge_rounds} round trips: {(restored.float() - reference.float()).abs().max().item():.3e}")
+if device_type == 'cuda':
+    print(f"peak memory: {torch.cuda.max_memory_allocated()/1e6:.1f}MB")
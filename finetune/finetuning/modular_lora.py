@@ -28,10 +28,21 @@ except ImportError:
 
     safetensors_available = False
 
+from .safe_open import safe_open as mmap_safe_open
+
 
 class LoraInjectedLinear(nn.Module):
     def __init__(
-        self, in_features, out_features, bias=False, r=4, dropout_p=0.1, scale=1.0
+        self,
+        in_features,
+        out_features,
+        bias=False,
+        r=4,
+        dropout_p=0.1,
+        scale=1.0,
+        linear: Optional[nn.Linear] = None,
+        device=None,
+        dtype=None,
     ):
         super().__init__()
 
@@ -40,17 +51,26 @@ class LoraInjectedLinear(nn.Module):
                 f"LoRA rank {r} must be less or equal than {min(in_features, out_features)}"
             )
         self.r = r
-        self.linear = nn.Linear(in_features, out_features, bias)
-        self.lora_down = nn.Linear(in_features, r, bias=False)
+        # Wrap an existing layer as is, so no throwaway weights are allocated on injection
+        self.linear = (
+            linear
+            if linear is not None
+            else nn.Linear(in_features, out_features, bias, device=device, dtype=dtype)
+        )
+        self.lora_down = nn.Linear(in_features, r, bias=False, device=device, dtype=dtype)
         self.dropout = nn.Dropout(dropout_p)
-        self.lora_up = nn.Linear(r, out_features, bias=False)
+        self.lora_up = nn.Linear(r, out_features, bias=False, device=device, dtype=dtype)
         self.scale = scale
         self.selector = nn.Identity()
+        # scale folded into self.linear.weight by merge_injected_lora, None while unmerged
+        self.merged_scale = None
 
         nn.init.normal_(self.lora_down.weight, std=1 / r)
         nn.init.zeros_(self.lora_up.weight)
 
     def forward(self, input):
+        if self.merged_scale is not None:
+            return self.linear(input)
         return (
             self.linear(input)
             + self.dropout(self.lora_up(self.selector(self.lora_down(input))))
@@ -123,11 +143,15 @@ class LoraInjectedConv2d(nn.Module):
         )
         self.selector = nn.Identity()
         self.scale = scale
+        # scale folded into self.conv.weight by merge_injected_lora, None while unmerged
+        self.merged_scale = None
 
         nn.init.normal_(self.lora_down.weight, std=1 / r)
         nn.init.zeros_(self.lora_up.weight)
 
     def forward(self, input):
+        if self.merged_scale is not None:
+            return self.conv(input)
         return (
             self.conv(input)
             + self.dropout(self.lora_up(self.selector(self.lora_down(input))))
@@ -202,34 +226,39 @@ def _find_modules_v2(
     Returns all matching modules, along with the parent of those moduless and the
     names they are referenced by.
     """
+    search_class = tuple(search_class)
+    exclude_children_of = tuple(exclude_children_of or [])
+
+    # Index every module by its qualified name in a single traversal of the model
+    modules = dict(model.named_modules())
 
     # Get the targets we should replace all linears under
     if ancestor_class is not None:
-        ancestors = (
-            module
-            for module in model.modules()
+        ancestors = {
+            fullname
+            for fullname, module in modules.items()
             if module.__class__.__name__ in ancestor_class
-        )
+        }
     else:
         # this, incase you want to naively iterate over all modules.
-        ancestors = [module for module in model.modules()]
+        ancestors = set(modules.keys())
 
-    # For each target find every linear_class module that isn't a child of a LoraInjectedLinear
-    for ancestor in ancestors:
-        for fullname, module in ancestor.named_modules():
-            if any([isinstance(module, _class) for _class in search_class]):
-                # Find the direct parent if this is a descendant, not a child, of target
-                *path, name = fullname.split(".")
-                parent = ancestor
-                while path:
-                    parent = parent.get_submodule(path.pop(0))
-                # Skip this linear if it's a child of a LoraInjectedLinear
-                if exclude_children_of and any(
-                    [isinstance(parent, _class) for _class in exclude_children_of]
-                ):
-                    continue
-                # Otherwise, yield it
-                yield parent, name, module
+    results = []
+    for fullname, module in modules.items():
+        if not fullname or not isinstance(module, search_class):
+            continue
+        # Only keep modules that are (direct or indirect) descendants of a target
+        path = fullname.split(".")
+        if not any(".".join(path[:i]) in ancestors for i in range(len(path))):
+            continue
+        parent_name, _, name = fullname.rpartition(".")
+        parent = modules[parent_name]
+        # Skip this linear if it's a child of a LoraInjectedLinear
+        if isinstance(parent, exclude_children_of):
+            continue
+        results.append((parent, name, module))
+
+    return results
 
 
 def _find_modules_old(
@@ -279,6 +308,8 @@ def inject_trainable_lora(
         if verbose:
             print("LoRA Injection : injecting lora into ", name)
             print("LoRA Injection : weight shape", weight.shape)
+        # The existing layer (including any parametrization, e.g. quantized weights) is
+        # wrapped as is and the LoRA weights are created directly on its device and dtype
         _tmp = LoraInjectedLinear(
             _child_module.in_features,
             _child_module.out_features,
@@ -286,13 +317,12 @@ def inject_trainable_lora(
             r=r,
             dropout_p=dropout_p,
             scale=scale,
+            linear=_child_module,
+            device=weight.device,
+            dtype=weight.dtype,
         )
-        _tmp.linear.weight = weight
-        if bias is not None:
-            _tmp.linear.bias = bias
 
         # switch the module
-        _tmp.to(_child_module.weight.device).to(_child_module.weight.dtype)
         _module._modules[name] = _tmp
 
         require_grad_params.append(_module._modules[name].lora_up.parameters())
@@ -336,10 +366,10 @@ def inject_trainable_lora_extended(
                 _child_module.out_features,
                 _child_module.bias is not None,
                 r=r,
+                linear=_child_module,
+                device=weight.device,
+                dtype=weight.dtype,
             )
-            _tmp.linear.weight = weight
-            if bias is not None:
-                _tmp.linear.bias = bias
         elif _child_module.__class__ == nn.Conv2d:
             weight = _child_module.weight
             bias = _child_module.bias
@@ -617,57 +647,129 @@ def parse_safeloras_embeds(
     return embeds
 
 
-def load_safeloras(path, device="cpu"):
-    safeloras = safe_open(path, framework="pt", device=device)
+def open_safeloras(path, device="cpu", mmap=True):
+    """
+    Open a safeloras file. With mmap=True the tensors are zero-copy views into a memory map of the
+    file, so they are only read from disk when a target module actually uses them.
+    """
+    if mmap:
+        return mmap_safe_open(path, framework="pt", device=device)
+    return safe_open(path, framework="pt", device=device)
+
+
+def load_safeloras(path, device="cpu", mmap=True):
+    safeloras = open_safeloras(path, device=device, mmap=mmap)
     return parse_safeloras(safeloras)
 
 
-def load_safeloras_embeds(path, device="cpu"):
-    safeloras = safe_open(path, framework="pt", device=device)
+def load_safeloras_embeds(path, device="cpu", mmap=True):
+    safeloras = open_safeloras(path, device=device, mmap=mmap)
     return parse_safeloras_embeds(safeloras)
 
 
-def load_safeloras_both(path, device="cpu"):
-    safeloras = safe_open(path, framework="pt", device=device)
+def load_safeloras_both(path, device="cpu", mmap=True):
+    safeloras = open_safeloras(path, device=device, mmap=mmap)
     return parse_safeloras(safeloras), parse_safeloras_embeds(safeloras)
 
 
-def collapse_lora(model, alpha=1.0):
+def _lora_base_layer(module):
+    return module.linear if isinstance(module, LoraInjectedLinear) else module.conv
 
-    for _module, name, _child_module in _find_modules(
-        model,
-        UNET_EXTENDED_TARGET_REPLACE | TEXT_ENCODER_EXTENDED_TARGET_REPLACE,
-        search_class=[LoraInjectedLinear, LoraInjectedConv2d],
-    ):
 
-        if isinstance(_child_module, LoraInjectedLinear):
-            print("Collapsing Lin Lora in", name)
-
-            _child_module.linear.weight = nn.Parameter(
-                _child_module.linear.weight.data
-                + alpha
-                * (
-                    _child_module.lora_up.weight.data
-                    @ _child_module.lora_down.weight.data
-                )
-                .type(_child_module.linear.weight.dtype)
-                .to(_child_module.linear.weight.device)
+def _lora_down_matrix(module):
+    # fold the (optional) diagonal selector into the down projection: up @ selector @ down
+    down = module.lora_down.weight.flatten(start_dim=1)
+    if not isinstance(module.selector, nn.Identity):
+        down = module.selector.weight.reshape(module.r, module.r) @ down
+    return down
+
+
+def _group_lora_modules(model, merged: bool):
+    """
+    Group the injected LoRA layers by base weight shape, rank, dtype and device,
+    so that every group can be merged with a single batched matmul.
+    """
+    groups = {}
+    for module in model.modules():
+        if not isinstance(module, (LoraInjectedLinear, LoraInjectedConv2d)):
+            continue
+        if (module.merged_scale is not None) != merged:
+            continue
+        base = _lora_base_layer(module)
+        if hasattr(base, "parametrizations"):
+            raise ValueError(
+                "Cannot merge LoRA into a parametrized (e.g. quantized) base weight."
             )
+        weight, up = base.weight, module.lora_up.weight
+        key = (tuple(weight.shape), module.r, weight.dtype, up.dtype, weight.device)
+        groups.setdefault(key, []).append(module)
+    return list(groups.values())
 
-        else:
-            print("Collapsing Conv Lora in", name)
-            _child_module.conv.weight = nn.Parameter(
-                _child_module.conv.weight.data
-                + alpha
-                * (
-                    _child_module.lora_up.weight.data.flatten(start_dim=1)
-                    @ _child_module.lora_down.weight.data.flatten(start_dim=1)
-                )
-                .reshape(_child_module.conv.weight.data.shape)
-                .type(_child_module.conv.weight.dtype)
-                .to(_child_module.conv.weight.device)
+
+@torch.no_grad()
+def _merge_lora_groups(model, alpha: float, unmerge: bool, chunk_size: int):
+    num_merged = 0
+    for modules in _group_lora_modules(model, merged=unmerge):
+        for i in range(0, len(modules), chunk_size):
+            chunk = modules[i : i + chunk_size]
+            weights = [_lora_base_layer(m).weight for m in chunk]
+            device = weights[0].device
+
+            ups = torch.stack([m.lora_up.weight.flatten(start_dim=1).to(device) for m in chunk])
+            downs = torch.stack([_lora_down_matrix(m).to(device) for m in chunk])
+            scales = [m.merged_scale if unmerge else alpha * m.scale for m in chunk]
+            scales = torch.tensor(scales, dtype=ups.dtype, device=device).view(-1, 1, 1)
+            if unmerge:
+                scales = -scales
+
+            # (n, out, r) @ (n, r, in) -> (n, out, in), then one fused in-place add over all weights
+            deltas = torch.bmm(ups * scales, downs).to(weights[0].dtype)
+            torch._foreach_add_(
+                weights, [d.view_as(w) for d, w in zip(deltas.unbind(0), weights)]
             )
 
+            for m, scale in zip(chunk, scales.view(-1).tolist()):
+                m.merged_scale = None if unmerge else scale
+            num_merged += len(chunk)
+    return num_merged
+
+
+def merge_injected_lora(model, alpha: float = 1.0, chunk_size: int = 16):
+    """
+    Merge every injected LoRA layer into its base weight in place, W += alpha * scale * up @ down.
+    Layers with the same shape are merged together with batched matmuls, chunk_size layers at a time.
+    Merged layers skip the LoRA branch in forward until they are unmerged again.
+    Returns the number of merged layers.
+    """
+    return _merge_lora_groups(model, alpha, unmerge=False, chunk_size=chunk_size)
+
+
+def unmerge_injected_lora(model, chunk_size: int = 16):
+    """
+    Subtract the merged LoRA updates from the base weights again (exact up to floating point rounding).
+    Returns the number of unmerged layers.
+    """
+    return _merge_lora_groups(model, 1.0, unmerge=True, chunk_size=chunk_size)
+
+
+def collapse_lora(model, alpha=1.0):
+    num_merged = merge_injected_lora(model, alpha)
+    print(f"Collapsed LoRA into {num_merged} layers")
+
+
+def _load_lora_factors(module, up_weight, down_weight, weight):
+    """
+    Point the LoRA factors of an injected module at the loaded weights. Weights that already have
+    the dtype and device of the base weight (e.g. mmap views from load_safeloras) are used without
+    a copy, anything else is converted with exactly one copy.
+    """
+    module.lora_up.weight = nn.Parameter(
+        up_weight.to(device=weight.device, dtype=weight.dtype)
+    )
+    module.lora_down.weight = nn.Parameter(
+        down_weight.to(device=weight.device, dtype=weight.dtype)
+    )
+
 
 def monkeypatch_or_replace_lora(
     model,
@@ -685,17 +787,16 @@ def monkeypatch_or_replace_lora(
         )
 
         weight = _source.weight
-        bias = _source.bias
+        # the LoRA factors are replaced by the loaded weights right away, so don't allocate them
         _tmp = LoraInjectedLinear(
             _source.in_features,
             _source.out_features,
             _source.bias is not None,
             r=r.pop(0) if isinstance(r, list) else r,
+            linear=_source,
+            device="meta",
+            dtype=weight.dtype,
         )
-        _tmp.linear.weight = weight
-
-        if bias is not None:
-            _tmp.linear.bias = bias
 
         # switch the module
         _module._modules[name] = _tmp
@@ -703,14 +804,7 @@ def monkeypatch_or_replace_lora(
         up_weight = loras.pop(0)
         down_weight = loras.pop(0)
 
-        _module._modules[name].lora_up.weight = nn.Parameter(
-            up_weight.type(weight.dtype)
-        )
-        _module._modules[name].lora_down.weight = nn.Parameter(
-            down_weight.type(weight.dtype)
-        )
-
-        _module._modules[name].to(weight.device)
+        _load_lora_factors(_module._modules[name], up_weight, down_weight, weight)
 
 
 def monkeypatch_or_replace_lora_extended(
@@ -738,17 +832,15 @@ def monkeypatch_or_replace_lora_extended(
             )
 
             weight = _source.weight
-            bias = _source.bias
             _tmp = LoraInjectedLinear(
                 _source.in_features,
                 _source.out_features,
                 _source.bias is not None,
                 r=r.pop(0) if isinstance(r, list) else r,
+                linear=_source,
+                device="meta",
+                dtype=weight.dtype,
             )
-            _tmp.linear.weight = weight
-
-            if bias is not None:
-                _tmp.linear.bias = bias
 
         elif (_child_module.__class__ == nn.Conv2d) or (
             _child_module.__class__ == LoraInjectedConv2d
@@ -786,13 +878,7 @@ def monkeypatch_or_replace_lora_extended(
         up_weight = loras.pop(0)
         down_weight = loras.pop(0)
 
-        _module._modules[name].lora_up.weight = nn.Parameter(
-            up_weight.type(weight.dtype)
-        )
-        _module._modules[name].lora_down.weight = nn.Parameter(
-            down_weight.type(weight.dtype)
-        )
-
+        _load_lora_factors(_module._modules[name], up_weight, down_weight, weight)
         _module._modules[name].to(weight.device)
 
 
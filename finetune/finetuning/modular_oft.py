@@ -63,6 +63,7 @@ def project_batch(R, eps=1e-5):
 class OFTInjectedLinear(nn.Module):
     def __init__(
         self, in_features, out_features, bias=False, r=4, eps=1e-5, is_coft=True, block_share=False,
+        linear=None, device=None, dtype=None,
     ):
         super().__init__()
 
@@ -77,7 +78,12 @@ class OFTInjectedLinear(nn.Module):
         self.out_features=out_features
 
         # Define the fixed Linear layer: v
-        self.OFT = torch.nn.Linear(in_features=in_features, out_features=out_features, bias=bias)
+        # Wrap an existing layer as is, so no throwaway weights are allocated on injection
+        self.OFT = (
+            linear
+            if linear is not None
+            else torch.nn.Linear(in_features=in_features, out_features=out_features, bias=bias, device=device, dtype=dtype)
+        )
 
         # Define the reduction rate:
         self.r = r
@@ -90,18 +96,23 @@ class OFTInjectedLinear(nn.Module):
         if self.block_share:
             # Initialized as an identity matrix
             self.R_shape = [in_features // self.r, in_features // self.r]
-            self.R = nn.Parameter(torch.zeros(self.R_shape[0], self.R_shape[0]), requires_grad=True)
+            self.R = nn.Parameter(torch.zeros(self.R_shape[0], self.R_shape[0], device=device, dtype=dtype), requires_grad=True)
   
             self.eps = eps * self.R_shape[0] * self.R_shape[0]
         else:
             # Initialized as an identity matrix
             self.R_shape = [self.r, in_features // self.r, in_features // self.r]
-            R = torch.zeros(self.R_shape[1], self.R_shape[1])
-            R = torch.stack([R] * self.r)
+            R = torch.zeros(self.r, self.R_shape[1], self.R_shape[1], device=device, dtype=dtype)
             self.R = nn.Parameter(R, requires_grad=True)
             self.eps = eps * self.R_shape[1] * self.R_shape[1]
 
+        # whether the rotation has been folded into self.OFT.weight by merge_injected_oft
+        self.merged = False
+
     def forward(self, x):
+        if self.merged:
+            return self.OFT(x)
+
         orig_dtype = x.dtype
         dtype = self.R.dtype
 
@@ -185,6 +196,7 @@ class OFTInjectedLinear(nn.Module):
 class OFTInjectedLinear_with_norm(nn.Module):
     def __init__(
         self, in_features, out_features, bias=False, r=4, eps=1e-5, is_coft=True, block_share=False,
+        linear=None, device=None, dtype=None,
     ):
         super().__init__()
 
@@ -199,7 +211,12 @@ class OFTInjectedLinear_with_norm(nn.Module):
         self.out_features=out_features
 
         # Define the fixed Linear layer: v
-        self.OFT = torch.nn.Linear(in_features=in_features, out_features=out_features, bias=bias)
+        # Wrap an existing layer as is, so no throwaway weights are allocated on injection
+        self.OFT = (
+            linear
+            if linear is not None
+            else torch.nn.Linear(in_features=in_features, out_features=out_features, bias=bias, device=device, dtype=dtype)
+        )
 
         # Define the reduction rate:
         self.r = r
@@ -209,25 +226,30 @@ class OFTInjectedLinear_with_norm(nn.Module):
         self.fix_filt_shape = [in_features, out_features]
 
         # Define the scaling factors
-        self.scaling_factors = nn.Parameter(torch.ones(out_features, 1))
+        self.scaling_factors = nn.Parameter(torch.ones(out_features, 1, device=device, dtype=dtype))
 
         # Define the trainable matrix parameter: R
         self.block_share=block_share
         if self.block_share:
             # Initialized as an identity matrix
             self.R_shape = [in_features // self.r, in_features // self.r]
-            self.R = nn.Parameter(torch.zeros(self.R_shape[0], self.R_shape[0]), requires_grad=False)
+            self.R = nn.Parameter(torch.zeros(self.R_shape[0], self.R_shape[0], device=device, dtype=dtype), requires_grad=False)
   
             self.eps = eps * self.R_shape[0] * self.R_shape[0]
         else:
             # Initialized as an identity matrix
             self.R_shape = [self.r, in_features // self.r, in_features // self.r]
-            R = torch.zeros(self.R_shape[1], self.R_shape[1])
-            R = torch.stack([R] * self.r)
+            R = torch.zeros(self.r, self.R_shape[1], self.R_shape[1], device=device, dtype=dtype)
             self.R = nn.Parameter(R, requires_grad=False)
             self.eps = eps * self.R_shape[1] * self.R_shape[1]
 
+        # whether the rotation has been folded into self.OFT.weight by merge_injected_oft
+        self.merged = False
+
     def forward(self, x):
+        if self.merged:
+            return self.OFT(x)
+
         orig_dtype = x.dtype
         dtype = self.R.dtype
 
@@ -461,42 +483,36 @@ def _find_modules_v2(
     Returns all matching modules, along with the parent of those moduless and the
     names they are referenced by.
     """
-
-    # Get the targets we should replace all linears under
-    if ancestor_class is not None:
-        ancestors = (
-            module
-            for module in model.modules()
-            if module.__class__.__name__ in ancestor_class
-        )
-    else:
-        # the first modules is the most senior father class.
-        # this, incase you want to naively iterate over all modules.
-        for module in model.modules():
-            ancestor_class = module.__class__.__name__
-            break
-        ancestors = (
-            module
-            for module in model.modules()
-            if module.__class__.__name__ in ancestor_class
-        )
+    search_class = tuple(search_class)
+    exclude_children_of = tuple(exclude_children_of or [])
+
+    # the first modules is the most senior father class.
+    # this, incase you want to naively iterate over all modules.
+    if ancestor_class is None:
+        ancestor_class = {model.__class__.__name__}
+
+    # Index every module by its qualified name in a single traversal of the model
+    modules = dict(model.named_modules())
+    ancestors = {
+        fullname
+        for fullname, module in modules.items()
+        if module.__class__.__name__ in ancestor_class
+    }
 
     results = []
     # For each target find every linear_class module that isn't a child of a OFTInjectedLinear
-    for ancestor in ancestors:
-        for fullname, module in ancestor.named_modules():
-            if any([isinstance(module, _class) for _class in search_class]):
-                # Find the direct parent if this is a descendant, not a child, of target
-                *path, name = fullname.split(".")
-                parent = ancestor
-                while path:
-                    parent = parent.get_submodule(path.pop(0))
-                # Skip this linear if it's a child of a OFTInjectedLinear
-                if exclude_children_of and any(
-                    [isinstance(parent, _class) for _class in exclude_children_of]
-                ):
-                    continue
-                results.append((parent, name, module))  # Append the result to the list
+    for fullname, module in modules.items():
+        if not fullname or not isinstance(module, search_class):
+            continue
+        path = fullname.split(".")
+        if not any(".".join(path[:i]) in ancestors for i in range(len(path))):
+            continue
+        parent_name, _, name = fullname.rpartition(".")
+        parent = modules[parent_name]
+        # Skip this linear if it's a child of a OFTInjectedLinear
+        if isinstance(parent, exclude_children_of):
+            continue
+        results.append((parent, name, module))  # Append the result to the list
 
     return results  # Return the list instead of using 'yield'
 
@@ -553,13 +569,12 @@ def inject_trainable_oft(
             eps=eps,
             is_coft=is_coft,
             block_share=block_share,
+            linear=_child_module,
+            device=weight.device,
+            dtype=weight.dtype,
         )
-        _tmp.OFT.weight = weight
-        if bias is not None:
-            _tmp.OFT.bias = bias
 
         # switch the module
-        _tmp.to(_child_module.weight.device).to(_child_module.weight.dtype)
         _module._modules[name] = _tmp
 
         require_grad_params.append(_module._modules[name].R)
@@ -589,45 +604,113 @@ def monkeypatch_remove_oft(model):
         _module._modules[name] = _tmp
         
         
-def collapse_oft(model):
+def _project_oft(module):
+    # the same (in-place) projection of R that is applied in forward
+    if module.is_coft:
+        if module.block_share:
+            module.R.copy_(project(module.R, eps=module.eps))
+        else:
+            module.R.copy_(project_batch(module.R, eps=module.eps))
 
-    for _module, name, _child_module in _find_modules(
-        model,
-        search_class=[OFTInjectedLinear],
-    ):
 
-        if isinstance(_child_module, OFTInjectedLinear):
-            print("Collapsing Lin OFT in", name)
-            
-            # OFT transformation
-            dtype = _child_module.R.dtype
-
-            if _child_module.block_share:
-                if _child_module.is_coft:
-                    with torch.no_grad():
-                        _child_module.R.copy_(project(_child_module.R, eps=_child_module.eps))
-                orth_rotate = _child_module.cayley(_child_module.R)
-            else:
-                if _child_module.is_coft:
-                    with torch.no_grad():
-                        _child_module.R.copy_(project_batch(_child_module.R, eps=_child_module.eps))
-                orth_rotate = _child_module.cayley_batch(_child_module.R)
-
-            # Block-diagonal parametrization
-            block_diagonal_matrix = _child_module.block_diagonal(orth_rotate)
-
-            # fix filter
-            # print(self.OFT)
-            fix_filt = _child_module.OFT.weight.data
-            fix_filt = torch.transpose(fix_filt, 0, 1)
-            filt = torch.mm(block_diagonal_matrix, fix_filt.to(dtype))
-            filt = torch.transpose(filt, 0, 1)
-            
-            _child_module.OFT.weight = nn.Parameter(
-                filt
-                .type(_child_module.R.dtype)
-                .to(_child_module.OFT.weight.device)
+def _oft_rotations(modules):
+    """
+    Cayley transform of the R blocks of all modules with one batched solve, returns (n, r, b, b).
+    The two conventions of cayley / cayley_batch are kept, since (I + S) and (I - S) commute.
+    """
+    R = torch.stack([m.R.expand(m.r, *m.R.shape[-2:]) for m in modules])
+    n, r, b, _ = R.shape
+    # solve in float32, linalg.solve does not support half precision
+    skew = 0.5 * (R - R.transpose(-1, -2)).reshape(n * r, b, b).float()
+    I = torch.eye(b, device=R.device).expand_as(skew)
+    if modules[0].block_share:
+        # cayley: (I + S) @ (I - S)^-1
+        Q = torch.linalg.solve(I - skew, I + skew)
+    else:
+        # cayley_batch: (I - S) @ (I + S)^-1
+        Q = torch.linalg.solve(I + skew, I - skew)
+    return Q.to(R.dtype).view(n, r, b, b)
+
+
+def _group_oft_modules(model, merged: bool):
+    """
+    Group the injected OFT layers by base weight shape, block layout, dtype and device,
+    so that every group can be rotated with a single batched matmul.
+    """
+    groups = {}
+    for module in model.modules():
+        if not isinstance(module, (OFTInjectedLinear, OFTInjectedLinear_with_norm)):
+            continue
+        if module.merged != merged:
+            continue
+        if hasattr(module.OFT, "parametrizations"):
+            raise ValueError(
+                "Cannot merge OFT into a parametrized (e.g. quantized) base weight."
             )
+        weight = module.OFT.weight
+        key = (
+            type(module), tuple(weight.shape), module.r, module.block_share,
+            weight.dtype, module.R.dtype, weight.device,
+        )
+        groups.setdefault(key, []).append(module)
+    return list(groups.values())
+
+
+@torch.no_grad()
+def _merge_oft_groups(model, unmerge: bool, chunk_size: int):
+    num_merged = 0
+    for modules in _group_oft_modules(model, merged=unmerge):
+        for i in range(0, len(modules), chunk_size):
+            chunk = modules[i : i + chunk_size]
+            weights = [m.OFT.weight for m in chunk]
+            if not unmerge:
+                for m in chunk:
+                    _project_oft(m)
+            Q = _oft_rotations(chunk)
+            n, r, b, _ = Q.shape
+            out_features = weights[0].shape[0]
+
+            W = torch.stack(weights).to(Q.dtype)
+            if unmerge and isinstance(chunk[0], OFTInjectedLinear_with_norm):
+                W = W / torch.stack([m.scaling_factors for m in chunk]).to(Q.dtype)
+
+            # W @ block_diag(Q)^T applied blockwise on the input dimension: (n*r, out, b) @ (n*r, b, b).
+            # The rotation is orthogonal, so unmerging multiplies by block_diag(Q) instead.
+            W = W.view(n, out_features, r, b).permute(0, 2, 1, 3).reshape(n * r, out_features, b)
+            W = torch.bmm(W, Q.view(n * r, b, b) if unmerge else Q.view(n * r, b, b).transpose(1, 2))
+            W = W.view(n, r, out_features, b).permute(0, 2, 1, 3).reshape(n, out_features, r * b)
+
+            if not unmerge and isinstance(chunk[0], OFTInjectedLinear_with_norm):
+                W = W * torch.stack([m.scaling_factors for m in chunk]).to(Q.dtype)
+
+            for m, weight, merged_weight in zip(chunk, weights, W.unbind(0)):
+                weight.copy_(merged_weight)
+                m.merged = not unmerge
+            num_merged += len(chunk)
+    return num_merged
+
+
+def merge_injected_oft(model, chunk_size: int = 16):
+    """
+    Fold the orthogonal rotation of every injected OFT layer into its base weight in place.
+    Layers with the same shape are rotated together with batched matmuls, chunk_size layers at a time,
+    without materializing the full block-diagonal matrix. Merged layers call the base layer directly
+    in forward until they are unmerged again. Returns the number of merged layers.
+    """
+    return _merge_oft_groups(model, unmerge=False, chunk_size=chunk_size)
+
+
+def unmerge_injected_oft(model, chunk_size: int = 16):
+    """
+    Undo merge_injected_oft with the inverse (transposed) rotation (exact up to floating point rounding).
+    Returns the number of unmerged layers.
+    """
+    return _merge_oft_groups(model, unmerge=True, chunk_size=chunk_size)
+
+
+def collapse_oft(model):
+    num_merged = merge_injected_oft(model)
+    print(f"Collapsed OFT into {num_merged} layers")
 
 
 def inject_trainable_oft_with_norm(
@@ -663,13 +746,12 @@ def inject_trainable_oft_with_norm(
             eps=eps,
             is_coft=is_coft,
             block_share=block_share,
+            linear=_child_module,
+            device=weight.device,
+            dtype=weight.dtype,
         )
-        _tmp.OFT.weight = weight
-        if bias is not None:
-            _tmp.OFT.bias = bias
 
         # switch the module
-        _tmp.to(_child_module.weight.device).to(_child_module.weight.dtype)
         _module._modules[name] = _tmp
 
         require_grad_params.append(_module._modules[name].scaling_factors)
@@ -0,0 +1,154 @@
+"""
+A minimal implementation of weight-only int8 / nf4 quantization for frozen base weights.
+
+The quantized weight is stored as an integer buffer and dequantized on the fly through a
+parametrization, so quantized layers are still nn.Linear / nn.Embedding modules and LoRA
+or OFT parametrizations can be stacked on top of them with add_lora / add_oft.
+"""
+
+import torch
+import torch.nn.functional as F
+import torch.nn.utils.parametrize as parametrize
+from torch import nn
+
+
+# The 16 quantiles of a standard normal distribution used by QLoRA (https://arxiv.org/abs/2305.14314)
+NF4_CODEBOOK = [
+    -1.0, -0.6961928009986877, -0.5250730514526367, -0.39491748809814453,
+    -0.28444138169288635, -0.18477343022823334, -0.09105003625154495, 0.0,
+    0.07958029955625534, 0.16093020141124725, 0.24611230194568634, 0.33791524171829224,
+    0.44070982933044434, 0.5626170039176941, 0.7229568362236023, 1.0,
+]
+
+
+class Int8Dequantize(nn.Module):
+    """Dequantize int8 weights with one absmax scale per output channel (row)."""
+
+    def __init__(self, scales):
+        super().__init__()
+        self.register_buffer("scales", scales)
+
+    def forward(self, X):
+        return X.to(self.scales.dtype) * self.scales
+
+    @classmethod
+    def quantize(cls, weight):
+        W = weight.detach().float().reshape(weight.shape[0], -1)
+        scales = W.abs().amax(dim=1, keepdim=True).clamp(min=1e-8) / 127
+        qweight = torch.round(W / scales).clamp(-127, 127).to(torch.int8)
+        return qweight.view(weight.shape), cls(scales.to(weight.dtype))
+
+
+class NF4Dequantize(nn.Module):
+    """Dequantize 4-bit normal-float weights (two per byte) with one absmax scale per block."""
+
+    def __init__(self, absmax, shape, block_size=64):
+        super().__init__()
+        self.shape = torch.Size(shape)
+        self.block_size = block_size
+        self.register_buffer("absmax", absmax)
+        self.register_buffer("codebook", torch.tensor(NF4_CODEBOOK, dtype=absmax.dtype, device=absmax.device))
+
+    def forward(self, X):
+        # Unpack the high and low nibbles back into codebook indices
+        idx = torch.stack([X >> 4, X & 0x0F], dim=-1).view(-1).long()
+        W = self.codebook[idx].view(-1, self.block_size) * self.absmax.unsqueeze(1)
+        return W.view(-1)[: self.shape.numel()].view(self.shape)
+
+    @classmethod
+    def quantize(cls, weight, block_size=64):
+        assert block_size % 2 == 0, "block_size must be even to pack two 4-bit values per byte"
+        W = weight.detach().float().reshape(-1)
+        W = F.pad(W, (0, -W.numel() % block_size)).view(-1, block_size)
+
+        absmax = W.abs().amax(dim=1).clamp(min=1e-8)
+        codebook = torch.tensor(NF4_CODEBOOK, device=W.device)
+
+        # Round every normalized value to the nearest codebook entry
+        midpoints = (codebook[1:] + codebook[:-1]) / 2
+        idx = torch.bucketize(W / absmax.unsqueeze(1), midpoints).to(torch.uint8).view(-1)
+        qweight = (idx[0::2] << 4) | idx[1::2]
+        return qweight, cls(absmax.to(weight.dtype), weight.shape, block_size=block_size)
+
+
+@torch.no_grad()
+def check_roundtrip(weight, qweight, dequantize):
+    """
+    Check that dequantize(qweight) is within the rounding bound of every weight and return the max
+    error relative to the largest weight. The bound is half a quantization step times the row (int8)
+    or block (nf4) absmax, plus a few ulps of the weight dtype for the stored scales.
+    """
+    W = weight.detach().float()
+    error = (dequantize(qweight).float() - W).abs()
+    eps = torch.finfo(weight.dtype).eps
+    if isinstance(dequantize, Int8Dequantize):
+        bound = dequantize.scales.float().view(-1, *[1] * (W.dim() - 1)) * (0.5 + 127 * 4 * eps)
+    else:
+        half_step = ((dequantize.codebook[1:] - dequantize.codebook[:-1]).max().float() / 2).item()
+        absmax = dequantize.absmax.float().repeat_interleave(dequantize.block_size)[: W.numel()].view(W.shape)
+        bound = absmax * (half_step + 4 * eps)
+    if (error > bound + 1e-8).any():
+        raise RuntimeError(f"{type(dequantize).__name__} round-trip error {error.max().item():.3g} exceeds the quantization bound")
+    return (error.max() / W.abs().max().clamp(min=1e-8)).item()
+
+
+def quantize_layer(layer, attr_name="weight", mode="int8", block_size=64):
+    """
+    Replace a layer's weight with an integer buffer plus a dequantize parametrization.
+    Must be applied before any LoRA / OFT parametrization is registered on the layer.
+    Returns the round-trip error of check_roundtrip.
+    """
+    weight = getattr(layer, attr_name)
+    if mode == "int8":
+        qweight, dequantize = Int8Dequantize.quantize(weight)
+    elif mode == "nf4":
+        qweight, dequantize = NF4Dequantize.quantize(weight, block_size=block_size)
+    else:
+        raise ValueError(f"Unknown quantization mode {mode}, valid options are 'int8' or 'nf4'")
+    error = check_roundtrip(weight, qweight, dequantize)
+
+    delattr(layer, attr_name)
+    layer.register_buffer(attr_name, qweight)
+    # unsafe=True since the parametrization changes the dtype (and for nf4, the shape) of the buffer
+    parametrize.register_parametrization(layer, attr_name, dequantize, unsafe=True)
+    return error
+
+
+def tie_quantized_weights(source, target, attr_name="weight"):
+    """tie the weights of target to the (already quantized) weights of source, e.g. GPT wte and lm_head"""
+    delattr(target, attr_name)
+    target.register_buffer(attr_name, source.parametrizations[attr_name].original)
+    parametrize.register_parametrization(target, attr_name, source.parametrizations[attr_name][0], unsafe=True)
+
+
+def quantize_model(model, mode="int8", block_size=64, layer_types=(nn.Linear, nn.Embedding)):
+    """
+    Quantize the weights of all linear and embedding layers in a model, keeping tied weights tied.
+    Every layer is checked against its round-trip bound; the largest relative error is printed.
+    """
+    quantized = {}
+    max_error = 0.0
+    for layer in model.modules():
+        if not isinstance(layer, layer_types) or parametrize.is_parametrized(layer, "weight"):
+            continue
+        weight = layer.weight
+        if id(weight) in quantized:
+            tie_quantized_weights(quantized[id(weight)][1], layer)
+        else:
+            max_error = max(max_error, quantize_layer(layer, mode=mode, block_size=block_size))
+            # hold on to the original weight so its id is not reused while we search for tied layers
+            quantized[id(weight)] = (weight, layer)
+    print(f"{mode} round-trip check passed for {len(quantized)} weights, max error {max_error:.3g} of the largest weight")
+    return model
+
+
+def get_weight_memory(model):
+    """Bytes held by the parameters and buffers of a model (shared tensors are counted once)."""
+    seen = set()
+    total = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        if tensor.data_ptr() in seen:
+            continue
+        seen.add(tensor.data_ptr())
+        total += tensor.numel() * tensor.element_size()
+    return total
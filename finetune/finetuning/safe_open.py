@@ -0,0 +1,77 @@
+"""
+A minimal, memory-mapped reader for safetensors files with the same interface as safetensors.safe_open.
+
+get_tensor returns zero-copy views into a copy-on-write mmap of the file, so nothing is read from disk
+until a tensor is actually used, and writing to a returned tensor never modifies the file.
+"""
+
+import json
+import mmap
+import struct
+
+import torch
+
+
+_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+class safe_open:
+    def __init__(self, filename, framework="pt", device="cpu"):
+        if framework != "pt":
+            raise ValueError(f"Only the 'pt' framework is supported, got {framework}")
+        self.device = torch.device(device)
+
+        with open(filename, "rb") as f:
+            # safetensors layout: 8 byte little-endian header size, JSON header, tensor data
+            (header_size,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_size))
+            # ACCESS_COPY gives writable (copy-on-write) pages, which torch.frombuffer requires
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        self._metadata = header.pop("__metadata__", None)
+        self._header = header
+        self._data_offset = 8 + header_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def keys(self):
+        return list(self._header.keys())
+
+    def metadata(self):
+        return self._metadata
+
+    def get_shape(self, key):
+        return self._header[key]["shape"]
+
+    def get_dtype(self, key):
+        return _DTYPES[self._header[key]["dtype"]]
+
+    def get_tensor(self, key):
+        info = self._header[key]
+        dtype = _DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        if start == end:
+            return torch.empty(info["shape"], dtype=dtype, device=self.device)
+
+        tensor = torch.frombuffer(
+            self._mmap,
+            dtype=dtype,
+            count=(end - start) // torch.empty((), dtype=dtype).element_size(),
+            offset=self._data_offset + start,
+        ).view(info["shape"])
+        return tensor if self.device.type == "cpu" else tensor.to(self.device)
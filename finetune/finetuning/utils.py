@@ -119,23 +119,23 @@ def tie_weights(linear: nn.Linear, embedding: nn.Embedding):
     """tie the weights of the linear layer and the embedding layer both with the same lora"""
     # this line below is optional if the original is already tied
     embedding.parametrizations.weight.original = linear.parametrizations.weight.original
-    embedding.parametrizations.weight[0].lora_A = linear.parametrizations.weight[0].lora_B
-    embedding.parametrizations.weight[0].lora_B = linear.parametrizations.weight[0].lora_A
+    embedding.parametrizations.weight[-1].lora_A = linear.parametrizations.weight[-1].lora_B
+    embedding.parametrizations.weight[-1].lora_B = linear.parametrizations.weight[-1].lora_A
 
 def untie_weights(linear: nn.Linear, embedding: nn.Embedding):
     """untie the weights of the linear layer and the embedding layer"""
     embedding.parametrizations.weight.original = nn.Parameter(embedding.weight.original.clone())
-    embedding.parametrizations.weight[0].lora_A = nn.Parameter(embedding.parametrizations.weight[0].lora_A.clone())
-    embedding.parametrizations.weight[0].lora_B = nn.Parameter(embedding.parametrizations.weight[0].lora_B.clone())
+    embedding.parametrizations.weight[-1].lora_A = nn.Parameter(embedding.parametrizations.weight[-1].lora_A.clone())
+    embedding.parametrizations.weight[-1].lora_B = nn.Parameter(embedding.parametrizations.weight[-1].lora_B.clone())
     
     
 def tie_oft_weights(linear: nn.Linear, embedding: nn.Embedding):
     """tie the weights of the linear layer and the embedding layer both with the same lora"""
     # this line below is optional if the original is already tied
     embedding.parametrizations.weight.original = linear.parametrizations.weight.original
-    embedding.parametrizations.weight[0].R = linear.parametrizations.weight[0].R
+    embedding.parametrizations.weight[-1].R = linear.parametrizations.weight[-1].R
     
 def untie_oft_weights(linear: nn.Linear, embedding: nn.Embedding):
     """untie the weights of the linear layer and the embedding layer"""
     embedding.parametrizations.weight.original = nn.Parameter(embedding.weight.original.clone())
-    embedding.parametrizations.weight[0].R = nn.Parameter(embedding.parametrizations.weight[0].R.clone())
\ No newline at end of file
+    embedding.parametrizations.weight[-1].R = nn.Parameter(embedding.parametrizations.weight[-1].R.clone())
\ No newline at end of file
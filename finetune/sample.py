@@ -7,6 +7,7 @@ from contextlib import nullcontext
 import torch
 import tiktoken
 from model import GPTConfig, GPT
+from finetuning.quantization import quantize_model, get_weight_memory
 
 ckpt_path = 'out-shakespeare/shakespeare_gpt2-large_ckpt.pt'
 
@@ -22,6 +23,8 @@ seed = 1337
 device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
 dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
 compile = False # use PyTorch 2.0 to compile the model to be faster
+quantize = '' # 'int8' or 'nf4' weight-only quantization of the model weights, '' to disable
+quantize_block_size = 64 # nf4 block size for the absmax scales
 exec(open('configurator.py').read()) # overrides from command line or config file
 # -----------------------------------------------------------------------------
 
@@ -50,6 +53,11 @@ elif init_from.startswith('gpt2'):
     # init from a given GPT-2 model
     model = GPT.from_pretrained(init_from, dict(dropout=0.0))
 
+if quantize:
+    weight_memory = get_weight_memory(model)
+    quantize_model(model, mode=quantize, block_size=quantize_block_size)
+    print(f"quantized weights to {quantize}: {weight_memory/1e6:.1f}MB -> {get_weight_memory(model)/1e6:.1f}MB")
+
 model.eval()
 model.to(device)
 if compile:
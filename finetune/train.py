@@ -40,6 +40,7 @@ from finetuning.modular_oft import (
     inject_trainable_oft_with_norm
 )
 from finetuning.modular_lora import inject_trainable_lora
+from finetuning.quantization import quantize_model, get_weight_memory
 
 from finetuning.utils import (
     get_lora_params, 
@@ -94,6 +95,9 @@ device = 'cuda'
 dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' 
 compile = True 
 
+quantize = '' # 'int8' or 'nf4' to quantize the frozen base weights, '' to disable
+quantize_block_size = 64 # nf4 block size for the absmax scales
+
 config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str))]
 exec(open('configurator.py').read()) 
 config = {k: globals()[k] for k in config_keys} 
@@ -202,6 +206,11 @@ if block_size < model.config.block_size:
     model.crop_block_size(block_size)
     model_args['block_size'] = block_size
     
+if quantize:
+    weight_memory = get_weight_memory(model)
+    quantize_model(model, mode=quantize, block_size=quantize_block_size)
+    print(f"quantized base weights to {quantize}: {weight_memory/1e6:.1f}MB -> {get_weight_memory(model)/1e6:.1f}MB")
+    
 if use_plora:
     add_lora(model, lora_config=lora_config)
     tie_weights(linear=model.lm_head, embedding=model.transformer.wte)
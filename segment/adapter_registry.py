@@ -0,0 +1,269 @@
+import os
+import re
+import json
+import time
+from collections import OrderedDict
+
+import torch
+import numpy as np
+from safetensors import safe_open # for lazy (mmap) adapter loading
+from transformers import AutoModelForCausalLM
+from peft import PeftModel
+
+
+# ADAPTER FILES
+
+ADAPTER_WEIGHTS_NAME = "adapter_model.safetensors"
+ADAPTER_BIN_NAME = "adapter_model.bin"
+ADAPTER_CONFIG_NAME = "adapter_config.json"
+
+def get_adapter_file(adapter_path):
+    """ Find the adapter weights file inside a checkpoint folder (e.g. cluster-0/epoch_1/). """
+    if os.path.isfile(adapter_path):
+        return adapter_path
+    for file_name in [ADAPTER_WEIGHTS_NAME, ADAPTER_BIN_NAME]:
+        adapter_file = os.path.join(adapter_path, file_name)
+        if os.path.isfile(adapter_file):
+            return adapter_file
+    raise FileNotFoundError(f"No adapter weights found in {adapter_path}")
+
+def get_adapter_config(adapter_path):
+    config_dir = adapter_path if os.path.isdir(adapter_path) else os.path.dirname(adapter_path)
+    with open(os.path.join(config_dir, ADAPTER_CONFIG_NAME)) as f:
+        return json.load(f)
+
+def get_peft_key(adapter_key, adapter_name="default"):
+    """
+    Map a key from a saved adapter file to the parameter name inside a PeftModel,
+    e.g. '...q_proj.lora_A.weight' -> '...q_proj.lora_A.default.weight'
+    """
+    return re.sub(r"\.(lora_[AB]|lora_embedding_[AB])\.", rf".\1.{adapter_name}.", adapter_key)
+
+def load_adapter_tensors(adapter_path, keys=None):
+    """
+    Read adapter tensors straight from the checkpoint file without touching the base model.
+    Safetensors files are memory-mapped, so only the requested keys are read from disk.
+    """
+    adapter_file = get_adapter_file(adapter_path)
+    tensors = {}
+    if adapter_file.endswith(".safetensors"):
+        with safe_open(adapter_file, framework="pt", device="cpu") as f:
+            for key in (f.keys() if keys is None else keys):
+                tensors[key] = f.get_tensor(key)
+    else:
+        state_dict = torch.load(adapter_file, map_location="cpu")
+        for key in (state_dict.keys() if keys is None else keys):
+            tensors[key] = state_dict[key]
+    return tensors
+
+
+# ADAPTER REGISTRY
+
+class AdapterRegistry:
+    """
+    Keep a single base model resident and hot-swap LoRA adapters into it.
+
+    Adapters are registered by name and loaded lazily from their safetensors files into
+    two bounded LRU tiers: a (pinned) CPU tier and a device tier. Activating an adapter
+    that is already on the device only re-points the LoRA parameters at the cached tensors,
+    so swapping costs no copies. The adapter attached to the model is always one of the device
+    tier's entries, and an evicted entry's tensors are reused for the adapter that replaces it,
+    so the device never holds more than device_capacity adapters. All registered adapters must share the same LoRA
+    config (rank, alpha and target modules) as the first adapter that is activated.
+    """
+
+    def __init__(
+        self,
+        base_model_name,
+        device=None,
+        torch_dtype=torch.float16,
+        cpu_capacity=8,
+        device_capacity=2,
+        adapter_name="default",
+        base_model=None,
+    ):
+        if device is None:
+            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.device = torch.device(device)
+        self.torch_dtype = torch_dtype
+        self.cpu_capacity = cpu_capacity
+        self.device_capacity = device_capacity
+        self.adapter_name = adapter_name
+        if device_capacity < 1:
+            raise ValueError("device_capacity must be at least 1, the active adapter lives in the device tier.")
+        if cpu_capacity < 1:
+            raise ValueError("cpu_capacity must be at least 1, adapters are staged in the CPU tier on their way to the device.")
+
+        if base_model is None:
+            base_model = AutoModelForCausalLM.from_pretrained(
+                base_model_name,
+                low_cpu_mem_usage=True,
+                return_dict=True,
+                torch_dtype=torch_dtype,
+            )
+            base_model.to(self.device)
+        self.base_model = base_model
+        self.model = None
+
+        self.adapter_paths = {}
+        self.cpu_cache = OrderedDict()
+        self.device_cache = OrderedDict()
+        self.lora_params = None
+        self.lora_config = None
+        self.active = None
+
+        self.swap_times = []
+        self.counts = {"device_hits": 0, "cpu_hits": 0, "misses": 0, "cpu_evictions": 0, "device_evictions": 0}
+
+    def register(self, name, adapter_path):
+        self.adapter_paths[name] = adapter_path
+
+    def register_checkpoints(self, checkpoint_dict):
+        """ Register every adapter from a {name: checkpoint_path} dict (e.g. fisher_parallel.load_checkpoints). """
+        for name, adapter_path in checkpoint_dict.items():
+            self.register(name, adapter_path)
+
+    def _attach(self, name):
+        # The first activated adapter builds the PeftModel that every other adapter is swapped into
+        adapter_path = self.adapter_paths[name]
+        self.model = PeftModel.from_pretrained(self.base_model, adapter_path, adapter_name=self.adapter_name)
+        self.model.to(self.device)
+        self.model.eval()
+        self.lora_config = get_adapter_config(adapter_path)
+        self.lora_params = {
+            param_name: param for param_name, param in self.model.named_parameters()
+            if "lora_" in param_name
+        }
+        # The tensors PeftModel just loaded are the first device tier entry, no second load
+        self.counts["misses"] += 1
+        self.device_cache[name] = {param_name: param.data for param_name, param in self.lora_params.items()}
+        return self.device_cache[name]
+
+    def _check_config(self, name):
+        lora_config = get_adapter_config(self.adapter_paths[name])
+        for key in ["r", "lora_alpha", "target_modules"]:
+            if lora_config.get(key) != self.lora_config.get(key):
+                raise ValueError(
+                    f"Adapter {name} has {key}={lora_config.get(key)}, "
+                    f"but the resident adapter uses {key}={self.lora_config.get(key)}"
+                )
+
+    def _load(self, name):
+        tensors = load_adapter_tensors(self.adapter_paths[name])
+        adapter = {}
+        for key, value in tensors.items():
+            param_name = get_peft_key(key, self.adapter_name)
+            if param_name not in self.lora_params:
+                raise KeyError(f"Parameter {param_name} from adapter {name} not found in the resident model.")
+            value = value.to(self.lora_params[param_name].dtype)
+            if self.device.type == "cuda":
+                value = value.pin_memory()
+            adapter[param_name] = value
+        return adapter
+
+    def _put_cpu(self, name, adapter):
+        self.cpu_cache[name] = adapter
+        self.cpu_cache.move_to_end(name)
+        while len(self.cpu_cache) > self.cpu_capacity:
+            self.cpu_cache.popitem(last=False)
+            self.counts["cpu_evictions"] += 1
+
+    def _fetch(self, name):
+        if name in self.device_cache:
+            self.counts["device_hits"] += 1
+            self.device_cache.move_to_end(name)
+            return self.device_cache[name]
+
+        if name in self.cpu_cache:
+            self.counts["cpu_hits"] += 1
+            self.cpu_cache.move_to_end(name)
+        else:
+            self.counts["misses"] += 1
+            self._check_config(name)
+            self._put_cpu(name, self._load(name))
+
+        if len(self.device_cache) >= self.device_capacity:
+            # Copy into the least recently used adapter's tensors instead of allocating new ones. If it is
+            # the active adapter (device_capacity=1) the model is switched to this one right after anyway.
+            _, buffers = self.device_cache.popitem(last=False)
+            self.counts["device_evictions"] += 1
+            adapter = {
+                param_name: buffers[param_name].copy_(value, non_blocking=True)
+                for param_name, value in self.cpu_cache[name].items()
+            }
+        else:
+            adapter = {
+                param_name: value.to(self.device, non_blocking=True)
+                for param_name, value in self.cpu_cache[name].items()
+            }
+        self.device_cache[name] = adapter
+        return adapter
+
+    @torch.no_grad()
+    def activate(self, name):
+        """ Swap adapter `name` into the resident model and return the model. """
+        if name not in self.adapter_paths:
+            raise KeyError(f"Adapter {name} has not been registered.")
+
+        start = time.perf_counter()
+        if self.model is None:
+            adapter = self._attach(name)
+        else:
+            adapter = self._fetch(name)
+        for param_name, value in adapter.items():
+            self.lora_params[param_name].data = value
+        self.active = name
+
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        self.swap_times.append(time.perf_counter() - start)
+        return self.model
+
+    def metrics(self):
+        lookups = self.counts["device_hits"] + self.counts["cpu_hits"] + self.counts["misses"]
+        swap_ms = np.array(self.swap_times) * 1000 if self.swap_times else np.zeros(1)
+        return {
+            **self.counts,
+            "lookups": lookups,
+            "hit_rate": (self.counts["device_hits"] + self.counts["cpu_hits"]) / max(lookups, 1),
+            "device_hit_rate": self.counts["device_hits"] / max(lookups, 1),
+            "swap_ms_mean": float(swap_ms.mean()),
+            "swap_ms_p50": float(np.percentile(swap_ms, 50)),
+            "swap_ms_p95": float(np.percentile(swap_ms, 95)),
+        }
+
+    def print_metrics(self):
+        metrics = self.metrics()
+        print(
+            f"""
+            Adapter registry metrics:
+            Lookups: {metrics['lookups']}
+            Hit Rate: {metrics['hit_rate']:.2%} (device: {metrics['device_hit_rate']:.2%})
+            Misses: {metrics['misses']}
+            Evictions: cpu {metrics['cpu_evictions']}, device {metrics['device_evictions']}
+            Swap Latency (ms): mean {metrics['swap_ms_mean']:.3f}, p50 {metrics['swap_ms_p50']:.3f}, p95 {metrics['swap_ms_p95']:.3f}
+            """
+        )
+
+
+if __name__ == "__main__":
+
+    from fisher_parallel import load_checkpoints
+
+    model_name = "meta-llama/Llama-2-7b-hf"
+    pretrained_model = "guanaco-7b-r64-a16-2"
+    num_clusters = 2
+    epoch_num = 1
+    num_rounds = 10
+
+    checkpoint_dict = load_checkpoints(pretrained_model, num_clusters, torch.device("cpu"), target_epoch=f'epoch_{epoch_num}')
+
+    registry = AdapterRegistry(model_name, cpu_capacity=num_clusters, device_capacity=num_clusters)
+    registry.register_checkpoints(checkpoint_dict)
+
+    # Cycle through every cluster adapter on the same resident base model
+    for _ in range(num_rounds):
+        for cluster_name in checkpoint_dict.keys():
+            model = registry.activate(cluster_name)
+
+    registry.print_metrics()
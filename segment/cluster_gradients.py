@@ -24,17 +24,20 @@ from trl import SFTTrainer
 import os
 from datasets import load_dataset, Dataset
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.cluster import KMeans
-import pandas as pd
 import numpy as np
 from itertools import islice
 from tqdm.auto import tqdm
 
-from sklearn.decomposition import IncrementalPCA
+from sklearn.decomposition import IncrementalPCA, PCA
+from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score, silhouette_score
 from joblib import dump, load
 import gc
 from functools import partial
 
+from gradient_sketch import GradientSketch
+from streaming_kmeans import cluster_ids
+from cluster_splits import split_by_cluster
+
 # from cuml.decomposition import IncrementalPCA
 # import cupy as cp
 # import cupyx
@@ -102,30 +105,209 @@ def aggregate_gradients_for_batch(batch, model, max_length=None):
     return all_gradients
 
 
+def lm_head_gradients(batch, model):
+    """ The lm_head gradients of aggregate_gradients_for_batch, left on the device and unflattened. """
+    batch = {k: v.to("cuda") for k, v in batch.items()}
+    model.zero_grad()
+    outputs = model(**batch)
+    outputs.loss.backward()
+    return [
+        parameter.grad for name, parameter in model.named_parameters()
+        if "lm_head" in name and parameter.requires_grad and parameter.grad is not None
+    ]
+
+
+def freeze_except_lm_head(model):
+    # Only the lm_head gradients are used as features, skip computing the other ~7B
+    for name, parameter in model.named_parameters():
+        parameter.requires_grad_("lm_head" in name)
+
+
+def lm_head_sketch(model, sketch_dim, seed=0, distribution="rademacher"):
+    """ GradientSketch of the flattened lm_head weight, with blocks aligned to whole vocabulary rows. """
+    vocab_size, hidden_size = model.get_output_embeddings().weight.shape
+    rows_per_block = max(1, (1 << 26) // (sketch_dim * hidden_size))
+    sketch = GradientSketch(vocab_size * hidden_size, sketch_dim, seed=seed, distribution=distribution, block_size=rows_per_block * hidden_size)
+    return sketch, rows_per_block
+
+
+def sketch_gradients(model, tokenized_dataset, tokenizer, sketch_dim, seed=0, distribution="rademacher", sketch_batch_size=8):
+    """
+    Per-example lm_head gradients compressed to sketch_dim features by a GradientSketch in one pass.
+
+    Each example's gradient is projected into its own (1, sketch_dim) row right after its backward, so
+    memory beyond the model's own .grad is O(sketch_dim) per example. The rows of sketch_batch_size
+    examples are copied to the host together, and only the (num_examples, sketch_dim) float32 sketch
+    is kept there.
+    """
+    lm_head_params = [parameter for name, parameter in model.named_parameters() if "lm_head" in name and parameter.requires_grad]
+    sketch, _ = lm_head_sketch(model, sketch_dim, seed=seed, distribution=distribution)
+    rows = torch.zeros(sketch_batch_size, sketch_dim, device=lm_head_params[0].device, dtype=torch.float32)
+
+    dataloader = get_tokenized_dataloader(tokenized_dataset, tokenizer, 1)
+    num_examples = len(dataloader)
+    sketched_gradients = np.zeros((num_examples, sketch_dim), dtype=np.float32)
+    filled, written = 0, 0
+
+    for batch in tqdm(dataloader, desc=f'Sketching gradients to {sketch_dim} dims...'):
+        sketch.project_tensors(lm_head_gradients(batch, model), out=rows[filled:filled + 1])
+        filled += 1
+
+        if filled == sketch_batch_size or written + filled == num_examples:
+            sketched_gradients[written:written + filled] = rows[:filled].cpu().numpy()
+            written += filled
+            filled = 0
+            rows.zero_()
+
+    return sketched_gradients
+
+
+@torch.no_grad()
+def lm_head_example_features(batch, model, sketch, rows_per_block):
+    """
+    Sketches of the lm_head gradient of every example in the batch from one forward pass, no backward.
+
+    For the causal LM loss the lm_head gradient of example e is sum_t delta_t h_t^T, with h_t the final
+    hidden state and delta_t = (softmax(z_t) - onehot(y_t)) / n_e the logit residual of its n_e target
+    tokens (the same gradient as a batch of one). It is formed for the whole batch one block of
+    vocabulary rows at a time and projected straight into the sketch, so the (batch, vocab, hidden)
+    per-example gradients never exist at once.
+    """
+    batch = {k: v.to(next(model.parameters()).device) for k, v in batch.items()}
+    outputs = model(input_ids=batch['input_ids'], attention_mask=batch['attention_mask'], output_hidden_states=True)
+
+    device = model.get_output_embeddings().weight.device
+    hidden = outputs.hidden_states[-1][:, :-1].to(device, torch.float32)
+    targets = batch['labels'][:, 1:].to(device)
+    valid = targets != -100
+
+    residuals = torch.softmax(outputs.logits[:, :-1].to(device, torch.float32), dim=-1)
+    residuals.scatter_add_(-1, targets.clamp(min=0).unsqueeze(-1), -valid.unsqueeze(-1).float())
+    residuals.mul_((valid / valid.sum(dim=1, keepdim=True).clamp(min=1)).unsqueeze(-1))
+
+    vocab_size, hidden_size = residuals.shape[-1], hidden.shape[-1]
+    features = None
+    for start in range(0, vocab_size, rows_per_block):
+        end = min(start + rows_per_block, vocab_size)
+        gradient_rows = torch.einsum('btv,bth->bvh', residuals[:, :, start:end], hidden)
+        features = sketch.project(gradient_rows.reshape(gradient_rows.shape[0], -1), offset=start * hidden_size, out=features)
+    return features
+
+
+def extract_gradient_features(model, tokenized_dataset, tokenizer, batch_size, sketch_dim, n_components, seed=0, features_path=None, checkpoint_every=100):
+    """
+    Single streaming pass over the dataset: per-example sketched lm_head gradients for a whole batch per
+    forward (lm_head_example_features), written to a (num_examples, sketch_dim) memmap while an
+    IncrementalPCA is fitted on them. The reduction then only transforms the stored sketches, so the
+    model runs over the data once instead of once to fit and once more per example to reduce.
+
+    Every checkpoint_every batches the IPCA and the cursor are saved next to the memmap (whose rows
+    since the last fit are the unfitted buffer), and a rerun resumes from exactly that row.
+    """
+    sketch, rows_per_block = lm_head_sketch(model, sketch_dim, seed=seed)
+
+    num_examples = len(tokenized_dataset)
+    features_path = features_path or f"gradient_sketch_k{sketch_dim}_seed{seed}.npy"
+    checkpoint_path = features_path + ".state.joblib"
+
+    if os.path.exists(checkpoint_path) and os.path.exists(features_path):
+        state = load_stream_state(checkpoint_path)
+        features = np.lib.format.open_memmap(features_path, mode="r+")
+        if features.shape != (num_examples, sketch_dim):
+            raise ValueError(f"{features_path} has shape {features.shape}, expected {(num_examples, sketch_dim)}. Remove it and {checkpoint_path} to start over.")
+        ipca, written, fit_from = state['ipca'], state['examples_seen'], state['fit_from']
+        print(f"Resuming gradient feature extraction from example {written} ({checkpoint_path})")
+    else:
+        features = np.lib.format.open_memmap(features_path, mode="w+", dtype=np.float32, shape=(num_examples, sketch_dim))
+        ipca = IncrementalPCA(n_components=n_components)
+        fit_from = 0
+        written = 0
+
+    # Seek directly to the first unprocessed example
+    dataloader = get_tokenized_dataloader(tokenized_dataset.select(range(written, num_examples)), tokenizer, batch_size)
+    for step, batch in enumerate(tqdm(dataloader, desc='Extracting per-example gradient features...'), start=1):
+        batch_features = lm_head_example_features(batch, model, sketch, rows_per_block).cpu().numpy()
+        features[written:written + len(batch_features)] = batch_features
+        written += len(batch_features)
+        # partial_fit needs at least n_components rows
+        if written - fit_from >= max(n_components, batch_size):
+            ipca.partial_fit(features[fit_from:written])
+            fit_from = written
+        if step % checkpoint_every == 0:
+            features.flush()
+            save_stream_state(checkpoint_path, {'ipca': ipca, 'examples_seen': written, 'fit_from': fit_from})
+    if written - fit_from >= n_components:
+        ipca.partial_fit(features[fit_from:written])
+        fit_from = written
+    features.flush()
+    save_stream_state(checkpoint_path, {'ipca': ipca, 'examples_seen': written, 'fit_from': fit_from})
+    print(f"Saved gradient sketches with shape {features.shape} to {features_path}")
+
+    reduced_gradients = np.concatenate([
+        ipca.transform(features[start:start + 65536]) for start in range(0, num_examples, 65536)
+    ])
+    return reduced_gradients, ipca
+
+
+def cluster_quality(features, labels, reference_labels=None):
+    """ Silhouette of a clustering, plus its agreement (ARI / NMI) with a reference clustering if given. """
+    quality = {'silhouette': silhouette_score(features, labels, sample_size=min(len(labels), 10000), random_state=0)}
+    if reference_labels is not None:
+        quality['ari'] = adjusted_rand_score(reference_labels, labels)
+        quality['nmi'] = normalized_mutual_info_score(reference_labels, labels)
+    return quality
+
+
 ##### CHECKPOINTING ######
 
-def manage_ipca_checkpoints(ipca_model_name, step_count, ipca, max_checkpoints=10):
+def save_stream_state(checkpoint_path, state):
+    """ Write the job state (IPCA, data cursor, unfitted buffer) atomically, a crash mid-write keeps the old file. """
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, checkpoint_path)
+
 
+def load_stream_state(checkpoint_path):
+    state = load(checkpoint_path)
+    if not isinstance(state, dict):
+        # Older checkpoints only pickled the IPCA, their suffix is the number of batches consumed
+        step_count = int(checkpoint_path.split('_')[-1].split('.')[0])
+        state = {'ipca': state, 'batches_seen': step_count, 'buffer': [], 'num_fits': 0}
+    return state
+
+
+def sorted_ipca_checkpoints(ipca_model_name):
     checkpoint_pattern = f"{ipca_model_name}_*.joblib"
     existing_checkpoints = glob.glob(checkpoint_pattern)
-    sorted_checkpoints = sorted(existing_checkpoints, key=lambda x: int(x.split('_')[-1].split('.')[0]))
-    
-    while len(sorted_checkpoints) >= max_checkpoints:
-        os.remove(sorted_checkpoints.pop(0))  # Remove the oldest checkpoint
-    
-    # Save the new checkpoint
+    return sorted(existing_checkpoints, key=lambda x: int(x.split('_')[-1].split('.')[0]))
+
+
+def manage_ipca_checkpoints(ipca_model_name, step_count, ipca, gradient_buffer=None, num_fits=0, max_checkpoints=10):
+
+    # Save the new checkpoint: the IPCA, the batches consumed so far and the gradients buffered since the last fit
     last_saved_pca = f"{ipca_model_name}_{step_count}.joblib"
-    dump(ipca, last_saved_pca)
-    
-    # Add the new checkpoint to the list
-    sorted_checkpoints.append(last_saved_pca)
+    state = {'ipca': ipca, 'batches_seen': step_count, 'buffer': list(gradient_buffer or []), 'num_fits': num_fits}
+    save_stream_state(last_saved_pca, state)
+
+    sorted_checkpoints = sorted_ipca_checkpoints(ipca_model_name)
+    while len(sorted_checkpoints) > max_checkpoints:
+        os.remove(sorted_checkpoints.pop(0))  # Remove the oldest checkpoint
     
     print(f"{step_count}: saving PCA at {last_saved_pca}. There are {len(sorted_checkpoints)} checkpoints saved.")
 
     
 #### CLUSTERING #########
 
-def cluster_gradients(dataset, num_clusters, batch_size, max_length, compute_pca=True, ipca_checkpoint_step=None):
+def cluster_features(features, num_clusters, backend="full"):
+    # Cluster id per row of features, the examples are split later with split_by_cluster
+    return cluster_ids(features, num_clusters, backend=backend)
+
+
+def cluster_gradients(dataset, num_clusters, batch_size, max_length, compute_pca=True, ipca_checkpoint_step=None,
+                      feature_mode="ipca", sketch_dim=256, sketch_pca_components=None, sketch_seed=0, clustering_backend="full"):
 
     # For PCA, n_components must be less or equal to batch_size
     n_components = batch_size
@@ -156,6 +338,25 @@ def cluster_gradients(dataset, num_clusters, batch_size, max_length, compute_pca
     )
     tokenized_dataset = tokenized_dataset.map(shift_labels_right, batched=True)
     print(f"Tokenized dataset length: {len(tokenized_dataset)}")
+    freeze_except_lm_head(model)
+
+    if feature_mode == "sketch":
+        # Random projection instead of IncrementalPCA: one pass, O(sketch_dim) memory per example
+        features = sketch_gradients(model, tokenized_dataset, tokenizer, sketch_dim, seed=sketch_seed)
+        np.save(f"sketched_gradients_k{sketch_dim}_seed{sketch_seed}.npy", features)
+        print(f"Saved sketched gradients with shape {features.shape} to sketched_gradients_k{sketch_dim}_seed{sketch_seed}.npy")
+        if sketch_pca_components is not None:
+            features = PCA(n_components=sketch_pca_components, random_state=0).fit_transform(features)
+        return cluster_features(features, num_clusters, clustering_backend)
+
+    if feature_mode == "lowrank":
+        # One forward per batch gives every example's projected gradient, PCA is fitted in the same pass
+        reduced_gradients, ipca = extract_gradient_features(
+            model, tokenized_dataset, tokenizer, batch_size, sketch_dim, n_components, seed=sketch_seed
+        )
+        dump(ipca, f"bs{batch_size}_ml{max_length}_lmhead_sketch{sketch_dim}_ipca.joblib")
+        np.save(f"reduced_gradients_stack_bs{batch_size}.npy", reduced_gradients)
+        return cluster_features(reduced_gradients, num_clusters, clustering_backend)
 
     ipca = IncrementalPCA(n_components=n_components, batch_size=batch_size)
     debug_mode = False
@@ -195,13 +396,9 @@ def cluster_gradients(dataset, num_clusters, batch_size, max_length, compute_pca
         
     gradient_shape = batch_gradients.shape if debug_mode else (batch_size, 131072000)
     reduced_shape = reduced_gradients_batch.shape if debug_mode else (1, n_components)
-    gradient_buffer = []
-        
-    dataloader = get_tokenized_dataloader(tokenized_dataset, tokenizer, batch_size)
-    iterator = iter(dataloader)
     
     step_count = 0
-    total_steps = len(iterator)
+    total_steps = math.ceil(len(tokenized_dataset) / batch_size)
     
     num_fits = 0
     save_every = 6 # Save after every X fits
@@ -216,15 +413,26 @@ def cluster_gradients(dataset, num_clusters, batch_size, max_length, compute_pca
         load_ipca_checkpoint = True
         
     ipca_model_name = f"bs{batch_size}_ml{max_length}_lmhead_ipca" # ["ipca_model", "b1_lmhead_ipca"]
-    # ipca_checkpoint_step = 1231
-    ipca_checkpoint = f"{ipca_model_name}_{ipca_checkpoint_step}.joblib" 
+    # ipca_checkpoint_step = 1231, or "latest"
+    if ipca_checkpoint_step == "latest":
+        existing_checkpoints = sorted_ipca_checkpoints(ipca_model_name)
+        if existing_checkpoints:
+            ipca_checkpoint = existing_checkpoints[-1]
+        elif compute_pca:
+            print(f"No IPCA checkpoints matching {ipca_model_name}_*.joblib, starting a new IPCA.")
+            load_ipca_checkpoint = False
+            ipca_checkpoint = None
+        else:
+            raise FileNotFoundError(f"No IPCA checkpoints matching {ipca_model_name}_*.joblib to load with compute_pca=False.")
+    else:
+        ipca_checkpoint = f"{ipca_model_name}_{ipca_checkpoint_step}.joblib" 
     
     print(f"""
         Starting Incremental PCA training with the following configs, saving after every {save_every} fits.
 
         Compute IPCA: {compute_pca}
         Load IPCA Checkpoint: {load_ipca_checkpoint}
-        IPCA Checkpoint Step: {ipca_checkpoint_step}
+        IPCA Checkpoint: {ipca_checkpoint if load_ipca_checkpoint else None}
         Num Components: {n_components}
         Batch Size: {batch_size}
         Gradient Buffer Size: {gradient_buffer_size}
@@ -234,48 +442,47 @@ def cluster_gradients(dataset, num_clusters, batch_size, max_length, compute_pca
     """)
     
     if load_ipca_checkpoint:
-        ipca = load(ipca_checkpoint)
-        start_batch_index = ipca_checkpoint_step
-        print(f"Loaded IPCA checkpoint from {ipca_checkpoint}.")
+        state = load_stream_state(ipca_checkpoint)
+        ipca = state['ipca']
+        start_batch_index = state['batches_seen']
+        gradient_buffer = state['buffer']
+        num_fits = state['num_fits']
+        print(f"Loaded IPCA checkpoint from {ipca_checkpoint}: {start_batch_index} batches seen, {len(gradient_buffer)} buffered.")
     else:
         start_batch_index = 0
 
     if compute_pca: # Process gradients in batches and accumulate in buffer
-        for i in tqdm(range(0, len(dataloader)), desc='Estimating PCA model from gradients...'):
+        # Seek straight past the batches already in the checkpoint instead of running the model over them
+        remaining_dataset = tokenized_dataset.select(range(min(start_batch_index * batch_size, len(tokenized_dataset)), len(tokenized_dataset)))
+        dataloader = get_tokenized_dataloader(remaining_dataset, tokenizer, batch_size)
+        step_count = start_batch_index
 
-            batch = next(iterator)
+        for batch in tqdm(dataloader, initial=start_batch_index, total=total_steps, desc='Estimating PCA model from gradients...'):
             step_count += 1
-            if (load_ipca_checkpoint and step_count > ipca_checkpoint_step) or not load_ipca_checkpoint:                   
-
-                if batch['input_ids'].shape[0] < expected_batch_size:
-                    print(f"Skipping a batch with size {len(batch)} which is smaller than the expected size {expected_batch_size}.")
-                    continue
-                else:
-                    batch_gradients = aggregate_gradients_for_batch(batch, model, max_length)
-                    gradient_buffer.append(batch_gradients) # Append batch_size (8) gradients to the buffer
-
-                    # If buffer is full (8 gradients from a total of 64 examples) then do a partial fit
-                    if len(gradient_buffer) == gradient_buffer_size:
-                        gradient_list = np.vstack(gradient_buffer) 
-                        ipca.partial_fit(gradient_list)
-                        num_fits += 1
-                        
-                        # TODO: save checkpoint after partial fits so examples are not missed
-                        if num_fits % save_every == 0:
-                            manage_ipca_checkpoints(ipca_model_name, step_count, ipca)
-                        
-                        del gradient_list  
-                        del gradient_buffer
-                        torch.cuda.empty_cache()  
-                        gc.collect()
-                        gradient_buffer = []  
-                        torch.cuda.empty_cache() 
-                        gc.collect()
-
-
-        print(f"{step_count}/{total_steps}: saving PCA at ipca_model_{step_count}.joblib")
-        last_saved_pca = f"{ipca_model_name}_{step_count}.joblib"
-        dump(ipca, last_saved_pca)
+
+            if batch['input_ids'].shape[0] < expected_batch_size:
+                print(f"Skipping a batch with size {batch['input_ids'].shape[0]} which is smaller than the expected size {expected_batch_size}.")
+                continue
+
+            batch_gradients = aggregate_gradients_for_batch(batch, model, max_length)
+            gradient_buffer.append(batch_gradients) # Append batch_size (8) gradients to the buffer
+
+            # If buffer is full (8 gradients from a total of 64 examples) then do a partial fit
+            if len(gradient_buffer) == gradient_buffer_size:
+                gradient_list = np.vstack(gradient_buffer) 
+                ipca.partial_fit(gradient_list)
+                num_fits += 1
+                gradient_buffer = []  
+
+                # Checkpoint right after a fit, so the cursor matches the IPCA and nothing buffered is lost
+                if num_fits % save_every == 0:
+                    manage_ipca_checkpoints(ipca_model_name, step_count, ipca, gradient_buffer, num_fits)
+                
+                del gradient_list  
+                torch.cuda.empty_cache() 
+                gc.collect()
+
+        manage_ipca_checkpoints(ipca_model_name, step_count, ipca, gradient_buffer, num_fits)
 
     gradient_buffer = []
     reduced_gradients = []
@@ -301,13 +508,7 @@ def cluster_gradients(dataset, num_clusters, batch_size, max_length, compute_pca
     print(f"Saved reduced gradients with shape {stacked_gradients.shape} to reduced_gradients_stack.npy")
     
     # Cluster the gradient features
-    kmeans = KMeans(n_clusters=num_clusters, random_state=0)
-    kmeans.fit(stacked_gradients)
-    cluster_labels = kmeans.labels_
-
-    # Create the clustered dataset
-    clustered_data = pd.DataFrame({'text': dataset['text'][:num_examples], 'cluster': cluster_labels})
-    return clustered_data
+    return cluster_features(stacked_gradients, num_clusters, clustering_backend)
 
 
 # Function to fit IncrementalPCA and calculate cumulative explained variance
@@ -338,7 +539,8 @@ def find_n_components(X, target_variance, batch_size):
 
 
 
-def main(cluster_name, dataset, num_clusters, num_components, max_length, test_pca=False, compute_pca=True, ipca_checkpoint_step=None):
+def main(cluster_name, dataset, num_clusters, num_components, max_length, test_pca=False, compute_pca=True, ipca_checkpoint_step=None,
+         feature_mode="ipca", sketch_dim=256, clustering_backend="full"):
     
     model_name = "meta-llama/Llama-2-7b-hf" # Also try "mistralai/Mistral-7B-v0.1"
     cluster = cluster_name
@@ -375,20 +577,23 @@ def main(cluster_name, dataset, num_clusters, num_components, max_length, test_p
             Num Clusters: {num_clusters}
             Num Components: {num_components}
             Max Seq Length: {max_length}
+            Feature Mode: {feature_mode}
+            Sketch Dim: {sketch_dim}
+            Clustering Backend: {clustering_backend}
         """)
         
-        clustered_data = cluster_gradients(train_dataset, num_clusters, num_components, max_length, compute_pca, ipca_checkpoint_step)
-        save_path = f"gradient_clusters_{num_clusters}.csv" 
-        clustered_data.to_csv(save_path)
-        print(f"Clustered data using model gradients and saved dataframe to {save_path}")
-
-        unique_clusters = clustered_data['cluster'].unique()
-        cluster_datasets = {}
+        cluster_labels = cluster_gradients(
+            train_dataset, num_clusters, num_components, max_length, compute_pca, ipca_checkpoint_step,
+            feature_mode=feature_mode, sketch_dim=sketch_dim,
+            sketch_pca_components=num_components if feature_mode == "sketch" else None,
+            clustering_backend=clustering_backend,
+        )
+        save_path = f"gradient_clusters_{num_clusters}_labels.npy"
+        np.save(save_path, cluster_labels)
+        print(f"Clustered data using model gradients and saved cluster ids to {save_path}")
 
-        # Loop through each cluster and create datasets
-        for cluster_label in unique_clusters:
-            cluster_df = clustered_data[clustered_data['cluster'] == cluster_label]
-            cluster_datasets[f"cluster_{cluster_label}"] = Dataset.from_pandas(cluster_df)
+        # Index views of the examples that have gradient features, no text is copied
+        cluster_datasets = split_by_cluster(train_dataset, cluster_labels, ['text'])
 
         # Sort the cluster numerically
         cluster_datasets = dict(sorted(cluster_datasets.items()))  
@@ -401,7 +606,8 @@ def main(cluster_name, dataset, num_clusters, num_components, max_length, test_p
             print(f'({count}/{total}) Saving {cluster_label} for {dataset} dataset...')
             print(cluster_dataset[0])
             dataset_length = len(cluster_dataset)    
-            dataset_name = f"data/{dataset}_pca{num_components}_{num_clusters}_{cluster_label}_{dataset_length}.json"
+            feature_tag = f"pca{num_components}" if feature_mode == "ipca" else f"{feature_mode}{sketch_dim}_pca{num_components}"
+            dataset_name = f"data/{dataset}_{feature_tag}_{num_clusters}_{cluster_label}_{dataset_length}.json"
             cluster_dataset.to_json(dataset_name)
             count += 1
     else:
@@ -477,8 +683,15 @@ if __name__ == "__main__":
     test_pca = True
     compute_pca = False
     
+    # "ipca", "sketch" (seeded random projection of each gradient, then PCA on the sketch) or
+    # "lowrank" (sketches of a whole batch of per-example gradients per forward, PCA in the same pass)
+    feature_mode = "ipca"
+    sketch_dim = 256
+    clustering_backend = "full" # exact in-memory KMeans, or "minibatch" for approximate streaming k-means
+    
     cluster_name = "narval"
     dataset = "guanaco"
     
-    main(cluster_name, dataset, num_clusters, num_components, max_length, test_pca=test_pca, compute_pca=compute_pca, ipca_checkpoint_step=ipca_checkpoint_step)
+    main(cluster_name, dataset, num_clusters, num_components, max_length, test_pca=test_pca, compute_pca=compute_pca, ipca_checkpoint_step=ipca_checkpoint_step,
+         feature_mode=feature_mode, sketch_dim=sketch_dim, clustering_backend=clustering_backend)
     
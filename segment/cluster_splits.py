@@ -0,0 +1,34 @@
+import numpy as np
+
+
+def split_by_cluster(dataset, cluster_labels, columns):
+    """
+    One dataset per cluster as index views of dataset: a single stable argsort by cluster id, then a
+    Dataset.select of each cluster's contiguous slice, so no text is copied (instead of filtering a
+    DataFrame of all text once per cluster).
+    """
+    # rows past the end of cluster_labels (e.g. gradients computed on a prefix) get no cluster
+    labels = np.full(len(dataset), -1, dtype=np.int64)
+    labels[:len(cluster_labels)] = cluster_labels
+    # add the column before any select, add_column would otherwise flatten (copy) an index mapping
+    dataset = dataset.remove_columns([column for column in dataset.column_names if column not in columns])
+    dataset = dataset.add_column('cluster', labels)
+
+    order = np.argsort(labels, kind="stable")
+    unique_labels, starts = np.unique(labels[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    return {
+        f"cluster_{label}": dataset.select(order[start:end])
+        for label, start, end in zip(unique_labels, starts, ends) if label >= 0
+    }
+
+def write_split(cluster_dataset, path, split_format):
+    if split_format == "json":
+        cluster_dataset.to_json(path) # JSON lines
+    elif split_format == "parquet":
+        cluster_dataset.to_parquet(path)
+    elif split_format == "arrow":
+        cluster_dataset.save_to_disk(path)
+    else:
+        raise ValueError(f"Unknown split format {split_format}, expected json, parquet or arrow.")
+    return path
@@ -0,0 +1,146 @@
+import os
+import re
+import json
+import glob
+
+import torch
+import numpy as np
+
+
+class FisherAccumulator:
+    """
+    Accumulate a diagonal Fisher into one preallocated, memory-mapped flat fp32 buffer on disk.
+
+    Every parameter owns a slice of the buffer (see offsets), and tensor(name) returns a zero-copy
+    view of it, so accumulation and normalization happen in place and only one copy of the Fisher
+    ever exists. Every flush_every samples the buffer is snapshotted to a new versioned checkpoint
+    file, and the state file that names it (with the sample count) is then replaced. Replacing the
+    state file is the only commit point, so a killed job resumes from the last complete flush instead
+    of starting over, and never pairs new data with an old sample count.
+    """
+
+    def __init__(self, path, shapes, flush_every=100):
+        self.path = path
+        self.flush_every = flush_every
+        self.buffer_path = path + ".buffer"
+        self.checkpoint_path = None
+        self.state_path = path + ".state.json"
+
+        self.shapes = {name: list(shape) for name, shape in shapes.items()}
+        self.offsets = {}
+        total = 0
+        for name, shape in self.shapes.items():
+            self.offsets[name] = total
+            total += int(np.prod(shape))
+        self.numel = total
+
+        self.num_samples = 0
+        self.normalized = False
+        self.last_flush = 0
+
+        state = self._load_state()
+        self.buffer = np.memmap(self.buffer_path, dtype=np.float32, mode="w+", shape=(max(self.numel, 1),))
+        if state is not None:
+            # Resume from the last flushed checkpoint, the live buffer may hold unflushed samples
+            self._copy(np.memmap(self.checkpoint_path, dtype=np.float32, mode="r", shape=self.buffer.shape), self.buffer)
+            self.num_samples = state["num_samples"]
+            self.normalized = state["normalized"]
+            self.last_flush = self.num_samples
+            print(f"Resuming Fisher accumulation from {self.num_samples} samples ({self.checkpoint_path})")
+        self._remove_stale_checkpoints()
+
+    def _load_state(self):
+        if not os.path.exists(self.state_path):
+            return None
+        with open(self.state_path) as f:
+            state = json.load(f)
+        checkpoint_path = state.get("checkpoint", self.path + ".ckpt")
+        if not os.path.exists(checkpoint_path):
+            return None
+        if state["shapes"] != self.shapes:
+            print(f"Ignoring Fisher checkpoint {checkpoint_path}, its parameters do not match")
+            return None
+        self.checkpoint_path = checkpoint_path
+        return state
+
+    def _remove_stale_checkpoints(self):
+        # Snapshots left behind by a flush that was interrupted before or after its commit
+        snapshot = re.compile(re.escape(self.path) + r"(\.\d+(\.normalized)?)?\.ckpt(\.tmp)?$")
+        for file_path in glob.glob(glob.escape(self.path) + ".*ckpt*"):
+            if snapshot.match(file_path) and file_path != self.checkpoint_path:
+                os.remove(file_path)
+
+    @staticmethod
+    def _copy(source, target, chunk_size=1 << 24):
+        # Copy in chunks so neither buffer is ever fully resident in memory
+        for start in range(0, source.shape[0], chunk_size):
+            target[start:start + chunk_size] = source[start:start + chunk_size]
+
+    def tensor(self, name):
+        offset = self.offsets[name]
+        numel = int(np.prod(self.shapes[name]))
+        return torch.from_numpy(self.buffer[offset:offset + numel]).view(self.shapes[name])
+
+    def tensors(self):
+        return {name: self.tensor(name) for name in self.shapes.keys()}
+
+    def add(self, example_fisher):
+        for param_name, value in example_fisher.items():
+            self.tensor(param_name).add_(value.detach().to("cpu", torch.float32))
+
+    def step(self, count=1):
+        self.num_samples += count
+        if self.num_samples - self.last_flush >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """
+        Snapshot the buffer to {path}.{num_samples}[.normalized].ckpt, then commit it by atomically
+        replacing the state file that names it, and only then delete the previous snapshot.
+        """
+        checkpoint_path = f"{self.path}.{self.num_samples}{'.normalized' if self.normalized else ''}.ckpt"
+        if checkpoint_path == self.checkpoint_path:
+            return
+        self.buffer.flush()
+        checkpoint = np.memmap(checkpoint_path + ".tmp", dtype=np.float32, mode="w+", shape=self.buffer.shape)
+        self._copy(self.buffer, checkpoint)
+        checkpoint.flush()
+        del checkpoint
+        os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+        state = {
+            "num_samples": self.num_samples, "normalized": self.normalized, "shapes": self.shapes,
+            "checkpoint": checkpoint_path,
+        }
+        with open(self.state_path + ".tmp", "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+        previous_checkpoint_path, self.checkpoint_path = self.checkpoint_path, checkpoint_path
+        if previous_checkpoint_path is not None and os.path.exists(previous_checkpoint_path):
+            os.remove(previous_checkpoint_path)
+        self.last_flush = self.num_samples
+
+    @torch.no_grad()
+    def normalize(self):
+        """ Divide the accumulated Fisher by the number of samples in place and commit it as a new snapshot. """
+        if not self.normalized:
+            self.buffer /= max(self.num_samples, 1)
+            self.normalized = True
+            self.flush()
+
+    def save(self, fisher_path):
+        """ Save the Fisher as a {param_name: tensor} dict, the same format as before. """
+        torch.save(self.tensors(), fisher_path)
+
+    def remove(self):
+        """ Delete the buffer and checkpoint files once the final Fisher has been saved. """
+        del self.buffer
+        # the state file first, so a crash midway never leaves a state pointing at a deleted snapshot
+        for file_path in [self.state_path, self.buffer_path, self.checkpoint_path]:
+            if file_path is not None and os.path.exists(file_path):
+                os.remove(file_path)
+        self.checkpoint_path = None
+        self._remove_stale_checkpoints()
@@ -0,0 +1,175 @@
+import os
+from functools import partial
+
+import torch
+import torch.distributed as dist
+from datasets import load_dataset, Dataset
+from transformers import AutoTokenizer
+
+from fisher import is_distributedSetup
+from fisher_parallel import (
+    estimate_fisher,
+    select_fisher_params,
+    load_peft_model,
+    load_checkpoints,
+    get_tokenized_dataloader,
+    preprocess_instruct,
+    tokenize_function,
+    shift_labels_right,
+)
+
+# Data-parallel Fisher computation, launch with e.g.
+# $ torchrun --nproc_per_node=4 fisher_distributed.py
+
+# DISTRIBUTED SETUP
+
+def setup_distributed():
+    """ Read the torchrun environment and join the process group (nccl on GPU, gloo on CPU). """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    rank = int(os.environ.get("RANK", 0))
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+
+    if torch.cuda.is_available():
+        device = torch.device(f"cuda:{local_rank}")
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device("cpu")
+
+    if is_distributedSetup(world_size) and not dist.is_initialized():
+        dist.init_process_group(backend="nccl" if device.type == "cuda" else "gloo")
+    return rank, world_size, device
+
+def cleanup_distributed():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+def get_rank_shard(dataset, num_examples, rank, world_size):
+    """
+    Rank-strided shard of the first num_examples examples. Unlike DistributedSampler, the shards are
+    not padded with repeated examples, so every example is counted exactly once in the reduced Fisher.
+    """
+    indices = range(rank, min(num_examples, len(dataset)), world_size)
+    if isinstance(dataset, Dataset):
+        return dataset.select(indices)
+    return [dataset[i] for i in indices]
+
+def all_reduce_fisher(stored_fisher, num_samples, model, device, world_size):
+    """
+    Sum the partial Fishers (and sample counts) of all ranks with a single all_reduce over one flat
+    fp32 buffer, then return the normalized Fisher. Parameters are flattened in named_parameters
+    order, so the layout is the same on every rank.
+    """
+    shapes = {name: param.shape for name, param in model.named_parameters() if param.requires_grad}
+    if not shapes:
+        raise ValueError("No parameters require grad, the Fisher selector matched nothing.")
+    flat_fisher = torch.cat([
+        stored_fisher[name].to(device, torch.float32).flatten()
+        if name in stored_fisher else torch.zeros(shape.numel(), device=device)
+        for name, shape in shapes.items()
+    ])
+    count = torch.tensor([num_samples], dtype=torch.float32, device=device)
+
+    if is_distributedSetup(world_size):
+        dist.all_reduce(flat_fisher, op=dist.ReduceOp.SUM)
+        dist.all_reduce(count, op=dist.ReduceOp.SUM)
+
+    # count is the same on every rank after the all_reduce, so all ranks raise together
+    if count.item() == 0:
+        raise ValueError("The Fisher was estimated from 0 samples on all ranks, check the dataset and num_examples.")
+    flat_fisher /= count
+    reduced_fisher = {}
+    for (name, shape), values in zip(shapes.items(), flat_fisher.split([s.numel() for s in shapes.values()])):
+        reduced_fisher[name] = values.view(shape).cpu()
+    return reduced_fisher, int(count.item())
+
+def get_distributed_fisher(
+    model,
+    dataset,
+    tokenizer,
+    num_examples,
+    batch_size,
+    rank,
+    world_size,
+    device,
+    vectorize=False
+):
+    shard = get_rank_shard(dataset, num_examples, rank, world_size)
+    if not vectorize:
+        batch_size = 1
+    dataloader = get_tokenized_dataloader(shard, tokenizer, batch_size)
+
+    stored_fisher, num_samples = estimate_fisher(model, dataloader, len(shard), vectorize=vectorize, device=device)
+    return all_reduce_fisher(stored_fisher, num_samples, model, device, world_size)
+
+
+if __name__ == "__main__":
+
+    dataset = "guanaco"
+    pretrained_model = "guanaco-7b-r64-a16-2"
+    model_name = "meta-llama/Llama-2-7b-hf"
+    num_clusters = 2
+    epoch_num = 1
+    max_length = 1024
+
+    select_params = ['lora', 'attn']
+    fisher_examples = 1000
+    vectorize_fisher = False
+    fisher_batch_size = 8
+
+    rank, world_size, device = setup_distributed()
+
+    if dataset == "guanaco":
+        train_dataset = load_dataset("timdettmers/openassistant-guanaco", split="train")
+    elif dataset == "instruct":
+        train_dataset = load_dataset("monology/VMware-open-instruct-higgsfield", split="train")
+        train_dataset = train_dataset.map(preprocess_instruct, batched=True)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "right"
+
+    # Only tokenize the examples this run will use
+    train_dataset = train_dataset.select(range(min(fisher_examples, len(train_dataset))))
+    tokenized_dataset = train_dataset.map(
+        partial(tokenize_function, dataset=dataset, tokenizer=tokenizer, max_length=max_length),
+        batched=True,
+    )
+    tokenized_dataset = tokenized_dataset.map(
+        lambda examples: {'input_ids': examples['input_ids'], 'attention_mask': examples['attention_mask']},
+        batched=True,
+        remove_columns=tokenized_dataset.column_names
+    )
+    tokenized_dataset = tokenized_dataset.map(shift_labels_right, batched=True)
+
+    checkpoint_dict = load_checkpoints(pretrained_model, num_clusters, torch.device("cpu"), target_epoch=f'epoch_{epoch_num}')
+
+    for model_folder, checkpoint_path in checkpoint_dict.items():
+        if rank == 0: print(f'Calculating fisher for {model_folder} on {world_size} processes...')
+
+        # Every rank holds a full replica of the model on its own device
+        model = load_peft_model(model_name, checkpoint_path, device_map={"": device})
+        select_fisher_params(model, select_params)
+        model.eval()
+
+        fisher, num_samples = get_distributed_fisher(
+            model,
+            tokenized_dataset,
+            tokenizer,
+            fisher_examples,
+            fisher_batch_size,
+            rank,
+            world_size,
+            device,
+            vectorize=vectorize_fisher
+        )
+
+        if rank == 0:
+            fisher_path = os.path.join('fishers/', f"{model_folder}_fisher_ep{epoch_num}.pt")
+            torch.save(fisher, fisher_path)
+            print(f'Saved fisher over {num_samples} examples for {model_folder} at {fisher_path}')
+
+        del model
+        if is_distributedSetup(world_size):
+            dist.barrier()
+
+    cleanup_distributed()
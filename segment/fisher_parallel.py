@@ -1,5 +1,6 @@
 import os
 import re
+import time
 from scipy.sparse.linalg import LinearOperator, cg as conjugate_gradient # for conjugate gradient methods
 
 from safetensors import safe_open # for checkpoint loading
@@ -20,6 +21,7 @@ from transformers import (
 from peft import LoraConfig, PeftModel
 
 import torch
+from torch.func import functional_call, vmap, grad # for vectorized per-example gradients
 from torch.utils import data
 from torch.utils.data import DataLoader
 from transformers import DataCollatorWithPadding
@@ -30,6 +32,9 @@ from itertools import islice
 import numpy as np
 from functools import partial
 from push_adapter import save_model
+from fisher_accumulator import FisherAccumulator
+from merge_engine import FlatLayout, fisher_merge_flat, unpack_merged, is_selected
+from adapter_registry import load_adapter_tensors, get_peft_key
 
 # FISHER MERGING METHODS
     
@@ -45,71 +50,156 @@ def compute_diag_fisher(model, param_regex):
     return example_fisher
     
 
-def get_model_fisher(pretrained_model, checkpoint_path, dataset, tokenizer, fisher_path, verbose=False):
+def compute_batched_diag_fisher(model, batch, param_names):
+    """
+    Sum of the squared per-example gradients of the log likelihood over a micro-batch,
+    computed in one vectorized pass with vmap(grad(...)) over the parameters in param_names.
+    Each example is scored on its own (batch of one), so the result matches the per-example loop.
+    """
+    params = {name: param.detach() for name, param in model.named_parameters() if name in param_names}
+
+    def example_log_prob(params, example):
+        example = {k: v.unsqueeze(0) for k, v in example.items()}
+        outputs = functional_call(model, params, args=(), kwargs=example)
+        # Fisher is the gradient of the log likelihood (which is the negative loss of the log prob)
+        return -outputs.loss
+
+    per_example_grads = vmap(grad(example_log_prob), in_dims=(None, 0), randomness="different")(params, batch)
+    return {name: torch.sum(torch.square(grads), dim=0) for name, grads in per_example_grads.items()}
+
+
+def estimate_fisher(
+    model, 
+    dataloader, 
+    num_examples, 
+    param_regex=".*", 
+    vectorize=False, 
+    device="cuda", 
+    accumulator=None
+):
+    """
+    Empirical diagonal Fisher of a model over the first num_examples examples of a dataloader,
+    for every parameter that requires grad (see select_fisher_params).
+    With vectorize=True, the Fisher of every micro-batch is computed with vmap,
+    otherwise the original one-example-at-a-time loop is used (which needs batch_size=1).
+    With a FisherAccumulator, the Fisher is accumulated on disk and resumes after the samples
+    it has already seen.
+    """
+    stored_fisher = {}
+
+    def update_fisher(example_fisher):
+        if accumulator is not None:
+            accumulator.add(example_fisher)
+            return
+        for param_name, value in example_fisher.items():
+            if param_name not in stored_fisher:
+                stored_fisher[param_name] = value
+            else:
+                stored_fisher[param_name] += value
+
+    param_names = {
+        name for name, param in model.named_parameters()
+        if re.fullmatch(param_regex, name) and param.requires_grad
+    }
+
+    num_samples = 0 if accumulator is None else accumulator.num_samples
+    start_batch = num_samples // dataloader.batch_size
+    num_batches = -(-num_examples // dataloader.batch_size)
+    for batch in tqdm(islice(dataloader, start_batch, num_batches), initial=start_batch, total=num_batches):
+        batch = {k: v[:num_examples - num_samples].to(device) for k, v in batch.items()}
+
+        if vectorize:
+            with torch.no_grad():
+                update_fisher(compute_batched_diag_fisher(model, batch, param_names))
+        else:
+            outputs = model(**batch)
+            loss = outputs.loss
+
+            # Fisher is the gradient of the log likelihood (which is the negative loss of the log prob)
+            log_prob = -loss
+            log_prob.backward()
+
+            # Compute the per-example fisher and update total fisher
+            with torch.no_grad():
+                example_fisher = compute_diag_fisher(model, param_regex)
+                update_fisher(example_fisher)
+            model.zero_grad()
+
+        num_samples += batch["input_ids"].shape[0]
+        if accumulator is not None:
+            accumulator.step(batch["input_ids"].shape[0])
+
+    if accumulator is not None:
+        stored_fisher = accumulator.tensors()
+    return stored_fisher, num_samples
+
+
+def select_fisher_params(model, select):
+    """
+    Only the selected parameters require grad, so backward produces no gradients (and the Fisher
+    stores no entries) for the rest of the model. Same selector as the merging functions:
+    a list of substrings that must all appear in the parameter name, [] or () for all parameters (None selects none).
+    """
+    selected_count = 0
+    for name, param in model.named_parameters():
+        param.requires_grad = is_selected(name, select)
+        selected_count += param.requires_grad
+    if selected_count == 0:
+        raise ValueError(f"No parameters match the selector {select}")
+    return selected_count
+
+def get_model_fisher(
+    pretrained_model, 
+    checkpoint_path, 
+    dataset, 
+    tokenizer, 
+    fisher_path, 
+    select_params=(), 
+    num_examples=1000, 
+    batch_size=1, 
+    vectorize=False, 
+    flush_every=100, 
+    verbose=False
+):
 
     model = load_peft_model(pretrained_model, checkpoint_path)
         
-    for param in model.parameters():
-        param.requires_grad = True
+    selected_count = select_fisher_params(model, select_params)
     
-    req_grad_count = 0
     lora_count = 0
     for name, param in model.named_parameters():
-        if not param.requires_grad:
-            if verbose: print(f"Parameter {name} does not require grad.")
-            req_grad_count += 1
+        if verbose and param.requires_grad: print(f"Parameter {name} is selected for the Fisher.")
         if 'lora' in name:
             if verbose: print(f"Parameter {name} is a LoRA parameter.")
             lora_count += 1
             
-    if req_grad_count == 0:
-        if verbose: print("All parameters require grad.")        
+    if verbose: print(f"Computing the Fisher for {selected_count} parameters matching {select_params}.")
     if lora_count == 0:
         if verbose: print("All LoRA parameters have been merged.")
         
     model.eval()
-    stored_fisher = {}
-    
-    def update_fisher(example_fisher):
-        for param_name, value in example_fisher.items():
-            if param_name not in stored_fisher:
-                stored_fisher[param_name] = value
-            else:
-                stored_fisher[param_name] += value
-    rank = 0
-    batch_size = 1 
     
+    # The per-example loop scores one example per forward pass
+    if not vectorize:
+        batch_size = 1
     dataloader = get_tokenized_dataloader(dataset, tokenizer, batch_size)
     
-    num_samples = 0
-    param_regex = ".*"
+    # Accumulate into a memory-mapped buffer next to the Fisher file, flushed every flush_every samples
+    shapes = {name: param.shape for name, param in model.named_parameters() if param.requires_grad}
+    accumulator = FisherAccumulator(fisher_path, shapes, flush_every=flush_every)
     
     print(f'Calculating losses for {checkpoint_path}...')
-    for batch in tqdm(islice(dataloader, 1000), total=1000):
-        batch = {k: v.to("cuda") for k, v in batch.items()}
-        
-        outputs = model(**batch)
-        loss = outputs.loss
-        
-        # Fisher is the gradient of the log likelihood (which is the negative loss of the log prob)
-        log_prob = -loss
-        log_prob.backward()
-
-        # Compute the per-example fisher and update total fisher
-        with torch.no_grad():
-            example_fisher = compute_diag_fisher(model, param_regex)
-            update_fisher(example_fisher)
-
-        num_samples += 1
-        model.zero_grad()
+    stored_fisher, num_samples = estimate_fisher(
+        model, dataloader, num_examples, vectorize=vectorize, accumulator=accumulator
+    )
             
-    with torch.no_grad():
-        stored_fisher = normalize_metadata(stored_fisher, num_samples)
+    accumulator.normalize()
         
-    for param_name, param in model.named_parameters():
+    for param_name in stored_fisher.keys():
         print(f"mean value of {param_name}: {torch.mean(stored_fisher[param_name])}")
         
-    torch.save(detach_metadata(stored_fisher), fisher_path)
+    accumulator.save(fisher_path)
+    accumulator.remove()
     
 
 def conjugate_gradient_forward(
@@ -152,20 +242,182 @@ def conjugate_gradient_forward(
     return final_model
     
 
+
+def conjugate_gradient_batched(
+    sum_fisher_matrices, 
+    sum_fisher_times_weight, 
+    init_model,
+    all_param_names,
+    num_iters=100,
+    tol=1e-5,
+    check_every=10,
+    closed_form=False,
+    device=None
+):
+    """
+    Solve diag(F) x = F * w for every parameter at once, in torch on any device.
+    All parameters are flattened into one vector and each keeps its own CG system: the per-parameter
+    dot products are segment sums (index_add_), so the iterates match running CG per parameter.
+    Convergence (||Ax - b|| <= tol * ||b||, as in SciPy) is only checked every check_every iterations
+    to avoid host round-trips. Since the Fisher is diagonal, closed_form=True returns x = b / F directly.
+    Returns the solved parameters and the relative residual of each parameter.
+    """
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    param_names = list(all_param_names)
+    shapes = [sum_fisher_times_weight[name].shape for name in param_names]
+    numels = [shape.numel() for shape in shapes]
+
+    A = torch.cat([sum_fisher_matrices[name].detach().flatten() for name in param_names]).to(device, torch.float32)
+    b = torch.cat([sum_fisher_times_weight[name].detach().flatten() for name in param_names]).to(device, torch.float32)
+    segment_ids = torch.repeat_interleave(
+        torch.arange(len(param_names), device=device), torch.tensor(numels, device=device)
+    )
+
+    def segment_sum(values):
+        return torch.zeros(len(param_names), device=device).index_add_(0, segment_ids, values)
+
+    if init_model is not None:
+        x = torch.cat([init_model[name].detach().flatten() for name in param_names]).to(device, torch.float32)
+    else:
+        x = torch.zeros_like(b)
+
+    if closed_form:
+        x = torch.where(A > 0, b / A, x)
+    else:
+        r = b - A * x
+        p = r.clone()
+        rs = segment_sum(r * r)
+        b_norm = torch.sqrt(segment_sum(b * b))
+        active = torch.ones(len(param_names), dtype=torch.bool, device=device)
+
+        for iteration in range(num_iters):
+            Ap = A * p
+            pAp = segment_sum(p * Ap)
+            alpha = torch.where(active & (pAp > 0), rs / pAp, torch.zeros_like(rs))
+            x += alpha[segment_ids] * p
+            r -= alpha[segment_ids] * Ap
+
+            rs_new = segment_sum(r * r)
+            beta = torch.where(active & (rs > 0), rs_new / rs, torch.zeros_like(rs))
+            p = r + beta[segment_ids] * p
+            rs = rs_new
+
+            if (iteration + 1) % check_every == 0:
+                active &= torch.sqrt(rs) > tol * b_norm
+                if not active.any():
+                    break
+
+    residuals = torch.sqrt(segment_sum((A * x - b) ** 2)) / torch.sqrt(segment_sum(b * b)).clamp(min=1e-12)
+    final_model = {}
+    for name, shape, values in zip(param_names, shapes, x.split(numels)):
+        final_model[name] = values.view(shape).cpu()
+    residuals = dict(zip(param_names, residuals.cpu().tolist()))
+    return final_model, residuals
+
+def print_residuals(residuals, top_k=10):
+    worst = sorted(residuals.items(), key=lambda item: item[1], reverse=True)[:top_k]
+    print(f"Max relative residual over {len(residuals)} parameters: {worst[0][1]:.3e}")
+    for param_name, residual in worst:
+        print(f"    {param_name}: {residual:.3e}")
+
     
 # DATASET AND CHECKPOINT LOADING
 
-def load_peft_model(base_model, adapter_model):
+def load_peft_model(base_model, adapter_model, device_map="auto"):
     base_model = AutoModelForCausalLM.from_pretrained(
         base_model,
         low_cpu_mem_usage=True,
         return_dict=True,
         torch_dtype=torch.float16,
-        device_map="auto", # Parallelize across GPUs
+        device_map=device_map, # "auto" parallelizes across GPUs
     )
     model = PeftModel.from_pretrained(base_model, adapter_model)
     return model
 
+def load_adapter_checkpoint(checkpoint_path, adapter_name="default"):
+    """
+    Adapter tensors of a checkpoint, keyed by their parameter names inside a PeftModel (the Fisher keys),
+    read straight from the adapter safetensors without loading the base model.
+    """
+    adapter = load_adapter_tensors(checkpoint_path)
+    return {get_peft_key(key, adapter_name): value for key, value in adapter.items()}
+
+def load_fisher(fisher):
+    """ A Fisher dict, loaded from disk if given as a path. """
+    if isinstance(fisher, str):
+        return torch.load(fisher, torch.device("cpu"))
+    return fisher
+
+def fisher_merge_adapters(checkpoint_paths, fishers, model_lambdas, select=()):
+    """
+    N-way Fisher merge of the adapters in checkpoint_paths, weighted by model_lambdas, returning a state
+    dict with the adapter keys only. Base weights are identical in every cluster (so merging them is a
+    no-op) and are only loaded on export, where save_model loads this state dict on top of the base model.
+    Adapters and Fishers (dicts or paths) are streamed one at a time, so memory only holds the running
+    weighted sum and Fisher sum, however many clusters are merged.
+    """
+    first_adapter = load_adapter_checkpoint(checkpoint_paths[0])
+    first_fisher = load_fisher(fishers[0])
+    layout = FlatLayout(
+        {name: value for name, value in first_adapter.items() if name in first_fisher},
+        select=select
+    )
+    print(f"Merging {len(layout.names)} selected adapter parameters ({layout.numel / 1e6:.1f}M values)")
+
+    def load_adapters():
+        # One adapter at a time, only the first and current ones are held in memory
+        yield first_adapter
+        for checkpoint_path in checkpoint_paths[1:]:
+            yield load_adapter_checkpoint(checkpoint_path)
+
+    def load_fishers():
+        yield first_fisher
+        for fisher in fishers[1:]:
+            yield load_fisher(fisher)
+
+    merged_flat = fisher_merge_flat(layout, load_adapters(), load_fishers(), model_lambdas)
+    return unpack_merged(layout, merged_flat, first_adapter)
+
+def get_cluster_sizes(cluster_data_dir, num_clusters):
+    """
+    Number of examples in each cluster, parsed from the dataset files written by generate_datasets.py
+    ({dataset}_{strategy}_{num_clusters}_cluster_{label}_{length} with a .json or .parquet extension, or
+    no extension for an arrow directory, depending on split_format).
+    """
+    cluster_sizes = [None] * num_clusters
+    for file_name in os.listdir(cluster_data_dir):
+        match = re.search(rf"_{num_clusters}_cluster_(\d+)_(\d+)(\.json|\.parquet)?$", file_name)
+        if match and int(match.group(1)) < num_clusters:
+            cluster_sizes[int(match.group(1))] = int(match.group(2))
+    if None in cluster_sizes:
+        raise FileNotFoundError(f"Missing cluster dataset files in {cluster_data_dir}: found sizes {cluster_sizes}")
+    return cluster_sizes
+
+def get_merge_weights(merge_weights, num_models, model_lambda=None, cluster_sizes=None):
+    """
+    Per-model merge weights, normalized to sum to one:
+    a list of weights, "uniform", "cluster_size" (proportional to cluster_sizes) or
+    "lambda" (model_lambda and 1 - model_lambda for two models, uniform otherwise).
+    """
+    if isinstance(merge_weights, (list, tuple)):
+        weights = list(merge_weights)
+    elif merge_weights == "uniform":
+        weights = [1.0] * num_models
+    elif merge_weights == "cluster_size":
+        if cluster_sizes is None:
+            raise ValueError("Cluster sizes are required to weight the merge by cluster size")
+        weights = list(cluster_sizes)
+    elif merge_weights == "lambda":
+        weights = [model_lambda, 1 - model_lambda] if num_models == 2 else [1.0] * num_models
+    else:
+        raise ValueError(f"Unknown merge weights {merge_weights}, valid options are a list, 'uniform', 'cluster_size' or 'lambda'")
+
+    if len(weights) != num_models:
+        raise ValueError(f"Got {len(weights)} merge weights for {num_models} models")
+    total = float(sum(weights))
+    return [weight / total for weight in weights]
+
 def get_tokenized_dataloader(tokenized_dataset, tokenizer, batch_size):
     data_collator = DataCollatorForLanguageModeling(
         tokenizer=tokenizer,
@@ -391,24 +643,41 @@ if __name__ == "__main__":
     select_params = ['lora', 'attn']
     
     compute_fishers = True
+    fisher_examples = 1000
+    # Vectorize the Fisher over micro-batches with torch.func
+    vectorize_fisher = False
+    fisher_batch_size = 8
+    # Flush the on-disk Fisher every N samples, so a killed job resumes from there
+    fisher_flush_every = 100
     skip_merge = False
     use_conjugate_gradient = False
     debug_mode = True
     
     model_lambda_factor = 3
     model_lambda = 0.1 * model_lambda_factor
+    # Per-cluster merge weights: a list, 'uniform', 'cluster_size' or 'lambda' (model_lambda for 2 clusters)
+    merge_weights = "lambda"
+    # Folder of the cluster datasets from generate_datasets.py, for merge_weights = 'cluster_size'
+    cluster_data_dir = None
     epoch_num = 1
     
     initialization = "average"
     num_iters = 100
+    # 'torch' (batched CG), 'closed_form' (x = b / F) or 'scipy' (original per-parameter CG)
+    cg_solver = "torch"
+    cg_tol = 1e-5
     
     # Construct the merged filename dynamically
     selected_params_part = '-' + '-'.join(select_params) if len(select_params) > 0 else '-all'
+    if merge_weights == "lambda":
+        merge_weights_part = f"-ml{int(model_lambda_factor)}"
+    else:
+        merge_weights_part = f"-w{merge_weights}" if isinstance(merge_weights, str) else "-wcustom"
     merged_descriptor = (
         f"{pretrained_model}"
         f"{selected_params_part}"
         f"-fisher-ep{epoch_num}"
-        f"-ml{int(model_lambda_factor)}" 
+        f"{merge_weights_part}" 
     )
     merged_path = os.path.join('merged_models/', merged_descriptor + ".pt")
     
@@ -419,6 +688,7 @@ if __name__ == "__main__":
         Dataset: {dataset}
         Epoch: {epoch_num}
         Model Lambda: {model_lambda:.2f}
+        Merge Weights: {merge_weights}
         Target Parameters: {select_params}
         Conjugate Gradient: {use_conjugate_gradient}
         Skip Merge: {skip_merge}
@@ -480,6 +750,7 @@ if __name__ == "__main__":
     
     # Load checkpoints
     checkpoint_dict = load_checkpoints(pretrained_model, num_clusters, torch.device("cpu"), target_epoch=f'epoch_{epoch_num}')
+    cluster_sizes = get_cluster_sizes(cluster_data_dir, num_clusters) if merge_weights == "cluster_size" else None
     
     if compute_fishers:
         for model_folder in checkpoint_dict.keys():
@@ -488,7 +759,18 @@ if __name__ == "__main__":
             fisher_path = os.path.join('fishers/', fisher_name)
             # model = load_file(checkpoint_dict[model_folder])
             checkpoint_path = checkpoint_dict[model_folder]
-            get_model_fisher(model_name, checkpoint_path, tokenized_dataset, tokenizer, fisher_path)
+            get_model_fisher(
+                model_name, 
+                checkpoint_path, 
+                tokenized_dataset, 
+                tokenizer, 
+                fisher_path, 
+                select_params=select_params, 
+                num_examples=fisher_examples, 
+                batch_size=fisher_batch_size, 
+                vectorize=vectorize_fisher, 
+                flush_every=fisher_flush_every
+            )
             print(f'Saved fisher for {model_folder} at {fisher_path}')
         
         
@@ -498,13 +780,12 @@ if __name__ == "__main__":
     if not use_conjugate_gradient:
         # Load fishers    
         if not skip_merge:
-            loaded_fishers = {}
+            # Fishers are only loaded one at a time while merging
+            fisher_paths = {}
             for model_folder in checkpoint_dict.keys():
                 fisher_name = f"{model_folder}_fisher_ep{epoch_num}.pt"
-                fisher_path = os.path.join('fishers/', fisher_name)
-                fisher = torch.load(fisher_path, torch.device("cpu"))
-                loaded_fishers[model_folder] = fisher
-            if debug_mode: print(f"keys for loaded_fishers: {loaded_fishers.keys()}")
+                fisher_paths[model_folder] = os.path.join('fishers/', fisher_name)
+            if debug_mode: print(f"keys for fisher_paths: {fisher_paths.keys()}")
 
             # The original implementation merges checkpoints by dataset
             # For adapters, merge checkpoints by cluster
@@ -515,58 +796,24 @@ if __name__ == "__main__":
                 print(f"Adding checkpoint path for {model_folder} and {cluster}: {checkpoint_path}")
                 checkpoint_fisher_matrices[cluster] = {"checkpoint": checkpoint_path}
 
-            for model_folder, loaded_fisher in loaded_fishers.items():
+            for model_folder, fisher_path in fisher_paths.items():
                 cluster = get_cluster(model_folder)
                 if cluster not in checkpoint_fisher_matrices:
                     raise ValueError(f"Cluster key {cluster} not found in checkpoint_fisher_matrices")
-                checkpoint_fisher_matrices[cluster].update({"fisher": loaded_fisher})
-
-            weighted_checkpoint_list = []
-            fisher_list = []
-
-            for cluster, checkpoint_fisher_matrix in checkpoint_fisher_matrices.items():
-                if debug_mode: print(f"cluster name: {cluster}")
-                if debug_mode: print(f"matrix keys: {checkpoint_fisher_matrix.keys()}")      
-                checkpoint_path = checkpoint_fisher_matrix["checkpoint"]
-
-                print(f"loading peft model {model_name} with adapter {checkpoint_path}")
-                checkpoint_model = load_peft_model(model_name, checkpoint_path)
-                checkpoint = checkpoint_model.state_dict()
-                checkpoint = {key: value.to('cpu') for key, value in checkpoint.items()}
-
-                print(f'Loaded checkpoint for {cluster}')
-                if debug_mode: debug_params(checkpoint_path, checkpoint)
-
-                fisher = checkpoint_fisher_matrix["fisher"]
-                fisher = set_minimum(fisher, 1e-8)
-
-                print(f'Loaded fisher for {cluster}')
-                if debug_mode: debug_params("fisher", fisher)
-
-                # Scale fishers
-                if len(checkpoint_dict) == 2:
-                    if len(fisher_list) == 0:
-                        fisher = scale(fisher, model_lambda, select=select_params)
-                        if debug_mode: debug_params("scaled fisher", fisher)
-                    else:
-                        assert len(fisher_list) == 1
-                        fisher = scale(fisher, (1 - model_lambda), select=select_params)
-                        if debug_mode: debug_params("scaled fisher", fisher)
-
-                weighted_cp = pairwise_param_map(
-                    checkpoint, fisher, lambda x, y: x * y, select=select_params
-                )
-                if debug_mode: debug_params("weighted_cp", weighted_cp)
-
-                weighted_checkpoint_list.append(weighted_cp)
-                fisher_list.append(fisher)
-
-            weighted_cp_sum = scale_and_sum(weighted_checkpoint_list, 1, select=select_params)
-            if debug_mode: debug_params("weighted_cp_sum", weighted_cp_sum)
-            fisher_sum = scale_and_sum(fisher_list, 1, select=select_params)
-            if debug_mode: debug_params("fisher_sum", fisher_sum)
-
-            merged_model = divide(weighted_cp_sum, fisher_sum, select=select_params)
+                checkpoint_fisher_matrices[cluster].update({"fisher": fisher_path})
+
+            cluster_names = list(checkpoint_fisher_matrices.keys())
+            model_lambdas = get_merge_weights(merge_weights, len(cluster_names), model_lambda, cluster_sizes)
+            print(f"Merge weights: {dict(zip(cluster_names, np.round(model_lambdas, 4).tolist()))}")
+
+            merge_start = time.perf_counter()
+            merged_model = fisher_merge_adapters(
+                [checkpoint_fisher_matrices[cluster]["checkpoint"] for cluster in cluster_names],
+                [checkpoint_fisher_matrices[cluster]["fisher"] for cluster in cluster_names],
+                model_lambdas,
+                select=select_params,
+            )
+            print(f"Merged {len(cluster_names)} cluster adapters in {time.perf_counter() - merge_start:.2f}s")
             if debug_mode: debug_params("merged_model", merged_model)
             
             torch.save(merged_model, merged_path)
@@ -585,13 +832,12 @@ if __name__ == "__main__":
     if use_conjugate_gradient:    
         # Load fishers
         if not skip_merge:
-            loaded_fishers = {}
+            # Fishers are only loaded one at a time while merging
+            fisher_paths = {}
             for model_folder in checkpoint_dict.keys():
                 fisher_name = f"{model_folder}_fisher_ep{epoch_num}.pt"
-                fisher_path = os.path.join('fishers/', fisher_name)
-                fisher = torch.load(fisher_path, torch.device("cpu"))
-                loaded_fishers[model_folder] = fisher
-            if debug_mode: print(f"keys for loaded_fishers: {loaded_fishers.keys()}")
+                fisher_paths[model_folder] = os.path.join('fishers/', fisher_name)
+            if debug_mode: print(f"keys for fisher_paths: {fisher_paths.keys()}")
 
             checkpoint_gram_matrices = {}
             all_param_names = None
@@ -601,55 +847,59 @@ if __name__ == "__main__":
                 print(f"Adding checkpoint path for {model_folder} and {cluster}: {checkpoint_path}")
                 checkpoint_gram_matrices[cluster] = {"checkpoint": checkpoint_path}
 
-            for model_folder, loaded_fisher in loaded_fishers.items():
+            for model_folder, fisher_path in fisher_paths.items():
                 cluster = get_cluster(model_folder)
                 if cluster not in checkpoint_gram_matrices:
                     raise ValueError(f"Cluster key {cluster} not found in checkpoint_fisher_matrices")
-                checkpoint_gram_matrices[cluster].update({"diagonal_fisher": loaded_fisher})
-                all_param_names = loaded_fisher.keys()
+                checkpoint_gram_matrices[cluster].update({"diagonal_fisher": fisher_path})
+
+            # The conjugate gradient merge is unweighted unless explicit merge weights are given
+            cg_merge_weights = "uniform" if merge_weights == "lambda" else merge_weights
+            model_lambdas = get_merge_weights(cg_merge_weights, len(checkpoint_gram_matrices), model_lambda, cluster_sizes)
+            print(f"Merge weights: {dict(zip(checkpoint_gram_matrices.keys(), np.round(model_lambdas, 4).tolist()))}")
 
-            datasets_fishers = []
-            datasets_weights = []
-            datasets_fisher_times_weight = []
             datasets_nonmerged_weights = []
+            layout = None
+            merge_start = time.perf_counter()
 
-            for cluster, checkpoint_gram_matrix in checkpoint_gram_matrices.items():
+            for (cluster, checkpoint_gram_matrix), cluster_lambda in zip(checkpoint_gram_matrices.items(), model_lambdas):
                 if debug_mode: print(f"cluster name: {cluster}")
                 if debug_mode: print(f"matrix keys: {checkpoint_gram_matrix.keys()}")
                 checkpoint_path = checkpoint_gram_matrix["checkpoint"]
 
-                print(f"loading peft model {model_name} with adapter {checkpoint_path}")
-                checkpoint_model = load_peft_model(model_name, checkpoint_path)
-                checkpoint = checkpoint_model.state_dict()
-                checkpoint = {key: value.to('cpu') for key, value in checkpoint.items()}
+                # Base weights are the same in every cluster, only the adapter tensors are read
+                checkpoint = load_adapter_checkpoint(checkpoint_path)
 
-                print(f'Loaded checkpoint for {cluster}')
+                print(f'Loaded adapter for {cluster}')
                 if debug_mode: debug_params(checkpoint_path, checkpoint)
 
-                fisher_matrices = {}
-                weights = {}
-
-                for module_name, diag_fisher in checkpoint_gram_matrix["diagonal_fisher"].items():
-                    param_name = module_name
-                    weights[param_name] = checkpoint[param_name]
-                    fisher_matrices[param_name] = diag_fisher
-
-                datasets_fishers.append(fisher_matrices)
-                datasets_weights.append(weights)
-
-                fisher_times_weight = element_wise_multiply(fisher_matrices, weights, select_params)
-                datasets_fisher_times_weight.append(fisher_times_weight)
+                diagonal_fisher = load_fisher(checkpoint_gram_matrix["diagonal_fisher"])
+                if layout is None:
+                    # Accumulate the sums over all models in flat buffers with one shared layout
+                    layout = FlatLayout(
+                        {name: value for name, value in checkpoint.items() if name in diagonal_fisher},
+                        select=select_params
+                    )
+                    all_param_names = layout.names
+                    fisher_buffer, weight_buffer = layout.empty(), layout.empty()
+                    average_flat, fisher_sum_flat, fisher_times_weight_flat = layout.zeros(), layout.zeros(), layout.zeros()
+
+                layout.pack(diagonal_fisher, out=fisher_buffer).mul_(cluster_lambda)
+                layout.pack(checkpoint, out=weight_buffer)
+                average_flat.add_(weight_buffer, alpha=cluster_lambda)
+                fisher_sum_flat.add_(fisher_buffer)
+                fisher_times_weight_flat.addcmul_(fisher_buffer, weight_buffer)
 
                 nonmerged_weights = {}
                 for param_name, param in checkpoint.items():
-                    if param_name not in fisher_matrices:
+                    if param_name not in layout.names:
                         nonmerged_weights[param_name] = param
                 datasets_nonmerged_weights.append(nonmerged_weights)
+                del checkpoint, diagonal_fisher
 
-            average_weights = scale_and_sum(datasets_weights, 1 / len(datasets_weights), select_params)
-
-            sum_fisher_matrices = scale_and_sum(datasets_fishers, 1, select_params)
-            sum_fisher_times_weight = scale_and_sum(datasets_fisher_times_weight, 1, select_params)
+            average_weights = layout.unpack(average_flat)
+            sum_fisher_matrices = layout.unpack(fisher_sum_flat)
+            sum_fisher_times_weight = layout.unpack(fisher_times_weight_flat)
 
             if initialization == "average":
                 init_model = average_weights
@@ -665,18 +915,31 @@ if __name__ == "__main__":
                     init_model = None
 
 
-            final_model = conjugate_gradient_forward(
-                sum_fisher_matrices,
-                sum_fisher_times_weight,
-                init_model,
-                all_param_names,
-                num_iters
-            )
+            if cg_solver == "scipy":
+                final_model = conjugate_gradient_forward(
+                    sum_fisher_matrices,
+                    sum_fisher_times_weight,
+                    init_model,
+                    all_param_names,
+                    num_iters
+                )
+            else:
+                final_model, residuals = conjugate_gradient_batched(
+                    sum_fisher_matrices,
+                    sum_fisher_times_weight,
+                    init_model,
+                    all_param_names,
+                    num_iters=num_iters,
+                    tol=cg_tol,
+                    closed_form=(cg_solver == "closed_form")
+                )
+                print_residuals(residuals)
 
             final_nonmerged_model = scale_and_sum(datasets_nonmerged_weights, 1 / len(datasets_nonmerged_weights), select_params)
 
             for param_name, param in final_nonmerged_model.items():
                 final_model[param_name] = param
+            print(f"Merged {len(checkpoint_gram_matrices)} cluster adapters in {time.perf_counter() - merge_start:.2f}s")
                 
             merged_path = os.path.join('merged_models/', merged_descriptor + '-cg' + ".pt")
                 
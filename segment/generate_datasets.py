@@ -21,12 +21,15 @@ from trl import SFTTrainer
 import os
 from datasets import load_dataset, Dataset
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.cluster import KMeans
-import pandas as pd
 import numpy as np
 from itertools import islice
 from tqdm.auto import tqdm
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from streaming_kmeans import cluster_ids
+from cluster_splits import split_by_cluster, write_split
+
 def preprocess_instruct(examples):
     # Concatenate 'prompt' and 'completion' fields
     texts = [prompt + " " + completion for prompt, completion in zip(examples['prompt'], examples['completion'])]
@@ -40,7 +43,10 @@ save_dir = "/scratch/alif/qlora/data"
 num_clusters = 4  # Adjust the number of clusters as needed
 n_components = 16
 cluster_strategy = "gradients"
+clustering_backend = "full" # exact in-memory KMeans, or "minibatch" for approximate streaming k-means over memmapped features
 resume_from_cluster = 0
+split_format = "json" # "json" (JSON lines, as before), "parquet" or "arrow" (save_to_disk)
+split_workers = 8
 
 if cluster == "cedar":
     if dataset == "guanaco":
@@ -68,87 +74,58 @@ if cluster == "narval":
 def cluster_gradients(dataset, num_clusters, n_components):
 
     gradient_path = f"reduced_gradients_stack_pca{n_components}.npy"
-    gradient_features = np.load(gradient_path)
+    gradient_features = np.load(gradient_path, mmap_mode="r")
     
-    # Cluster the gradient features
-    kmeans = KMeans(n_clusters=num_clusters, random_state=0)
-    kmeans.fit(gradient_features)
-    cluster_labels = kmeans.labels_
-
-    # Create the clustered dataset
-    clustered_data = pd.DataFrame({'text': dataset['text'], 'cluster': cluster_labels})
-    return clustered_data
+    # Cluster the gradient features, one cluster id per example
+    return cluster_ids(gradient_features, num_clusters, backend=clustering_backend)
 
 def cluster_embeddings(dataset, num_clusters, embeddings):    
-    # Extract text data
-    texts = [entry['text'] for entry in dataset]
-    prompts = [entry['prompt'] for entry in dataset]
-    completions = [entry['completion'] for entry in dataset]
-
-    # Clustering
-    kmeans = KMeans(n_clusters=num_clusters, random_state=0)
-    kmeans.fit(embeddings)
-
-    # Assigning cluster labels to each text
-    cluster_labels = kmeans.labels_
-
-    # Creating a DataFrame for easier visualization
-    clustered_data = pd.DataFrame({'text': texts, 'prompt': prompts, 'completion': completions, 'cluster': cluster_labels})
-
-    return clustered_data
+    # Clustering, embeddings can be memory-mapped
+    return cluster_ids(embeddings, num_clusters, backend=clustering_backend)
 
 def cluster_tfid(dataset, num_clusters):    
     # Extract text data (adjust the key 'text' if your dataset has a different text field)
-    texts = [entry['text'] for entry in dataset]
+    texts = dataset['text']
 
     # Data Preparation and Feature Extraction
     vectorizer = TfidfVectorizer(stop_words='english')
-    X = vectorizer.fit_transform(texts)
+    X = vectorizer.fit_transform(texts).tocsr()
 
-    # Clustering
-    kmeans = KMeans(n_clusters=num_clusters, random_state=0)
-    kmeans.fit(X)
-
-    # Assigning cluster labels to each text
-    cluster_labels = kmeans.labels_
-
-    # Creating a DataFrame for easier visualization
-    clustered_data = pd.DataFrame({'text': texts, 'cluster': cluster_labels})
-
-    return clustered_data
+    # Clustering, with the minibatch backend only chunks of the sparse matrix are densified at a time
+    return cluster_ids(X, num_clusters, backend=clustering_backend)
 
+text_columns = ['text']
 if cluster_strategy == "embeddings":
-    embeddings = np.load(f'embeddings/{dataset}_embeddings.npy')
-    clustered_data = cluster_embeddings(train_dataset, num_clusters, embeddings)
+    embeddings = np.load(f'embeddings/{dataset}_embeddings.npy', mmap_mode="r")
+    cluster_labels = cluster_embeddings(train_dataset, num_clusters, embeddings)
+    text_columns = [column for column in ['text', 'prompt', 'completion'] if column in train_dataset.column_names]
     print(f'Created {num_clusters} clusters from precomputed embeddings file: {dataset}_embeddings.npy')
 elif cluster_strategy == "tfid":
-    clustered_data = cluster_tfid(train_dataset, num_clusters)
+    cluster_labels = cluster_tfid(train_dataset, num_clusters)
 elif cluster_strategy == "gradients":
     cluster_strategy = f"{cluster_strategy}_pca{n_components}"
-    clustered_data = cluster_gradients(train_dataset, num_clusters, n_components)
-    # save_path = f"gradient_clusters_{num_clusters}_pca{n_components}.csv" 
-    # clustered_data.to_csv(save_path)
-    # print(f"Clustered data using model gradients and saved dataframe to {save_path}")
-
-unique_clusters = clustered_data['cluster'].unique()
-cluster_datasets = {}
-
-# Loop through each cluster and create datasets
-for cluster_label in unique_clusters:
-    cluster_df = clustered_data[clustered_data['cluster'] == cluster_label]
-    cluster_datasets[f"cluster_{cluster_label}"] = Dataset.from_pandas(cluster_df)
+    cluster_labels = cluster_gradients(train_dataset, num_clusters, n_components)
+
+# Save the cluster id of every example, so splits and later runs do not need to recluster
+labels_path = f"{save_dir}/{dataset}_{cluster_strategy}_{num_clusters}_labels.npy"
+np.save(labels_path, cluster_labels)
+print(f"Saved cluster ids to {labels_path}")
+
+cluster_datasets = split_by_cluster(train_dataset, cluster_labels, text_columns)
     
 # Sort the cluster numerically
 cluster_datasets = dict(sorted(cluster_datasets.items()))  
 
-count = 1
 total = len(cluster_datasets.items())
-
-for cluster_label, cluster_dataset in islice(cluster_datasets.items(), resume_from_cluster, total, 1):   
-    
-    print(f'({count}/{total}) Saving {cluster_label} for {dataset} dataset...')
-    print(cluster_dataset[0])
-    dataset_length = len(cluster_dataset)    
-    dataset_name = f"{save_dir}/{dataset}_{cluster_strategy}_{num_clusters}_{cluster_label}_{dataset_length}.json"
-    cluster_dataset.to_json(dataset_name)
-    count += 1
+split_extension = {"json": ".json", "parquet": ".parquet", "arrow": ""}[split_format]
+
+# Write the splits in parallel, arrow does the heavy lifting outside of the GIL
+with ThreadPoolExecutor(max_workers=max(1, min(split_workers, total - resume_from_cluster))) as executor:
+    futures = []
+    for cluster_label, cluster_dataset in islice(cluster_datasets.items(), resume_from_cluster, total, 1):   
+        dataset_length = len(cluster_dataset)    
+        dataset_name = f"{save_dir}/{dataset}_{cluster_strategy}_{num_clusters}_{cluster_label}_{dataset_length}{split_extension}"
+        futures.append(executor.submit(write_split, cluster_dataset, dataset_name, split_format))
+
+    for count, future in enumerate(as_completed(futures), start=1):
+        print(f'({count}/{len(futures)}) Saved {future.result()} for {dataset} dataset')
@@ -1,4 +1,5 @@
 import os
+import hashlib
 import torch
 import torch.nn.functional as F
 import numpy as np
@@ -18,6 +19,12 @@ def preprocess_instruct(examples):
 dataset = "instruct"
 cluster = "narval"
 
+model_name = "thenlper/gte-base"
+embedding_dtype = torch.float32 # matches the original embeddings, torch.float16 is faster but changes the clusters
+batch_size = 32
+max_length = 512
+cache_dir = "embeddings/cache" # embeddings of texts seen in earlier runs are reused from here
+
 if cluster == "cedar":
     if dataset == "guanaco":
         dataset_name = "timdettmers/openassistant-guanaco"
@@ -50,13 +57,90 @@ def get_embeddings_in_batches(texts, model, tokenizer, batch_size=32):
         all_embeddings.append(normalized_embeddings.detach().cpu().numpy())
     return np.vstack(all_embeddings)
 
+
+class EmbeddingCache:
+    """
+    Append-only embedding store keyed by a hash of the text: vectors.bin holds float32 rows and keys.bin
+    the 16 byte digest of each row. Rows are appended (vectors first, then keys) after every batch, so
+    an interrupted run keeps everything it embedded and a rerun on a changed dataset only embeds the
+    texts it has not seen.
+    """
+
+    def __init__(self, path, dim):
+        os.makedirs(path, exist_ok=True)
+        self.dim = dim
+        self.vectors_path = os.path.join(path, "vectors.bin")
+        self.keys_path = os.path.join(path, "keys.bin")
+
+        keys = np.fromfile(self.keys_path, dtype="S16") if os.path.exists(self.keys_path) else np.empty(0, dtype="S16")
+        num_vectors = os.path.getsize(self.vectors_path) // (4 * dim) if os.path.exists(self.vectors_path) else 0
+        # only rows with both a key and a complete vector count, drop any partial tail
+        self.num_rows = min(len(keys), num_vectors)
+        self.rows = {key: row for row, key in enumerate(keys[:self.num_rows].tolist())}
+        for file_path, size in [(self.vectors_path, self.num_rows * 4 * dim), (self.keys_path, self.num_rows * 16)]:
+            with open(file_path, "ab") as f:
+                f.truncate(size)
+
+    @staticmethod
+    def digest(text):
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def lookup(self, keys):
+        return np.array([self.rows.get(key, -1) for key in keys], dtype=np.int64)
+
+    def append(self, keys, embeddings):
+        with open(self.vectors_path, "ab") as f:
+            f.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+        with open(self.keys_path, "ab") as f:
+            f.write(b"".join(keys))
+        for key in keys:
+            self.rows[key] = self.num_rows
+            self.num_rows += 1
+
+    def vectors(self):
+        return np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self.num_rows, self.dim))
+
+
+def embed_texts(texts, model, tokenizer, cache, batch_size=32, max_length=512, device=torch.device('cuda')):
+    """
+    Embeddings of texts in their original order, computing only the texts missing from the cache.
+
+    Missing texts are tokenized once without padding, sorted by length and batched, so every batch only
+    pads to similar lengths, and run under inference mode. Each batch is appended to the cache as soon
+    as it is done, and the output is gathered from the cache rows in the original order.
+    """
+    keys = [cache.digest(text) for text in tqdm(texts, desc="Hashing texts")]
+    missing = {}
+    for index, (key, row) in enumerate(zip(keys, cache.lookup(keys))):
+        if row < 0 and key not in missing:
+            missing[key] = index
+    print(f"{len(texts) - len(missing)}/{len(texts)} embeddings cached, embedding {len(missing)} texts")
+
+    missing_keys = list(missing.keys())
+    missing_texts = [texts[index] for index in missing.values()]
+    input_ids = tokenizer(missing_texts, max_length=max_length, truncation=True)['input_ids'] if missing_texts else []
+    order = np.argsort([len(ids) for ids in input_ids], kind="stable")
+
+    with torch.inference_mode():
+        for i in tqdm(range(0, len(order), batch_size), desc="Generating Embeddings"):
+            batch_order = order[i:i + batch_size]
+            batch_dict = tokenizer.pad({'input_ids': [input_ids[j] for j in batch_order]}, padding=True, return_tensors='pt').to(device)
+            outputs = model(**batch_dict)
+            embeddings = average_pool(outputs.last_hidden_state.float(), batch_dict['attention_mask'])
+            normalized_embeddings = F.normalize(embeddings, p=2, dim=1)
+            cache.append([missing_keys[j] for j in batch_order], normalized_embeddings.cpu().numpy())
+
+    return cache.vectors()[cache.lookup(keys)]
+
 # Check for CUDA availability
 if not torch.cuda.is_available():
     raise EnvironmentError("CUDA not available or GPUs not detected")
 
 # Initialize tokenizer and model
-tokenizer = AutoTokenizer.from_pretrained("thenlper/gte-base")
-model = AutoModel.from_pretrained("thenlper/gte-base")
+tokenizer = AutoTokenizer.from_pretrained(model_name)
+model = AutoModel.from_pretrained(model_name, torch_dtype=embedding_dtype)
+model.eval()
+embedding_dim = model.config.hidden_size
 
 # Utilizing multiple GPUs
 if torch.cuda.device_count() > 1:
@@ -66,13 +150,12 @@ if torch.cuda.device_count() > 1:
 model.to(torch.device('cuda'))  # Move the model to GPU
 
 # Assuming you have a Hugging Face dataset loaded into train_dataset
-texts = [entry['text'] for entry in train_dataset]  # Extract texts from the dataset
+texts = train_dataset['text']  # Extract texts from the dataset
 
-# Get embeddings and save them
-embeddings = get_embeddings_in_batches(texts, model, tokenizer, batch_size=32)
+# Get embeddings and save them, the cache is specific to the model, max length and dtype
+cache_name = f"{model_name.replace('/', '_')}_ml{max_length}_{str(embedding_dtype).split('.')[-1]}"
+cache = EmbeddingCache(os.path.join(cache_dir, cache_name), embedding_dim)
+embeddings = embed_texts(texts, model, tokenizer, cache, batch_size=batch_size, max_length=max_length)
 fname = dataset + '_embeddings.npy'
 np.save(fname, embeddings)
-
-
-
-
+print(f"Saved {embeddings.shape} embeddings to {fname}")
@@ -0,0 +1,67 @@
+import math
+import torch
+
+
+class GradientSketch:
+    """
+    Seeded Johnson-Lindenstrauss sketch x -> x @ R / sqrt(k) of very long (e.g. lm_head) gradients.
+
+    R (dim x k, Rademacher or Gaussian entries) is never materialized: block b of block_size rows is
+    regenerated on the device of the gradient from torch.Generator(seed + b), multiplied in and
+    dropped. Projecting costs O(block_size * k) extra memory, and every call (and every process) with
+    the same seed, dim and k sees the same R, so sketches computed in different runs are comparable.
+    """
+
+    def __init__(self, dim, k, seed=0, distribution="rademacher", block_size=None):
+        if distribution not in ("rademacher", "gaussian"):
+            raise ValueError(f"Unknown sketch distribution {distribution}, expected rademacher or gaussian.")
+        self.dim = dim
+        self.k = k
+        self.seed = seed
+        self.distribution = distribution
+        # ~256MB of fp32 projection rows per block by default
+        self.block_size = block_size or max(1, (1 << 26) // k)
+        self.num_blocks = math.ceil(dim / self.block_size)
+
+    def block(self, block_index, device, dtype=torch.float32):
+        """ Rows [block_index * block_size, ...) of R, scaled by 1 / sqrt(k). """
+        start = block_index * self.block_size
+        rows = min(self.block_size, self.dim - start)
+        generator = torch.Generator(device=device).manual_seed(self.seed + block_index)
+        if self.distribution == "rademacher":
+            block = torch.randint(0, 2, (rows, self.k), generator=generator, device=device, dtype=dtype)
+            block.mul_(2).sub_(1)
+        else:
+            block = torch.randn(rows, self.k, generator=generator, device=device, dtype=dtype)
+        return block.div_(math.sqrt(self.k))
+
+    @torch.no_grad()
+    def project(self, x, offset=0, out=None):
+        """
+        Add the sketch of x to out and return it. x is (n, m) or (m,) and holds coordinates
+        [offset, offset + m) of the full dim-length vectors, so a gradient split across several
+        parameters is projected piece by piece (with running offsets) without concatenating it.
+        Projecting n rows at once generates each block of R only once for all of them.
+        """
+        x = x.reshape(-1, x.shape[-1]) if x.dim() > 1 else x.reshape(1, -1)
+        if offset + x.shape[1] > self.dim:
+            raise ValueError(f"Coordinates up to {offset + x.shape[1]} do not fit in a sketch of dim {self.dim}.")
+        if out is None:
+            out = torch.zeros(x.shape[0], self.k, device=x.device, dtype=torch.float32)
+
+        end = offset + x.shape[1]
+        for block_index in range(offset // self.block_size, math.ceil(end / self.block_size)):
+            block_start = block_index * self.block_size
+            lo = max(offset, block_start)
+            hi = min(end, block_start + self.block_size)
+            rows = self.block(block_index, x.device)[lo - block_start:hi - block_start]
+            out.addmm_(x[:, lo - offset:hi - offset].float(), rows)
+        return out
+
+    def project_tensors(self, tensors, out=None):
+        """ Sketch (1, k) of one vector given as a list of tensors, e.g. the .grad of several parameters. """
+        offset = 0
+        for tensor in tensors:
+            out = self.project(tensor.reshape(1, -1), offset=offset, out=out)
+            offset += tensor.numel()
+        return out
@@ -0,0 +1,102 @@
+import os
+import json
+
+import numpy as np
+
+
+class GradientStore:
+    """
+    Projected gradients of one proj_dim in a preallocated (num_rows, dim) memmap on disk.
+
+    Rows are written in place as soon as they are projected, in any order. A completion bitmap marks
+    the rows that are safely on disk (it is only flushed after the rows it covers), so an interrupted
+    collection resumes by skipping the finished rows. The L2 norm of every row is kept in a sidecar,
+    so the normalized gradients are a lazy view instead of a second copy of the data.
+
+    mode="r" maps an existing store read-only, e.g. for querying.
+    """
+
+    def __init__(self, path, num_rows=None, dim=None, dtype=np.float32, mode="r+"):
+        self.path = path
+        self.grads_path = os.path.join(path, "grads.npy")
+        self.norms_path = os.path.join(path, "norms.npy")
+        self.done_path = os.path.join(path, "done.npy")
+        self.meta_path = os.path.join(path, "meta.json")
+
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            if (num_rows is not None and meta["num_rows"] != num_rows) or (dim is not None and meta["dim"] != dim):
+                raise ValueError(f"Gradient store {path} holds {meta['num_rows']} x {meta['dim']} rows, not {num_rows} x {dim}.")
+            self.num_rows, self.dim = meta["num_rows"], meta["dim"]
+        else:
+            if num_rows is None or dim is None or mode == "r":
+                raise FileNotFoundError(f"No gradient store at {path}, num_rows and dim are needed to create one.")
+            os.makedirs(path, exist_ok=True)
+            self.num_rows, self.dim = num_rows, dim
+            np.lib.format.open_memmap(self.grads_path, mode="w+", dtype=dtype, shape=(num_rows, dim)).flush()
+            np.lib.format.open_memmap(self.norms_path, mode="w+", dtype=np.float32, shape=(num_rows,)).flush()
+            np.lib.format.open_memmap(self.done_path, mode="w+", dtype=np.bool_, shape=(num_rows,)).flush()
+            # meta.json last, so a store is only ever reopened once all of its files exist
+            with open(self.meta_path, "w") as f:
+                json.dump({"num_rows": num_rows, "dim": dim, "dtype": np.dtype(dtype).name}, f)
+
+        self.grads = np.lib.format.open_memmap(self.grads_path, mode=mode)
+        self.norms = np.lib.format.open_memmap(self.norms_path, mode=mode)
+        self.done = np.lib.format.open_memmap(self.done_path, mode=mode)
+
+    @classmethod
+    def open(cls, path, mode="r"):
+        """ An existing store, read-only by default, e.g. for querying. """
+        return cls(path, mode=mode)
+
+    def write(self, rows, data):
+        """ Write data (len(rows), dim) to the given row indices and mark them complete. """
+        rows = np.asarray(rows)
+        data = np.asarray(data, dtype=np.float32)
+        self.grads[rows] = data
+        self.norms[rows] = np.linalg.norm(data, axis=1)
+        self.grads.flush()
+        self.norms.flush()
+        self.done[rows] = True
+        self.done.flush()
+
+    def missing(self):
+        """ Indices of the rows not written yet. """
+        return np.flatnonzero(~self.done)
+
+    def is_complete(self):
+        return bool(self.done.all())
+
+    def check_complete(self):
+        """ Raise if some rows were never written, e.g. by an interrupted collect_grads run (they read as zeros). """
+        missing = int((~self.done).sum())
+        if missing > 0:
+            raise ValueError(f"Gradient store {self.path} is missing {missing} of {self.num_rows} rows, finish collecting the gradients first.")
+
+    def normalized(self):
+        return NormalizedView(self)
+
+    def blocks(self, block_rows=65536, normalize=False):
+        """ (start, rows) blocks of the gradients in float32, normalized on the fly if asked. """
+        for start in range(0, self.num_rows, block_rows):
+            block = np.asarray(self.grads[start:start + block_rows], dtype=np.float32)
+            if normalize:
+                block = block / np.maximum(self.norms[start:start + block_rows], 1e-12)[:, None]
+            yield start, block
+
+
+class NormalizedView:
+    """ Row-normalized gradients of a GradientStore, computed from the norms sidecar on access. """
+
+    def __init__(self, store):
+        self.store = store
+        self.shape = (store.num_rows, store.dim)
+
+    def __len__(self):
+        return self.store.num_rows
+
+    def __getitem__(self, index):
+        rows = np.asarray(self.store.grads[index], dtype=np.float32)
+        norms = np.maximum(np.asarray(self.store.norms[index], dtype=np.float32), 1e-12)
+        return rows / (norms[..., None] if rows.ndim > 1 else norms)
@@ -0,0 +1,126 @@
+import numpy as np
+import torch
+
+from gradient_store import GradientStore
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+
+# BLOCKWISE EXACT QUERIES
+
+def load_queries(store, normalize=True, device="cpu"):
+    """ All rows of a (small, e.g. validation) gradient store as one float32 tensor. """
+    rows = store.normalized()[:] if normalize else np.asarray(store.grads[:], dtype=np.float32)
+    return torch.from_numpy(np.ascontiguousarray(rows)).to(device)
+
+
+def _merge_topk(top_scores, top_indices, scores, indices, k):
+    # running top-k over the train rows seen so far, per query (columns)
+    scores = torch.cat([top_scores, scores])
+    indices = torch.cat([top_indices, indices])
+    top_scores, order = scores.topk(min(k, scores.shape[0]), dim=0)
+    return top_scores, torch.gather(indices, 0, order)
+
+
+@torch.no_grad()
+def query_topk(train_stores, val_stores, k=100, checkpoint_weights=None, cluster_ids=None, num_clusters=None,
+               normalize=True, block_rows=65536, device="cpu"):
+    """
+    Top-k training rows per validation gradient, by inner product summed over checkpoints.
+
+    train_stores and val_stores are matching lists of GradientStores (one per checkpoint), scored as
+    sum_c w_c * <train_c, val_c> like the LESS influence estimate. The training gradients are streamed
+    from their memmaps block_rows at a time, so memory is O(block_rows * num_queries) no matter how many
+    rows there are. Every store must be complete (rows never written would score 0 and could enter the
+    top-k). With cluster_ids (one per training row) the top-k is also kept per cluster, together
+    with the mean score of each cluster per query.
+
+    Returns a dict with 'scores' and 'indices' of shape (k, num_queries), plus per-cluster lists
+    'cluster_scores' and 'cluster_indices' of (up to k, num_queries) tensors and 'cluster_mean'
+    (num_clusters, num_queries) when clustered.
+    """
+    if len(train_stores) != len(val_stores):
+        raise ValueError(f"Got {len(train_stores)} training and {len(val_stores)} validation gradient stores.")
+    checkpoint_weights = checkpoint_weights or [1.0] * len(train_stores)
+    num_rows = train_stores[0].num_rows
+    if any(store.num_rows != num_rows for store in train_stores):
+        raise ValueError("Training gradient stores of different checkpoints have different numbers of rows.")
+    for store in list(train_stores) + list(val_stores):
+        store.check_complete()
+
+    queries = [load_queries(store, normalize, device) for store in val_stores]
+    num_queries = queries[0].shape[0]
+
+    top_scores = torch.empty(0, num_queries, device=device)
+    top_indices = torch.empty(0, num_queries, dtype=torch.long, device=device)
+    if cluster_ids is not None:
+        cluster_ids = torch.as_tensor(np.asarray(cluster_ids), dtype=torch.long, device=device)
+        num_clusters = num_clusters or int(cluster_ids.max().item()) + 1
+        cluster_top_scores = [top_scores] * num_clusters
+        cluster_top_indices = [top_indices] * num_clusters
+        cluster_sum = torch.zeros(num_clusters, num_queries, device=device)
+        cluster_count = torch.bincount(cluster_ids, minlength=num_clusters).clamp(min=1)
+
+    block_iterators = [store.blocks(block_rows, normalize=normalize) for store in train_stores]
+    for blocks in zip(*block_iterators):
+        start = blocks[0][0]
+        scores = None
+        for (_, block), query, weight in zip(blocks, queries, checkpoint_weights):
+            block_scores = torch.from_numpy(block).to(device) @ query.T
+            scores = block_scores.mul_(weight) if scores is None else scores.add_(block_scores, alpha=weight)
+        indices = torch.arange(start, start + scores.shape[0], device=device)[:, None].expand_as(scores)
+        top_scores, top_indices = _merge_topk(top_scores, top_indices, scores, indices, k)
+
+        if cluster_ids is not None:
+            block_clusters = cluster_ids[start:start + scores.shape[0]]
+            cluster_sum.index_add_(0, block_clusters, scores)
+            for cluster in block_clusters.unique().tolist():
+                mask = block_clusters == cluster
+                cluster_top_scores[cluster], cluster_top_indices[cluster] = _merge_topk(
+                    cluster_top_scores[cluster], cluster_top_indices[cluster], scores[mask], indices[mask], k
+                )
+
+    result = {"scores": top_scores.cpu(), "indices": top_indices.cpu()}
+    if cluster_ids is not None:
+        result["cluster_scores"] = [scores.cpu() for scores in cluster_top_scores]
+        result["cluster_indices"] = [indices.cpu() for indices in cluster_top_indices]
+        result["cluster_mean"] = (cluster_sum / cluster_count[:, None]).cpu()
+    return result
+
+
+# APPROXIMATE QUERIES
+
+def build_faiss_index(store, nlist=4096, pq_subquantizers=64, normalize=True, train_rows=262144, block_rows=65536):
+    """
+    IVF-PQ inner-product index over a gradient store, for approximate top-k over millions of rows.
+    Trained on a sample of train_rows rows, then filled block by block from the memmap.
+    """
+    if faiss is None:
+        raise ImportError("build_faiss_index needs faiss (pip install faiss-cpu or faiss-gpu).")
+    store.check_complete()
+
+    quantizer = faiss.IndexFlatIP(store.dim)
+    index = faiss.IndexIVFPQ(quantizer, store.dim, nlist, pq_subquantizers, 8, faiss.METRIC_INNER_PRODUCT)
+
+    sample = np.sort(np.random.default_rng(0).choice(store.num_rows, min(train_rows, store.num_rows), replace=False))
+    view = store.normalized() if normalize else store.grads
+    index.train(np.ascontiguousarray(view[sample], dtype=np.float32))
+    for _, block in store.blocks(block_rows, normalize=normalize):
+        index.add(np.ascontiguousarray(block))
+    return index
+
+
+def faiss_topk(index, val_store, k=100, nprobe=32, normalize=True):
+    """ Approximate top-k of build_faiss_index for every validation gradient, as (k, num_queries) arrays. """
+    index.nprobe = nprobe
+    val_store.check_complete()
+    queries = load_queries(val_store, normalize).numpy()
+    scores, indices = index.search(queries, k)
+    return {"scores": torch.from_numpy(scores.T.copy()), "indices": torch.from_numpy(indices.T.copy())}
+
+
+def open_stores(paths):
+    return [GradientStore.open(path) for path in paths]
@@ -0,0 +1,87 @@
+import torch
+
+
+# FLAT PARAMETER BUFFERS
+
+def is_selected(param_name, select):
+    """ Same selector as param_map / reduce_params: every substring must appear in the name, [] or () selects all, None selects nothing. """
+    return select is not None and all(substring in param_name for substring in select)
+
+
+class FlatLayout:
+    """
+    Fixed packing of the selected parameters of a model into one contiguous flat fp32 vector.
+
+    Every checkpoint and Fisher with the same parameter names is packed with the same layout,
+    so merging arithmetic runs as a handful of fused in-place vector ops over the whole model
+    instead of one small op (and one new tensor) per parameter.
+    """
+
+    def __init__(self, params, select=(), device="cpu", dtype=torch.float32):
+        self.names = [name for name in params.keys() if is_selected(name, select)]
+        self.shapes = [params[name].shape for name in self.names]
+        self.numels = [shape.numel() for shape in self.shapes]
+        self.numel = sum(self.numels)
+        self.device = torch.device(device)
+        self.dtype = dtype
+
+    def empty(self):
+        return torch.empty(self.numel, device=self.device, dtype=self.dtype)
+
+    def zeros(self):
+        return torch.zeros(self.numel, device=self.device, dtype=self.dtype)
+
+    def pack(self, params, out=None):
+        """ Copy the selected parameters into a flat vector (reusing out if given). """
+        if out is None:
+            out = self.empty()
+        for name, values in zip(self.names, out.split(self.numels)):
+            if name not in params:
+                raise KeyError(f"Parameter {name} not found in the parameters being packed.")
+            values.copy_(params[name].detach().flatten())
+        return out
+
+    def unpack(self, flat):
+        """ Views of the flat vector with the original parameter names and shapes (no copy). """
+        return {
+            name: values.view(shape)
+            for name, shape, values in zip(self.names, self.shapes, flat.split(self.numels))
+        }
+
+
+# MERGING OPERATIONS
+
+@torch.no_grad()
+def fisher_merge_flat(layout, checkpoints, fishers, model_lambdas, fisher_minimum=1e-8, epsilon=1e-8):
+    """
+    Fisher-weighted average sum_i(l_i * F_i * w_i) / sum_i(l_i * F_i) over the selected parameters.
+
+    checkpoints and fishers can be any iterables (e.g. generators that load one model at a time),
+    since each pair is packed into two reusable scratch buffers and accumulated in place. Peak memory
+    is four flat buffers of the selected parameters, no matter how many models are merged.
+    """
+    weighted_sum = layout.zeros()
+    fisher_sum = layout.zeros()
+    fisher_buffer = layout.empty()
+    weight_buffer = layout.empty()
+
+    for checkpoint, fisher, model_lambda in zip(checkpoints, fishers, model_lambdas):
+        layout.pack(fisher, out=fisher_buffer)
+        # set_minimum followed by scale, in place
+        fisher_buffer.clamp_(min=fisher_minimum).mul_(model_lambda)
+        fisher_sum.add_(fisher_buffer)
+        weighted_sum.addcmul_(fisher_buffer, layout.pack(checkpoint, out=weight_buffer))
+
+    # same guard as divide(): only zero Fisher entries get epsilon added
+    fisher_sum.masked_fill_(fisher_sum == 0, epsilon)
+    return weighted_sum.div_(fisher_sum)
+
+
+def unpack_merged(layout, merged_flat, base_params):
+    """
+    The merged state dict: selected parameters are views of the merged flat vector, every other
+    parameter is taken from base_params (the first checkpoint, as reduce_params does).
+    """
+    merged_model = dict(base_params)
+    merged_model.update(layout.unpack(merged_flat))
+    return merged_model
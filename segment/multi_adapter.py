@@ -0,0 +1,225 @@
+import os
+import math
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+from safetensors.torch import save_file
+from transformers import DataCollatorForLanguageModeling, get_scheduler
+
+from adapter_registry import ADAPTER_WEIGHTS_NAME
+
+
+# MULTI-ADAPTER LORA
+
+class AdapterRouter:
+    """ Cluster id of every example in the current batch, shared by all MultiLoraLinear modules of a model. """
+
+    def __init__(self):
+        self.adapter_ids = None
+
+
+class MultiLoraLinear(nn.Module):
+    """
+    A frozen base linear (fp16 or 4-bit) with num_adapters independent LoRA adapters.
+
+    Every example is routed to its own adapter by router.adapter_ids: the batch is split into one
+    segment per adapter present, each segment runs through its adapter's A and B, and the results are
+    added back into the shared base output. Every adapter is its own Parameter, so adapters absent from
+    a batch get no gradient and the optimizer leaves them (and their Adam state) untouched.
+    """
+
+    def __init__(self, base_layer, router, num_adapters, r=8, lora_alpha=16, lora_dropout=0.0):
+        super().__init__()
+        self.base_layer = base_layer
+        self.router = router
+        self.r = r
+        self.scaling = lora_alpha / r
+        self.dropout = nn.Dropout(lora_dropout) if lora_dropout > 0 else nn.Identity()
+
+        device = base_layer.weight.device
+        self.lora_A = nn.ParameterList(
+            [nn.Parameter(torch.empty(r, base_layer.in_features, device=device)) for _ in range(num_adapters)]
+        )
+        self.lora_B = nn.ParameterList(
+            [nn.Parameter(torch.zeros(base_layer.out_features, r, device=device)) for _ in range(num_adapters)]
+        )
+        # same initialization as peft: kaiming A, zero B, so every adapter starts at the base model
+        for lora_A in self.lora_A:
+            nn.init.kaiming_uniform_(lora_A, a=math.sqrt(5))
+
+    def forward(self, x):
+        result = self.base_layer(x)
+        adapter_ids = self.router.adapter_ids
+        if adapter_ids is None:
+            return result
+
+        lora_x = self.dropout(x).to(self.lora_A[0].dtype)
+        lora_result = torch.zeros(result.shape, device=result.device, dtype=lora_x.dtype)
+        for adapter_id in adapter_ids.unique().tolist():
+            rows = (adapter_ids == adapter_id).nonzero(as_tuple=True)[0]
+            segment = lora_x.index_select(0, rows)
+            segment = F.linear(F.linear(segment, self.lora_A[adapter_id]), self.lora_B[adapter_id])
+            lora_result = lora_result.index_add(0, rows, segment)
+        return result + (lora_result * self.scaling).to(result.dtype)
+
+
+def inject_multi_lora(model, num_adapters, r=8, lora_alpha=16, lora_dropout=0.0, target_modules=("q_proj", "v_proj")):
+    """
+    Freeze model and wrap every nn.Linear matching one of target_modules the way peft matches them (full
+    name or name suffix, peft's default for Llama is q_proj and v_proj) in a MultiLoraLinear. Returns the
+    router that selects the adapters.
+    """
+    router = AdapterRouter()
+    for parameter in model.parameters():
+        parameter.requires_grad_(False)
+
+    targets = [
+        (name, module) for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and any(name == target or name.endswith("." + target) for target in target_modules)
+    ]
+    if len(targets) == 0:
+        raise ValueError(f"No linear layers named {target_modules} found in the model.")
+    for name, module in targets:
+        parent_name, _, child_name = name.rpartition(".")
+        parent = model.get_submodule(parent_name) if parent_name else model
+        setattr(parent, child_name, MultiLoraLinear(module, router, num_adapters, r, lora_alpha, lora_dropout))
+    return router
+
+
+def save_cluster_adapters(model, output_dirs, peft_config):
+    """
+    Save adapter k of every MultiLoraLinear as a regular PEFT adapter in output_dirs[k]
+    (adapter_model.safetensors + adapter_config.json), loadable with PeftModel.from_pretrained.
+    """
+    target_modules = set()
+    for k, output_dir in enumerate(output_dirs):
+        tensors = {}
+        for name, module in model.named_modules():
+            if isinstance(module, MultiLoraLinear):
+                target_modules.add(name.split(".")[-1])
+                tensors[f"base_model.model.{name}.lora_A.weight"] = module.lora_A[k].detach().contiguous().cpu()
+                tensors[f"base_model.model.{name}.lora_B.weight"] = module.lora_B[k].detach().contiguous().cpu()
+        os.makedirs(output_dir, exist_ok=True)
+        save_file(tensors, os.path.join(output_dir, ADAPTER_WEIGHTS_NAME))
+        if peft_config.target_modules is None:
+            peft_config.target_modules = sorted(target_modules)
+        peft_config.save_pretrained(output_dir)
+
+
+def adapter_parameters(model, num_adapters):
+    """ The LoRA A and B parameters of every MultiLoraLinear, grouped by adapter. """
+    parameters = [[] for _ in range(num_adapters)]
+    for module in model.modules():
+        if isinstance(module, MultiLoraLinear):
+            for k in range(num_adapters):
+                parameters[k] += [module.lora_A[k], module.lora_B[k]]
+    return parameters
+
+
+# TRAINING
+
+def routed_lm_loss(logits, labels, adapter_ids):
+    """
+    Causal LM loss where every adapter gets the mean token loss of its own examples, so each adapter's
+    gradient matches training it alone on its share of the batch.
+    """
+    shift_logits = logits[:, :-1].float()
+    shift_labels = labels[:, 1:]
+    token_loss = F.cross_entropy(shift_logits.transpose(1, 2), shift_labels, ignore_index=-100, reduction="none")
+    example_loss = token_loss.sum(dim=1) / (shift_labels != -100).sum(dim=1).clamp(min=1)
+
+    examples_per_adapter = torch.bincount(adapter_ids)[adapter_ids]
+    return (example_loss / examples_per_adapter).sum()
+
+
+def train_multi_adapter(model, router, dataset, tokenizer, cluster_ids, output_dirs, peft_config,
+                        num_train_epochs=1, per_device_train_batch_size=8, gradient_accumulation_steps=1,
+                        learning_rate=2e-4, weight_decay=0.0, max_grad_norm=0.3, lr_scheduler_type="cosine",
+                        warmup_ratio=0.03, max_seq_length=None, fp16=False, bf16=False, optim="adamw",
+                        logging_steps=10, device=None):
+    """
+    Train all cluster adapters of a MultiLoraLinear model in one job: batches are drawn from the whole
+    dataset and every example is routed to the adapter of its cluster (cluster_ids), so the frozen base
+    forward is shared by all clusters. After every epoch adapter k is saved to output_dirs[k]/epoch_{n},
+    the same layout as one SaveEpochCallback run per cluster.
+
+    Gradients are clipped to max_grad_norm per adapter, so one cluster's gradients never scale another's
+    update. Unlike the sequential runs, which get one warmup and cosine schedule each over their own
+    cluster's steps, all adapters share a single schedule over the steps of the whole dataset: a small
+    cluster sees the learning rate at every point of the schedule rather than a full schedule of its own.
+    With fp16 the loss scaler is also shared, so an overflow in any adapter skips the step for all of them.
+    """
+    device = device or next(model.parameters()).device
+    max_seq_length = max_seq_length or min(tokenizer.model_max_length, 1024)
+
+    dataset = dataset.add_column("adapter_id", list(map(int, cluster_ids)))
+    dataset = dataset.map(
+        lambda examples: tokenizer(examples["text"], truncation=True, max_length=max_seq_length),
+        batched=True,
+        remove_columns=[column for column in dataset.column_names if column != "adapter_id"],
+    )
+    lm_collator = DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False)
+
+    def collate(features):
+        adapter_ids = torch.tensor([feature.pop("adapter_id") for feature in features])
+        batch = lm_collator(features)
+        batch["adapter_ids"] = adapter_ids
+        return batch
+
+    dataloader = DataLoader(dataset, batch_size=per_device_train_batch_size, shuffle=True, collate_fn=collate)
+
+    parameters = [parameter for parameter in model.parameters() if parameter.requires_grad]
+    parameters_per_adapter = adapter_parameters(model, len(output_dirs))
+    if optim == "paged_adamw_32bit":
+        import bitsandbytes as bnb
+        optimizer = bnb.optim.PagedAdamW32bit(parameters, lr=learning_rate, weight_decay=weight_decay)
+    else:
+        optimizer = torch.optim.AdamW(parameters, lr=learning_rate, weight_decay=weight_decay)
+    num_training_steps = num_train_epochs * math.ceil(len(dataloader) / gradient_accumulation_steps)
+    scheduler = get_scheduler(
+        lr_scheduler_type, optimizer,
+        num_warmup_steps=math.ceil(warmup_ratio * num_training_steps),
+        num_training_steps=num_training_steps,
+    )
+    scaler = torch.cuda.amp.GradScaler(enabled=fp16)
+    autocast_dtype = torch.bfloat16 if bf16 else torch.float16
+
+    print(f"Training {len(output_dirs)} adapters on {len(dataset)} examples for {num_train_epochs} epochs ({num_training_steps} steps)")
+    model.train()
+    start = time.perf_counter()
+    step = 0
+    for epoch in range(1, num_train_epochs + 1):
+        for micro_step, batch in enumerate(dataloader, start=1):
+            batch = {k: v.to(device) for k, v in batch.items()}
+            router.adapter_ids = batch["adapter_ids"]
+            with torch.autocast(device_type=device.type, dtype=autocast_dtype, enabled=fp16 or bf16):
+                logits = model(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"]).logits
+            loss = routed_lm_loss(logits, batch["labels"], batch["adapter_ids"]) / gradient_accumulation_steps
+            scaler.scale(loss).backward()
+
+            if micro_step % gradient_accumulation_steps == 0 or micro_step == len(dataloader):
+                scaler.unscale_(optimizer)
+                for adapter_params in parameters_per_adapter:
+                    # adapters absent from the step have no gradients and are skipped
+                    adapter_params = [parameter for parameter in adapter_params if parameter.grad is not None]
+                    if adapter_params:
+                        torch.nn.utils.clip_grad_norm_(adapter_params, max_grad_norm)
+                scaler.step(optimizer)
+                scaler.update()
+                scheduler.step()
+                optimizer.zero_grad(set_to_none=True) # adapters missing from the next batch keep grad None
+                step += 1
+                if step % logging_steps == 0:
+                    print(f"epoch {epoch} step {step}/{num_training_steps}: loss {loss.item() * gradient_accumulation_steps:.4f}, {time.perf_counter() - start:.0f}s")
+
+        epoch_dirs = [os.path.join(output_dir, f"epoch_{epoch}") for output_dir in output_dirs]
+        save_cluster_adapters(model, epoch_dirs, peft_config)
+        print(f"Saved {len(epoch_dirs)} adapters at the end of epoch {epoch}")
+
+    router.adapter_ids = None
+    elapsed = time.perf_counter() - start
+    print(f"Trained {len(output_dirs)} adapters concurrently in {elapsed:.0f}s")
+    return elapsed
@@ -31,7 +31,10 @@ def save_model(save_type, model_name, adapter_path, output_dir, new_state_dict=N
         model = model.merge_and_unload()
     elif save_type == "merge":
         model = PeftModel.from_pretrained(base_model, adapter_path)
-        model.load_state_dict(torch.load(new_state_dict))
+        # Merged state dicts may only hold the adapter weights, the base weights stay as loaded
+        _, unexpected_keys = model.load_state_dict(torch.load(new_state_dict), strict=False)
+        if unexpected_keys:
+            raise KeyError(f"Merged state dict has parameters not found in the model: {unexpected_keys[:10]}")
         model = model.merge_and_unload()
     else:
         print(f"Save type must be specified. Valid options are 'adapter' or 'merge'")
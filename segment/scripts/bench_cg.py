@@ -0,0 +1,60 @@
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fisher_parallel import conjugate_gradient_forward, conjugate_gradient_batched, print_residuals
+
+# Benchmark the batched torch CG (and closed form) against the per-parameter SciPy CG
+# on random diagonal Fishers with the LoRA shapes of a 32 layer, rank 64 model
+
+num_layers = 32
+hidden_size = 4096
+rank = 64
+num_iters = 100
+
+torch.manual_seed(0)
+sum_fisher_matrices = {}
+sum_fisher_times_weight = {}
+init_model = {}
+for layer in range(num_layers):
+    for proj in ["q_proj", "v_proj"]:
+        for name, shape in [("lora_A", (rank, hidden_size)), ("lora_B", (hidden_size, rank))]:
+            param_name = f"model.layers.{layer}.self_attn.{proj}.{name}.weight"
+            fisher = torch.rand(shape) ** 4 + 1e-8
+            weight = torch.randn(shape) * 0.02
+            sum_fisher_matrices[param_name] = fisher
+            sum_fisher_times_weight[param_name] = fisher * weight
+            init_model[param_name] = weight + torch.randn(shape) * 0.01
+all_param_names = list(sum_fisher_matrices.keys())
+
+start = time.perf_counter()
+scipy_model = conjugate_gradient_forward(
+    sum_fisher_matrices, sum_fisher_times_weight, init_model, all_param_names, num_iters
+)
+scipy_time = time.perf_counter() - start
+print(f"scipy: {scipy_time:.2f}s")
+
+devices = [torch.device("cpu")] + ([torch.device("cuda")] if torch.cuda.is_available() else [])
+for device in devices:
+    for closed_form in [False, True]:
+        # warm up, then time
+        conjugate_gradient_batched(
+            sum_fisher_matrices, sum_fisher_times_weight, init_model, all_param_names,
+            num_iters=num_iters, closed_form=closed_form, device=device
+        )
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        final_model, residuals = conjugate_gradient_batched(
+            sum_fisher_matrices, sum_fisher_times_weight, init_model, all_param_names,
+            num_iters=num_iters, closed_form=closed_form, device=device
+        )
+        elapsed = time.perf_counter() - start
+
+        max_diff = max((final_model[name] - scipy_model[name].float()).abs().max().item() for name in all_param_names)
+        solver = "closed form" if closed_form else "batched cg"
+        print(f"{solver} on {device}: {elapsed:.3f}s ({scipy_time / elapsed:.1f}x), max abs diff vs scipy: {max_diff:.2e}")
+        print_residuals(residuals, top_k=3)
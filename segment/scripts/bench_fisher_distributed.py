@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+from transformers import GPT2Config, GPT2LMHeadModel
+from peft import LoraConfig, get_peft_model
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fisher_parallel import estimate_fisher, select_fisher_params
+from fisher_distributed import get_rank_shard, all_reduce_fisher
+
+# Scaling efficiency of the data-parallel Fisher on a tiny CPU model with 1/2/4 gloo processes
+
+num_examples = 256
+seq_len = 64
+batch_size = 8
+world_sizes = [1, 2, 4]
+
+def build_model():
+    torch.manual_seed(0)
+    config = GPT2Config(n_layer=4, n_head=4, n_embd=128, n_positions=seq_len, vocab_size=1024)
+    model = GPT2LMHeadModel(config)
+    lora_config = LoraConfig(r=8, lora_alpha=16, target_modules=["c_attn"], lora_dropout=0.0, task_type="CAUSAL_LM")
+    model = get_peft_model(model, lora_config)
+    select_fisher_params(model, ['lora'])
+    model.eval()
+    return model, config
+
+def worker(rank, world_size, results):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = "29512"
+    torch.set_num_threads(1) # one core per process, so the speedup comes from data parallelism
+    dist.init_process_group(backend="gloo", rank=rank, world_size=world_size)
+
+    model, config = build_model()
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(0, config.vocab_size, (num_examples, seq_len), generator=generator)
+    dataset = [{"input_ids": ids, "attention_mask": torch.ones_like(ids), "labels": ids} for ids in input_ids]
+
+    dist.barrier()
+    start = time.perf_counter()
+    shard = get_rank_shard(dataset, num_examples, rank, world_size)
+    dataloader = DataLoader(shard, batch_size=batch_size)
+    stored_fisher, num_samples = estimate_fisher(model, dataloader, len(shard), vectorize=True, device="cpu")
+    fisher, total_samples = all_reduce_fisher(stored_fisher, num_samples, model, torch.device("cpu"), world_size)
+    elapsed = time.perf_counter() - start
+
+    if rank == 0:
+        results.put((elapsed, total_samples, sum(value.sum().item() for value in fisher.values())))
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    context = mp.get_context("spawn")
+    baseline = None
+    for world_size in world_sizes:
+        results = context.SimpleQueue()
+        mp.spawn(worker, args=(world_size, results), nprocs=world_size, join=True)
+        elapsed, total_samples, checksum = results.get()
+
+        speed = total_samples / elapsed
+        baseline = baseline or speed
+        efficiency = speed / (baseline * world_size)
+        print(
+            f"{world_size} process(es): {speed:.1f} examples/sec, "
+            f"speedup {speed / baseline:.2f}x, efficiency {efficiency:.0%}, fisher checksum {checksum:.6e}"
+        )
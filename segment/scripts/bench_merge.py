@@ -0,0 +1,52 @@
+import os
+import sys
+import time
+import tempfile
+
+import torch
+from safetensors.torch import save_file
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fisher_parallel import fisher_merge_adapters
+from adapter_registry import get_peft_key
+
+# End-to-end Fisher merge time for 2-8 synthetic cluster adapters with the LoRA shapes of
+# Llama-2-7B (r=64 on q_proj and v_proj), read straight from safetensors without a base model
+
+num_layers = 32
+hidden_size = 4096
+rank = 64
+cluster_counts = [2, 4, 8]
+select_params = ['lora', 'attn']
+
+def make_adapter(seed):
+    generator = torch.Generator().manual_seed(seed)
+    adapter = {}
+    for layer in range(num_layers):
+        for proj in ["q_proj", "v_proj"]:
+            prefix = f"base_model.model.model.layers.{layer}.self_attn.{proj}"
+            adapter[f"{prefix}.lora_A.weight"] = torch.randn(rank, hidden_size, generator=generator).half()
+            adapter[f"{prefix}.lora_B.weight"] = torch.randn(hidden_size, rank, generator=generator).half()
+    return adapter
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    checkpoint_paths = []
+    fishers = []
+    for cluster in range(max(cluster_counts)):
+        adapter = make_adapter(cluster)
+        checkpoint_path = os.path.join(tmp_dir, f"cluster-{cluster}")
+        os.makedirs(checkpoint_path)
+        save_file(adapter, os.path.join(checkpoint_path, "adapter_model.safetensors"))
+        checkpoint_paths.append(checkpoint_path)
+        fishers.append({get_peft_key(key): torch.rand(value.shape) for key, value in adapter.items()})
+
+    for num_clusters in cluster_counts:
+        start = time.perf_counter()
+        merged_model = fisher_merge_adapters(
+            checkpoint_paths[:num_clusters],
+            fishers[:num_clusters],
+            [1.0 / num_clusters] * num_clusters,
+            select=select_params,
+        )
+        elapsed = time.perf_counter() - start
+        print(f"{num_clusters} clusters: merged {len(merged_model)} adapter tensors in {elapsed:.2f}s")
@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+import tempfile
+
+import torch
+from datasets import Dataset
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+from tokenizers import Tokenizer, models, pre_tokenizers
+from peft import LoraConfig
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from multi_adapter import inject_multi_lora, train_multi_adapter
+
+# Wall-clock of training K cluster adapters one after the other (model load + training per cluster,
+# as train_cluster.py does) vs concurrently on one shared base, on a tiny Llama
+
+num_clusters = 8
+examples_per_cluster = 64
+vocab_size = 512
+lora_r = 8
+lora_alpha = 16
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+words = [f"w{i}" for i in range(vocab_size - 2)]
+tokenizer = PreTrainedTokenizerFast(
+    tokenizer_object=Tokenizer(models.WordLevel({word: i for i, word in enumerate(["<unk>", "</s>"] + words)}, unk_token="<unk>")),
+    unk_token="<unk>", eos_token="</s>",
+)
+tokenizer.backend_tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+tokenizer.pad_token = tokenizer.eos_token
+
+generator = torch.Generator().manual_seed(0)
+texts, cluster_labels = [], []
+for cluster in range(num_clusters):
+    for _ in range(examples_per_cluster):
+        length = int(torch.randint(16, 128, (1,), generator=generator))
+        ids = torch.randint(cluster * 32, cluster * 32 + 64, (length,), generator=generator)
+        texts.append(" ".join(words[i] for i in ids.tolist()))
+        cluster_labels.append(cluster)
+dataset = Dataset.from_dict({"text": texts})
+
+def load_base():
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=vocab_size, hidden_size=256, intermediate_size=688, num_hidden_layers=4,
+                         num_attention_heads=4, max_position_embeddings=256)
+    return LlamaForCausalLM(config).to(device)
+
+def train(model, dataset, cluster_ids, num_adapters, output_dir):
+    router = inject_multi_lora(model, num_adapters, r=lora_r, lora_alpha=lora_alpha)
+    peft_config = LoraConfig(r=lora_r, lora_alpha=lora_alpha, task_type="CAUSAL_LM")
+    output_dirs = [os.path.join(output_dir, f"cluster_{k}") for k in range(num_adapters)]
+    train_multi_adapter(model, router, dataset, tokenizer, cluster_ids, output_dirs, peft_config,
+                        num_train_epochs=1, per_device_train_batch_size=8, logging_steps=1000, device=device)
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    start = time.perf_counter()
+    for cluster in range(num_clusters):
+        indices = [i for i, label in enumerate(cluster_labels) if label == cluster]
+        train(load_base(), dataset.select(indices), [0] * len(indices), 1, os.path.join(tmp_dir, f"sequential_{cluster}"))
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    train(load_base(), dataset, cluster_labels, num_clusters, os.path.join(tmp_dir, "concurrent"))
+    concurrent = time.perf_counter() - start
+
+print(f"sequential: {sequential:.1f}s, concurrent: {concurrent:.1f}s ({sequential / concurrent:.2f}x) for {num_clusters} clusters on {device}")
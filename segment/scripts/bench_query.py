@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gradient_store import GradientStore
+from influence_query import query_topk, build_faiss_index, faiss_topk, faiss
+
+# Top-k query throughput over a 1M x 8192 training gradient store (fp16 on disk, ~16GB) against
+# 512 validation gradients, exact blockwise vs IVF-PQ (if faiss is installed)
+
+num_rows = 1_000_000
+dim = 8192
+num_queries = 512
+num_clusters = 64
+k = 100
+block_rows = 32768
+write_rows = 65536
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    generator = np.random.default_rng(0)
+    train_store = GradientStore(os.path.join(tmp_dir, "train"), num_rows, dim, dtype=np.float16)
+    for start in range(0, num_rows, write_rows):
+        rows = np.arange(start, min(start + write_rows, num_rows))
+        train_store.write(rows, generator.standard_normal((len(rows), dim), dtype=np.float32))
+    val_store = GradientStore(os.path.join(tmp_dir, "val"), num_queries, dim)
+    val_store.write(np.arange(num_queries), generator.standard_normal((num_queries, dim), dtype=np.float32))
+    cluster_ids = generator.integers(0, num_clusters, num_rows)
+
+    for clustered in [False, True]:
+        start = time.perf_counter()
+        result = query_topk(
+            [train_store], [val_store], k=k, block_rows=block_rows, device=device,
+            cluster_ids=cluster_ids if clustered else None, num_clusters=num_clusters,
+        )
+        elapsed = time.perf_counter() - start
+        gb = num_rows * dim * train_store.grads.itemsize / 2**30
+        print(
+            f"exact{' + clusters' if clustered else ''} on {device}: {elapsed:.1f}s, "
+            f"{num_rows / elapsed:,.0f} rows/s, {gb / elapsed:.2f} GB/s, top score {result['scores'][0].mean():.3f}"
+        )
+
+    if faiss is not None:
+        start = time.perf_counter()
+        index = build_faiss_index(train_store)
+        build_time = time.perf_counter() - start
+        start = time.perf_counter()
+        approximate = faiss_topk(index, val_store, k=k)
+        elapsed = time.perf_counter() - start
+        recall = np.mean([
+            len(np.intersect1d(approximate["indices"][:, q].numpy(), result["indices"][:, q].numpy())) / k
+            for q in range(num_queries)
+        ])
+        print(f"ivf-pq: build {build_time:.1f}s, query {elapsed:.2f}s ({num_queries / elapsed:,.0f} queries/s), recall@{k} {recall:.3f}")
+    else:
+        print("faiss not installed, skipping the IVF-PQ index")
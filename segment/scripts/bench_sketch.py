@@ -0,0 +1,90 @@
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from sklearn.cluster import KMeans
+from sklearn.decomposition import IncrementalPCA, PCA
+from transformers import GPT2Config, GPT2LMHeadModel
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gradient_sketch import GradientSketch
+from cluster_gradients import cluster_quality, lm_head_sketch, lm_head_example_features
+
+# Cluster quality of sketched lm_head gradients vs IncrementalPCA on the full gradients, on a tiny
+# untied GPT-2 and synthetic "topics" (examples drawn from disjoint slices of the vocabulary)
+
+num_topics = 4
+examples_per_topic = 64
+seq_len = 32
+n_components = 16
+sketch_dims = [64, 256, 1024]
+
+torch.manual_seed(0)
+config = GPT2Config(n_layer=2, n_head=4, n_embd=128, n_positions=seq_len, vocab_size=2048, tie_word_embeddings=False)
+model = GPT2LMHeadModel(config)
+model.eval()
+for name, parameter in model.named_parameters():
+    parameter.requires_grad_("lm_head" in name)
+
+topic_size = config.vocab_size // num_topics
+topics = np.repeat(np.arange(num_topics), examples_per_topic)
+all_input_ids = torch.stack([torch.randint(topic * topic_size, (topic + 1) * topic_size, (seq_len,)) for topic in topics])
+gradients = []
+for input_ids in all_input_ids:
+    model.zero_grad()
+    model(input_ids=input_ids[None], labels=input_ids[None]).loss.backward()
+    gradients.append(model.lm_head.weight.grad.flatten().clone())
+gradients = torch.stack(gradients)
+print(f"{len(topics)} examples, gradient dim {gradients.shape[1]}")
+
+def report(name, features, elapsed, ipca_labels=None):
+    labels = KMeans(n_clusters=num_topics, random_state=0, n_init=10).fit_predict(features)
+    quality = cluster_quality(features, labels, topics)
+    line = f"{name}: {elapsed:.2f}s, {features.nbytes / 2**10:.0f}KB features, silhouette {quality['silhouette']:.3f}, ARI vs topics {quality['ari']:.3f}"
+    if ipca_labels is not None:
+        agreement = cluster_quality(features, labels, ipca_labels)
+        line += f", ARI vs ipca {agreement['ari']:.3f}, NMI vs ipca {agreement['nmi']:.3f}"
+    print(line)
+    return labels
+
+start = time.perf_counter()
+ipca = IncrementalPCA(n_components=n_components, batch_size=n_components)
+ipca_features = ipca.fit_transform(gradients.numpy())
+ipca_labels = report("ipca", ipca_features, time.perf_counter() - start)
+
+for sketch_dim in sketch_dims:
+    start = time.perf_counter()
+    sketch = GradientSketch(gradients.shape[1], sketch_dim, seed=0, block_size=1 << 14)
+    sketched = sketch.project(gradients).numpy()
+    report(f"sketch k={sketch_dim}", sketched, time.perf_counter() - start, ipca_labels)
+    reduced = PCA(n_components=n_components, random_state=0).fit_transform(sketched)
+    report(f"sketch k={sketch_dim} + pca{n_components}", reduced, time.perf_counter() - start, ipca_labels)
+
+    # JL distortion of pairwise distances
+    exact = torch.cdist(gradients[:64], gradients[:64])
+    approx = torch.cdist(torch.from_numpy(sketched[:64]), torch.from_numpy(sketched[:64]))
+    mask = exact > 0
+    ratio = approx[mask] / exact[mask]
+    print(f"  distance ratio sketch/exact: mean {ratio.mean():.3f}, std {ratio.std():.3f}")
+
+# Single-pass per-example features from the low-rank structure of the lm_head gradient (one forward
+# per batch, no backward) vs sketching the per-example backward gradients above
+sketch_dim = 256
+sketch, rows_per_block = lm_head_sketch(model, sketch_dim, seed=0)
+start = time.perf_counter()
+exact_sketch = sketch.project(gradients)
+sketch_time = time.perf_counter() - start
+
+start = time.perf_counter()
+lowrank_features = []
+for input_ids in all_input_ids.split(8):
+    batch = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids), "labels": input_ids}
+    lowrank_features.append(lm_head_example_features(batch, model, sketch, rows_per_block))
+lowrank_features = torch.cat(lowrank_features)
+lowrank_time = time.perf_counter() - start
+print(f"lowrank single pass: {lowrank_time:.2f}s for {len(topics)} examples (sketching precomputed gradients: {sketch_time:.2f}s)")
+
+max_diff = (lowrank_features - exact_sketch).abs().max().item()
+print(f"  max abs diff vs sketched backward gradients: {max_diff:.2e} (relative to max {exact_sketch.abs().max().item():.2e})")
@@ -0,0 +1,37 @@
+import os
+import sys
+import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from datasets import Dataset
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cluster_splits import split_by_cluster, write_split
+
+# Split 1M synthetic instruction rows into 64 clusters and write them in parallel in each format
+
+num_rows = 1_000_000
+num_clusters = 64
+split_workers = 8
+
+generator = np.random.default_rng(0)
+words = np.array(["model", "data", "cluster", "adapter", "merge", "gradient", "token", "layer"])
+texts = [" ".join(row) for row in words[generator.integers(0, len(words), (num_rows, 48))]]
+dataset = Dataset.from_dict({"text": texts, "prompt": texts, "completion": texts})
+cluster_labels = generator.integers(0, num_clusters, num_rows)
+
+start = time.perf_counter()
+cluster_datasets = split_by_cluster(dataset, cluster_labels, ["text", "prompt", "completion"])
+print(f"split into {len(cluster_datasets)} clusters in {time.perf_counter() - start:.2f}s")
+
+for split_format in ["json", "parquet", "arrow"]:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=split_workers) as executor:
+            paths = list(executor.map(
+                lambda item: write_split(item[1], os.path.join(tmp_dir, f"{item[0]}.{split_format}"), split_format),
+                cluster_datasets.items(),
+            ))
+        print(f"{split_format}: wrote {len(paths)} splits in {time.perf_counter() - start:.2f}s")
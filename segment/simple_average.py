@@ -1,9 +1,12 @@
 import os
 import re
-import torch
-from peft import PeftModel, PeftConfig
-from transformers import AutoModelForCausalLM
+import shutil
+from safetensors import safe_open
+from safetensors.torch import save_file
+from huggingface_hub import snapshot_download
+from transformers import AutoTokenizer
 from push_adapter import save_model
+from adapter_registry import get_adapter_file, get_adapter_config, load_adapter_tensors, ADAPTER_WEIGHTS_NAME, ADAPTER_CONFIG_NAME
 
 # Define the model name pattern as a variable
 model_name_pattern = 'guanaco-7b-r64-a16'
@@ -12,13 +15,115 @@ model_name_pattern = 'guanaco-7b-r64-a16'
 def find_lora_weight_keys(state_dict):
     return [key for key in state_dict.keys() if 'lora' in key]
 
+
+# STREAMING ADAPTER AVERAGING
+
+class AdapterTensors:
+    """ Lazy reader for the tensors of one adapter: memory-mapped for safetensors, loaded once for .bin files. """
+
+    def __init__(self, adapter_path):
+        adapter_file = get_adapter_file(adapter_path)
+        if adapter_file.endswith(".safetensors"):
+            self.file = safe_open(adapter_file, framework="pt", device="cpu")
+            self.tensors = None
+        else:
+            self.file = None
+            self.tensors = load_adapter_tensors(adapter_file)
+
+    def keys(self):
+        return list(self.file.keys() if self.file is not None else self.tensors.keys())
+
+    def get_tensor(self, key):
+        return self.file.get_tensor(key) if self.file is not None else self.tensors[key]
+
+
+def average_adapters(adapter_paths, output_dir):
+    """
+    Average the LoRA tensors of several adapters without instantiating any model. Each tensor is read
+    from every adapter file (mmap) and averaged in fp32 one key at a time, so only one tensor per
+    adapter is in memory at once. Writes adapter_model.safetensors and the first adapter's config.
+    """
+    adapters = [AdapterTensors(adapter_path) for adapter_path in adapter_paths]
+    lora_weight_keys = find_lora_weight_keys({key: None for key in adapters[0].keys()})
+
+    average_weights = {}
+    for key in lora_weight_keys:
+        summed_weight = None
+        for adapter in adapters:
+            weight = adapter.get_tensor(key)
+            summed_weight = weight.float() if summed_weight is None else summed_weight.add_(weight.float())
+        average_weights[key] = summed_weight.div_(len(adapters))
+
+    os.makedirs(output_dir, exist_ok=True)
+    save_file(average_weights, os.path.join(output_dir, ADAPTER_WEIGHTS_NAME))
+    # Save the config - assume the config is the same for all models in the group
+    shutil.copy(os.path.join(adapter_paths[0], ADAPTER_CONFIG_NAME), os.path.join(output_dir, ADAPTER_CONFIG_NAME))
+    return average_weights
+
+
+def lora_deltas(adapter_weights, adapter_config):
+    """ {base weight name: (B, A, scaling)} for every LoRA pair, e.g. base_model.model.X.lora_A.weight -> X.weight """
+    scaling = adapter_config["lora_alpha"] / adapter_config["r"]
+    deltas = {}
+    for key, lora_A in adapter_weights.items():
+        if ".lora_A." not in key:
+            continue
+        base_key = re.sub(r"^base_model\.model\.", "", key.replace(".lora_A.weight", ".weight"))
+        deltas[base_key] = (adapter_weights[key.replace(".lora_A.", ".lora_B.")], lora_A, scaling)
+    return deltas
+
+
+def merge_adapter_streaming(base_model_name, adapter_weights, adapter_config, output_dir):
+    """
+    Fuse an adapter into the base weights in one streaming pass over the base safetensors shards,
+    W += scaling * B @ A (in fp32, stored back in the shard's dtype), one shard in memory at a time.
+    Same result as save_model("adapter", ...) without loading the base model twice.
+    """
+    base_dir = base_model_name if os.path.isdir(base_model_name) else snapshot_download(
+        base_model_name, allow_patterns=["*.safetensors", "*.json", "tokenizer.model"]
+    )
+    deltas = lora_deltas(adapter_weights, adapter_config)
+    os.makedirs(output_dir, exist_ok=True)
+
+    shard_names = sorted(name for name in os.listdir(base_dir) if name.endswith(".safetensors"))
+    if len(shard_names) == 0:
+        raise FileNotFoundError(f"No safetensors shards in {base_dir}, set fuse_merge = False to merge with save_model.")
+    merged = 0
+    for shard_name in shard_names:
+        shard = {}
+        with safe_open(os.path.join(base_dir, shard_name), framework="pt", device="cpu") as f:
+            metadata = f.metadata()
+            for key in f.keys():
+                weight = f.get_tensor(key)
+                if key in deltas:
+                    lora_B, lora_A, scaling = deltas[key]
+                    weight = weight.float().addmm_(lora_B.float(), lora_A.float(), alpha=scaling).to(weight.dtype)
+                    merged += 1
+                shard[key] = weight
+        save_file(shard, os.path.join(output_dir, shard_name), metadata=metadata)
+        print(f"Merged {shard_name} ({merged}/{len(deltas)} LoRA weights so far)")
+        del shard
+
+    if merged != len(deltas):
+        raise KeyError(f"Only {merged} of {len(deltas)} LoRA weights matched a base weight, check the adapter keys.")
+
+    # config, generation config and the shard index are unchanged
+    for name in os.listdir(base_dir):
+        if name.endswith(".json") and not name.startswith("tokenizer"):
+            shutil.copy(os.path.join(base_dir, name), os.path.join(output_dir, name))
+    tokenizer = AutoTokenizer.from_pretrained(base_model_name, trust_remote_code=True)
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "right"
+    tokenizer.save_pretrained(output_dir)
+
+
 # List directories that match the model pattern
 root_dir = "/scratch/alif/language-models/segment"
 model_dirs = [d for d in os.listdir('.') if model_name_pattern in d and 'cluster' in d]
 
-# Load the base model for compatibility checks
+# The base model is never loaded for averaging, only read shard by shard when fusing the merge
 base_model_name = "meta-llama/Llama-2-7b-hf"
-base_model = AutoModelForCausalLM.from_pretrained(base_model_name, torch_dtype=torch.float32)
+fuse_merge = True # False to merge with push_adapter.save_model instead
 
 select_groups = [2]
 epoch_num = 1
@@ -30,52 +135,31 @@ pattern = re.compile(rf'{model_name_pattern}-(\d+)-cluster')
 for group in set(match.group(1) for d in model_dirs if (match := pattern.match(d))):
 
     if int(group) in select_groups:
-        summed_weights = None
-        num_models = 0
         print(f'Processing group {group}...')
 
-        # Accumulate weights for each adapter in the group
-        for model_dir in (d for d in model_dirs if d.startswith(f'{model_name_pattern}-{group}-cluster')):
-            model_path = os.path.join(root_dir, model_dir, epoch_path) 
-            print(f'Loading model from directory: {model_path}')
-            model = PeftModel.from_pretrained(base_model, model_path)
-            num_models += 1
-
-            # Initialize summed_weights with the first model's state_dict structure
-            if summed_weights is None:
-                lora_weight_keys = find_lora_weight_keys(model.state_dict())
-                summed_weights = {key: torch.zeros_like(model.state_dict()[key]) for key in lora_weight_keys}
-
-            # Sum the weights across all models
-            for key in lora_weight_keys:
-                summed_weights[key] += model.state_dict()[key]
+        # Average the LoRA tensors of every adapter in the group straight from their files
+        adapter_paths = [
+            os.path.join(root_dir, model_dir, epoch_path)
+            for model_dir in model_dirs if model_dir.startswith(f'{model_name_pattern}-{group}-cluster')
+        ]
+        for adapter_path in adapter_paths:
+            print(f'Reading adapter from directory: {adapter_path}')
 
-        # Average the weights
-        average_weights = {key: summed_weights[key] / num_models for key in lora_weight_keys}
-
-        # Save the averaged adapter weights and config
         avg_adapter_dir = f'{model_name_pattern}-{group}-sa-ep{epoch_num}-adapter'
-        os.makedirs(avg_adapter_dir, exist_ok=True)
-
-        # Save the weights
-        torch.save(average_weights, os.path.join(avg_adapter_dir, 'adapter_model.bin'))
-
-        # Save the config - assume the config is the same for all models in the group
-        # and use the first model's config as the reference
-        first_model_config = PeftConfig.from_pretrained(os.path.join(model_dirs[0], epoch_path))
-        first_model_config.save_pretrained(avg_adapter_dir)
-
+        average_weights = average_adapters(adapter_paths, avg_adapter_dir)
         print(f'Finished processing group {group}.')
 
-
-    print(f"Merging averaged adapter weights into base model {base_model_name}...")
-    output_dir = f'{model_name_pattern}-{group}-sa-ep{epoch_num}-model'
-    adapter_path = avg_adapter_dir
-    save_model("adapter", base_model_name, adapter_path, output_dir)
-    print(f"Successfully saved averaged model at {output_dir}!")
-    
-    try:
-        shutil.rmtree(adapter_path)
-        print(f"Directory {adapter_path} has been removed")
-    except OSError as e:
-        print(f"Error: {e.strerror}")
\ No newline at end of file
+        print(f"Merging averaged adapter weights into base model {base_model_name}...")
+        output_dir = f'{model_name_pattern}-{group}-sa-ep{epoch_num}-model'
+        adapter_path = avg_adapter_dir
+        if fuse_merge:
+            merge_adapter_streaming(base_model_name, average_weights, get_adapter_config(adapter_path), output_dir)
+        else:
+            save_model("adapter", base_model_name, adapter_path, output_dir)
+        print(f"Successfully saved averaged model at {output_dir}!")
+
+        try:
+            shutil.rmtree(adapter_path)
+            print(f"Directory {adapter_path} has been removed")
+        except OSError as e:
+            print(f"Error: {e.strerror}")
@@ -0,0 +1,91 @@
+import time
+import resource
+
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans, kmeans_plusplus
+
+
+def peak_memory_gb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20
+
+
+def _rows(features, start, end):
+    rows = features[start:end]
+    return rows if hasattr(rows, "tocsr") else np.asarray(rows, dtype=np.float32)
+
+
+def _chunks(num_rows, chunk_rows):
+    # (start, end) of every chunk, a short tail is merged into the chunk before it so every chunk,
+    # including whichever one partial_fit sees first, has at least chunk_rows rows
+    starts = list(range(0, num_rows, chunk_rows))
+    if len(starts) > 1 and num_rows - starts[-1] < chunk_rows:
+        starts.pop()
+    return [(start, end) for start, end in zip(starts, starts[1:] + [num_rows])]
+
+
+def fit_streaming_kmeans(features, num_clusters, chunk_rows=65536, init_sample_rows=100000, max_epochs=1, random_state=0):
+    """
+    Mini-batch k-means over row chunks of features, which can be a memmap (np.load(..., mmap_mode="r"))
+    or a sparse matrix, so only one chunk is ever materialized. The centers are initialized with
+    k-means++ on a random sample of init_sample_rows rows (None to let the first chunk initialize them).
+    """
+    num_rows = features.shape[0]
+    generator = np.random.default_rng(random_state)
+    init = "k-means++"
+    if init_sample_rows is not None:
+        sample = np.sort(generator.choice(num_rows, min(init_sample_rows, num_rows), replace=False))
+        sample_rows = features[sample]
+        sample_rows = sample_rows if hasattr(sample_rows, "tocsr") else np.asarray(sample_rows, dtype=np.float32)
+        init, _ = kmeans_plusplus(sample_rows, num_clusters, random_state=random_state)
+
+    if min(chunk_rows, num_rows) < num_clusters:
+        raise ValueError(f"chunk_rows ({chunk_rows}) and the number of rows ({num_rows}) must be at least num_clusters ({num_clusters}).")
+    kmeans = MiniBatchKMeans(n_clusters=num_clusters, init=init, n_init=1, batch_size=chunk_rows, random_state=random_state)
+    chunks = _chunks(num_rows, chunk_rows)
+    for epoch in range(max_epochs):
+        # visit the chunks in a different order every epoch, the rows inside a chunk stay contiguous on disk
+        for chunk in generator.permutation(len(chunks)):
+            start, end = chunks[chunk]
+            kmeans.partial_fit(_rows(features, start, end))
+    return kmeans
+
+
+def assign_clusters(kmeans, features, chunk_rows=65536, labels_path=None):
+    """ Nearest-center cluster id of every row, computed chunk by chunk into an int32 array (or .npy memmap). """
+    num_rows = features.shape[0]
+    if labels_path is None:
+        labels = np.empty(num_rows, dtype=np.int32)
+    else:
+        labels = np.lib.format.open_memmap(labels_path, mode="w+", dtype=np.int32, shape=(num_rows,))
+    for start in range(0, num_rows, chunk_rows):
+        labels[start:start + chunk_rows] = kmeans.predict(_rows(features, start, start + chunk_rows))
+    if labels_path is not None:
+        labels.flush()
+    return labels
+
+
+def cluster_ids(features, num_clusters, backend="full", labels_path=None, verbose=True, **kwargs):
+    """
+    Cluster id per row of features with either the original in-memory KMeans(n_clusters, random_state=0)
+    ("full", the default, reproduces existing splits) or the approximate streaming backend ("minibatch"). Time and peak memory are reported per million rows.
+    """
+    start = time.perf_counter()
+    if backend == "full":
+        labels = KMeans(n_clusters=num_clusters, random_state=0).fit(features).labels_.astype(np.int32)
+        if labels_path is not None:
+            np.save(labels_path, labels)
+    elif backend == "minibatch":
+        kmeans = fit_streaming_kmeans(features, num_clusters, **kwargs)
+        labels = assign_clusters(kmeans, features, chunk_rows=kwargs.get("chunk_rows", 65536), labels_path=labels_path)
+    else:
+        raise ValueError(f"Unknown clustering backend {backend}, expected minibatch or full.")
+
+    if verbose:
+        elapsed = time.perf_counter() - start
+        millions = features.shape[0] / 1e6
+        print(
+            f"Clustered {features.shape[0]} rows into {num_clusters} clusters with {backend} k-means in {elapsed:.1f}s "
+            f"({elapsed / max(millions, 1e-9):.1f}s per million rows), peak memory {peak_memory_gb():.2f}GB"
+        )
+    return labels
@@ -21,11 +21,13 @@ from trl import SFTTrainer
 import os
 from datasets import load_dataset, Dataset
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.cluster import KMeans
-import pandas as pd
 import numpy as np
 from itertools import islice
 
+from streaming_kmeans import cluster_ids
+from cluster_splits import split_by_cluster
+from multi_adapter import inject_multi_lora, train_multi_adapter
+
 def preprocess_instruct(examples):
     # Concatenate 'prompt' and 'completion' fields
     texts = [prompt + " " + completion for prompt, completion in zip(examples['prompt'], examples['completion'])]
@@ -39,6 +41,8 @@ num_clusters = 4  # Adjust the number of clusters as needed
 resume_from_cluster = 0 # zero-indexed, resume from last incomplete run
 resume_from_checkpoint = None
 cluster_strategy = "embeddings"
+clustering_backend = "full" # exact in-memory KMeans, or "minibatch" for approximate streaming k-means over memmapped features
+train_concurrently = False # one job with a shared base and an adapter per cluster, instead of one run per cluster
 
 attention_only = True
 layer_config = "att" if attention_only else "lin"
@@ -171,58 +175,26 @@ else:
 #### CLUSTERING #########
 
 def cluster_embeddings(dataset, num_clusters, embeddings):    
-    # Extract text data
-    texts = [entry['text'] for entry in dataset]
-
-    # Clustering
-    kmeans = KMeans(n_clusters=num_clusters, random_state=0)
-    kmeans.fit(embeddings)
-
-    # Assigning cluster labels to each text
-    cluster_labels = kmeans.labels_
-
-    # Creating a DataFrame for easier visualization
-    clustered_data = pd.DataFrame({'text': texts, 'cluster': cluster_labels})
-
-    return clustered_data
+    # Clustering, embeddings can be memory-mapped
+    return cluster_ids(embeddings, num_clusters, backend=clustering_backend)
 
 def cluster_tfid(dataset, num_clusters):    
     # Extract text data (adjust the key 'text' if your dataset has a different text field)
-    texts = [entry['text'] for entry in dataset]
+    texts = dataset['text']
 
     # Data Preparation and Feature Extraction
     vectorizer = TfidfVectorizer(stop_words='english')
-    X = vectorizer.fit_transform(texts)
+    X = vectorizer.fit_transform(texts).tocsr()
 
-    # Clustering
-    kmeans = KMeans(n_clusters=num_clusters, random_state=0)
-    kmeans.fit(X)
-
-    # Assigning cluster labels to each text
-    cluster_labels = kmeans.labels_
-
-    # Creating a DataFrame for easier visualization
-    clustered_data = pd.DataFrame({'text': texts, 'cluster': cluster_labels})
-
-    return clustered_data
+    # Clustering, with the minibatch backend only chunks of the sparse matrix are densified at a time
+    return cluster_ids(X, num_clusters, backend=clustering_backend)
 
 if cluster_strategy == "embeddings":
-    embeddings = np.load(f'{dataset}_embeddings.npy')
-    clustered_data = cluster_embeddings(train_dataset, num_clusters, embeddings)
+    embeddings = np.load(f'{dataset}_embeddings.npy', mmap_mode="r")
+    cluster_labels = cluster_embeddings(train_dataset, num_clusters, embeddings)
     print(f'Created {num_clusters} clusters from precomputed embeddings file: {dataset}_embeddings.npy')
 elif cluster_strategy == "tfid":
-    clustered_data = cluster_tfid(train_dataset, num_clusters)
-
-unique_clusters = clustered_data['cluster'].unique()
-cluster_datasets = {}
-
-# Loop through each cluster and create datasets
-for cluster_label in unique_clusters:
-    cluster_df = clustered_data[clustered_data['cluster'] == cluster_label]
-    cluster_datasets[f"cluster_{cluster_label}"] = Dataset.from_pandas(cluster_df)
-    
-# Sort the cluster numerically
-cluster_datasets = dict(sorted(cluster_datasets.items()))  
+    cluster_labels = cluster_tfid(train_dataset, num_clusters)
 
 # Create custom checkpoint callbacks
 class PeftSavingCallback(TrainerCallback):
@@ -243,79 +215,111 @@ class SaveEpochCallback(TrainerCallback):
         kwargs['model'].save_pretrained(model_save_path)
         print(f"Model saved to {model_save_path} at the end of epoch {epoch}")
     
-count = 1
-total = len(cluster_datasets.items())
-
-for cluster_label, cluster_dataset in islice(cluster_datasets.items(), resume_from_cluster, total, 1):   
-    
-    # The QLoRA paper uses a batch size of 16 for a total of 1875 steps for Guanaco (~10K)
-    # Which means the model sees 30K examples, or each example 3 times
-    # However, Sebastian Raschka's experiments suggest multiple iterations over a dataset harms performance
-    dataset_iterations = 1
-    cluster_size = len(cluster_dataset)
-    cluster_max_steps = dataset_iterations * (cluster_size // per_device_train_batch_size)
-    new_model_name = f"llama-2-7b-{dataset}_lora-{layer_config}-d{lora_dropout_factor}-r{lora_r}-a{lora_alpha}-{num_clusters}_{cluster_label}"
-    
-    # print(f'{count}/{total} Training {cluster_label} for {cluster_max_steps} steps...')
-    print(f'({count}/{total}) Training {new_model_name} for {num_train_epochs} epochs...')
-
-    # Initialize both callbacks
-    save_model_callback = SaveEpochCallback(new_model_name)
-    peft_saving_callback = PeftSavingCallback()
-    callbacks = [save_model_callback, peft_saving_callback]  
-    
-    # Set training parameters
-    # Just going to train by epoch instead, easier for experimentation
-    training_arguments = TrainingArguments(
-        resume_from_checkpoint=resume_from_checkpoint,
-        output_dir=new_model_name,
-        num_train_epochs=num_train_epochs, # Compare results across epochs
-        # max_steps = cluster_max_steps, # Need to investigate how many steps or epochs to train for
+if train_concurrently:
+    if resume_from_cluster != 0 or resume_from_checkpoint is not None:
+        raise ValueError("resume_from_cluster and resume_from_checkpoint are not supported with train_concurrently, set them to 0 and None.")
+    # Reuse the base model loaded above for every cluster, batches are routed to each example's adapter
+    from peft import prepare_model_for_kbit_training
+    model = prepare_model_for_kbit_training(model, use_gradient_checkpointing=gradient_checkpointing)
+    target_modules = peft_config.target_modules or ["q_proj", "v_proj"]
+    router = inject_multi_lora(model, num_clusters, r=lora_r, lora_alpha=lora_alpha, lora_dropout=lora_dropout, target_modules=target_modules)
+    cluster_model_names = [
+        f"llama-2-7b-{dataset}_lora-{layer_config}-d{lora_dropout_factor}-r{lora_r}-a{lora_alpha}-{num_clusters}_cluster_{cluster_label}"
+        for cluster_label in range(num_clusters)
+    ]
+    print(f'Training {num_clusters} cluster adapters concurrently for {num_train_epochs} epochs...')
+    train_multi_adapter(
+        model, router, train_dataset.select_columns(['text']), tokenizer, cluster_labels, cluster_model_names, peft_config,
+        num_train_epochs=num_train_epochs,
         per_device_train_batch_size=per_device_train_batch_size,
         gradient_accumulation_steps=gradient_accumulation_steps,
-        optim=optim,
-        save_steps=save_steps,
-        logging_steps=logging_steps,
         learning_rate=learning_rate,
         weight_decay=weight_decay,
-        fp16=fp16,
-        bf16=bf16,
         max_grad_norm=max_grad_norm,
-        warmup_ratio=warmup_ratio,
-        group_by_length=group_by_length,
         lr_scheduler_type=lr_scheduler_type,
-        report_to=report_to
-    )
-    
-    model = AutoModelForCausalLM.from_pretrained(
-        model_name,
-        quantization_config=bnb_config
-    )
-    model.config.use_cache = False
-    model.config.pretraining_tp = 1
-
-    # Create a trainer for this cluster
-    trainer = SFTTrainer(
-        model=model,
-        train_dataset=cluster_dataset,
-        peft_config=peft_config,
-        dataset_text_field="text",
+        warmup_ratio=warmup_ratio,
         max_seq_length=max_seq_length,
-        tokenizer=tokenizer,
-        args=training_arguments,
-        packing=packing,
-        callbacks=callbacks,
+        fp16=fp16,
+        bf16=bf16,
+        optim=optim,
+        logging_steps=logging_steps,
     )
+else:
+    cluster_datasets = split_by_cluster(train_dataset, cluster_labels, ['text'])
 
-    # Train the model for this cluster
-    checkpoint = None
-    if training_arguments.resume_from_checkpoint is not None:
-        checkpoint = training_arguments.resume_from_checkpoint
-        print(f'Resuming {cluster_label} model training from {resume_from_checkpoint}')
-    else:
-        print(f'Starting new training run for model: {new_model}')
-    trainer.train(resume_from_checkpoint=checkpoint)
-    count += 1
+    # Sort the cluster numerically
+    cluster_datasets = dict(sorted(cluster_datasets.items()))
 
+    count = 1
+    total = len(cluster_datasets.items())
 
+    for cluster_label, cluster_dataset in islice(cluster_datasets.items(), resume_from_cluster, total, 1):   
+    
+        # The QLoRA paper uses a batch size of 16 for a total of 1875 steps for Guanaco (~10K)
+        # Which means the model sees 30K examples, or each example 3 times
+        # However, Sebastian Raschka's experiments suggest multiple iterations over a dataset harms performance
+        dataset_iterations = 1
+        cluster_size = len(cluster_dataset)
+        cluster_max_steps = dataset_iterations * (cluster_size // per_device_train_batch_size)
+        new_model_name = f"llama-2-7b-{dataset}_lora-{layer_config}-d{lora_dropout_factor}-r{lora_r}-a{lora_alpha}-{num_clusters}_{cluster_label}"
+    
+        # print(f'{count}/{total} Training {cluster_label} for {cluster_max_steps} steps...')
+        print(f'({count}/{total}) Training {new_model_name} for {num_train_epochs} epochs...')
 
+        # Initialize both callbacks
+        save_model_callback = SaveEpochCallback(new_model_name)
+        peft_saving_callback = PeftSavingCallback()
+        callbacks = [save_model_callback, peft_saving_callback]  
+    
+        # Set training parameters
+        # Just going to train by epoch instead, easier for experimentation
+        training_arguments = TrainingArguments(
+            resume_from_checkpoint=resume_from_checkpoint,
+            output_dir=new_model_name,
+            num_train_epochs=num_train_epochs, # Compare results across epochs
+            # max_steps = cluster_max_steps, # Need to investigate how many steps or epochs to train for
+            per_device_train_batch_size=per_device_train_batch_size,
+            gradient_accumulation_steps=gradient_accumulation_steps,
+            optim=optim,
+            save_steps=save_steps,
+            logging_steps=logging_steps,
+            learning_rate=learning_rate,
+            weight_decay=weight_decay,
+            fp16=fp16,
+            bf16=bf16,
+            max_grad_norm=max_grad_norm,
+            warmup_ratio=warmup_ratio,
+            group_by_length=group_by_length,
+            lr_scheduler_type=lr_scheduler_type,
+            report_to=report_to
+        )
+    
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            quantization_config=bnb_config
+        )
+        model.config.use_cache = False
+        model.config.pretraining_tp = 1
+
+        # Create a trainer for this cluster
+        trainer = SFTTrainer(
+            model=model,
+            train_dataset=cluster_dataset,
+            peft_config=peft_config,
+            dataset_text_field="text",
+            max_seq_length=max_seq_length,
+            tokenizer=tokenizer,
+            args=training_arguments,
+            packing=packing,
+            callbacks=callbacks,
+        )
+
+        # Train the model for this cluster
+        checkpoint = None
+        if training_arguments.resume_from_checkpoint is not None:
+            checkpoint = training_arguments.resume_from_checkpoint
+            print(f'Resuming {cluster_label} model training from {resume_from_checkpoint}')
+        else:
+            print(f'Starting new training run for model: {new_model}')
+        trainer.train(resume_from_checkpoint=checkpoint)
+        count += 1
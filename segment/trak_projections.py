@@ -1,3 +1,13 @@
+import os
+import time
+import queue
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List, Optional
+
+import numpy as np
 import torch
 from torch import Tensor
 import torch.nn.functional as F
@@ -9,8 +19,10 @@ from tqdm import tqdm
 
 from trak.projectors import BasicProjector, CudaProjector, ProjectionType
 
+from gradient_store import GradientStore
+
 
-def prepare_batch(batch, device=torch.device("cuda:0"))
+def prepare_batch(batch, device=torch.device("cuda:0")):
     """ Move batch to device. """
     for key in batch:
         batch[key] = batch[key].to(device)
@@ -41,6 +53,7 @@ def get_number_of_params(model):
         assert len(names) == 0
     num_params = sum([p.numel() for p in model.parameters() if p.requires_grad])
     print(f"Total number of params that require grad: {num_params}")
+    return num_params
 
 
 
@@ -78,23 +91,147 @@ def obtain_sign_gradients(model, batch):
     vectorized_grad_signs = torch.cat([torch.sign(p.grad).view(-1) for p in model.parameters() if p.grad is not None])
     return vectorized_grad_signs
 
-def obtain_gradients_with_adam(model, batch, avg, avg_sq):
+def adam_precondition(vectorized_grads, avg, avg_sq):
+    """ The Adam update direction for the gradient given the optimizer's first and second moments. """
     beta1 = 0.9
     beta2 = 0.999
     eps = 1e-08
     
-    loss = model(**batch).loss
-    loss.backward()
-    
-    vectorized_grads = torch.cat(p.grad.view(-1) for n, p in model.named_parameters() if p.grad is not None)
-    
     # What is this computation doing?
     updated_avg = beta1 * avg + (1 - beta1) * vectorized_grads
     updated_avg_sq = beta2 * avg_sq + (1 - beta2) * vectorized_grads ** 2
-    vectorized_grads = updated_avg / torch.sqrt(updated_avg_sq + eps)
+    return updated_avg / torch.sqrt(updated_avg_sq + eps)
+
+def obtain_gradients_with_adam(model, batch, avg, avg_sq):
+    loss = model(**batch).loss
+    loss.backward()
     
-    return vectorized_grads
+    vectorized_grads = torch.cat([p.grad.view(-1) for n, p in model.named_parameters() if p.grad is not None])
+    return adam_precondition(vectorized_grads, avg, avg_sq)
+
+def obtain_gradients_with_adam_states(model, batch, optimizer_states):
+    """ One backward, then the Adam-preconditioned gradient for each (avg, avg_sq) in optimizer_states. """
+    vectorized_grads = obtain_gradients(model, batch)
+    return [adam_precondition(vectorized_grads, avg, avg_sq) for avg, avg_sq in optimizer_states]
+
+
+
+class StageTimer:
+    """ Wall-clock seconds spent in each stage of collect_grads, summed over the threads running it. """
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def __call__(self, stage, stream=None):
+        start = time.perf_counter()
+        yield
+        if stream is not None:
+            stream.synchronize() # count the GPU work of the stage, not just its launch
+        with self.lock:
+            self.totals[stage] += time.perf_counter() - start
+
+    def report(self, num_batches):
+        elapsed = time.perf_counter() - self.start
+        print(f"Collected {num_batches} batches in {elapsed:.1f}s ({num_batches / max(elapsed, 1e-9):.2f} batches/s)")
+        for stage, seconds in sorted(self.totals.items(), key=lambda item: -item[1]):
+            print(f"    {stage}: {seconds:.1f}s ({seconds / max(elapsed, 1e-9):.0%} of wall-clock)")
+
+
+class ProjectionPipeline:
+    """
+    Projects chunks of full gradients on a worker thread (and its own CUDA stream on GPU), so the
+    projection of one chunk overlaps the forward/backward of the next. At most one chunk is in flight:
+    submitting the next chunk first waits for the previous one, which bounds memory to two chunks.
+    """
+
+    def __init__(self, projectors, proj_dim, model_id, device, timer, max_rows=16):
+        self.projectors = projectors
+        self.max_rows = max_rows
+        self.proj_dim = proj_dim
+        self.model_id = model_id
+        self.timer = timer
+        self.stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def _project_all(self, current_full_grads):
+        # the projectors take at most max_rows (projector_batch_size) rows per call
+        return {
+            dim: torch.cat([projector.project(chunk, model_id=self.model_id) for chunk in current_full_grads.split(self.max_rows)]).cpu()
+            for dim, projector in zip(self.proj_dim, self.projectors)
+        }
+
+    def _project(self, current_full_grads, rows, ready):
+        with self.timer("project", self.stream):
+            if self.stream is None:
+                return rows, self._project_all(current_full_grads)
+            with torch.cuda.stream(self.stream):
+                self.stream.wait_event(ready)
+                current_full_grads.record_stream(self.stream)
+                return rows, self._project_all(current_full_grads)
+
+    def submit(self, full_grads, rows):
+        """ Start projecting full_grads (output rows rows) and return (rows, projections) of the previous chunk, or None. """
+        current_full_grads = torch.stack(full_grads).to(torch.float16) # torch.stack concats along new dim (2,3), whereas torch.cat concats along existing dim (6,)
+        ready = None
+        if self.stream is not None:
+            ready = torch.cuda.Event()
+            ready.record()
+        finished = self.drain()
+        self.pending = self.executor.submit(self._project, current_full_grads, rows, ready)
+        return finished
+
+    def drain(self):
+        """ Wait for the chunk in flight and return its (rows, projections), or None. """
+        if self.pending is None:
+            return None
+        with self.timer("wait for projection"):
+            finished = self.pending.result()
+        self.pending = None
+        return finished
+
+    def close(self):
+        finished = self.drain()
+        self.executor.shutdown()
+        return finished
+
 
+class AsyncWriter:
+    """ Writes on a background thread, so disk I/O overlaps with gradient computation. """
+
+    def __init__(self, timer, max_pending=2):
+        self.timer = timer
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            write_fn, args = item
+            try:
+                with self.timer("save"):
+                    write_fn(*args)
+            except Exception as e:
+                self.error = e
+
+    def write(self, write_fn, *args):
+        if self.error is not None:
+            raise self.error
+        with self.timer("wait for writer"):
+            self.queue.put((write_fn, args))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
 
 
 def collect_grads(dataloader,
@@ -103,10 +240,18 @@ def collect_grads(dataloader,
                   proj_dim: List[int] = [8192],
                   adam_optimizer_state: Optional[dict] = None,
                   gradient_type: str = "adam",
-                  max_samples: Optional[int] = None):
+                  max_samples: Optional[int] = None,
+                  adam_optimizer_states: Optional[dict] = None):
     
     """
     Collects gradients from the model during eval and saves them to disk.
+
+    The projected gradients of each proj_dim go straight into a GradientStore at output_dir/dim{dim}
+    (one row per batch), rows already completed by an earlier run are skipped without a forward pass.
+
+    adam_optimizer_states ({checkpoint name: optimizer state}) scores several training checkpoints in the
+    same pass: each batch's raw gradient is computed once, preconditioned with every checkpoint's Adam
+    moments, projected with the same projectors (same seeds) and written to output_dir/{name}/dim{dim}.
     """
     
     torch.random.manual_seed(0)
@@ -116,33 +261,35 @@ def collect_grads(dataloader,
     
     projector_batch_size = 16
     project_interval = 16 # project every 16 batches
-    save_interval = 160 # save every 160 batches
     
-    def _project(current_full_grads, projected_grads):
-        current_full_grads = torch.stack(current_full_grads).to(torch.float16) # torch.stack concats along new dim (2,3), whereas torch.cat concats along existing dim (6,)
-        for i, projector in enumerate(projectors):
-            current_projected_grads = projector.project(current_full_grads, model_id=model_id)
-            projected_grads[proj_dim[i]].append(current_projected_grads.cpu())
-            
-    def _save(projected_grads, output_dirs):
+    timer = StageTimer()
+    writer = AsyncWriter(timer)
+
+    def _write(stores, finished):
+        rows, projected = finished
         for dim in proj_dim:
-            if len(projected_grads[dim]) == 0:
-                continue
-            projected_grads[dim] = torch.cat(projected_grads[dim])
-            
-            output_dir = output_dirs[dim]
-            outfile = os.path.join(output_dir, f"grads-{count}.pt")
-            torch.save(projected_grads[dim], outfile)
-            print(f"Saving {outfile}, {projected_grads[dim].shape}", flush=True) # flushes the buffer and displays immediately
-            projected_grads[dim] = []
+            # the projected chunk holds len(rows) rows per checkpoint, checkpoint by checkpoint
+            for name, checkpoint_rows in zip(checkpoint_names, projected[dim].split(len(rows))):
+                stores[name, dim].write(rows, checkpoint_rows.float().numpy())
+
+    def _save(finished):
+        if finished is not None:
+            writer.write(_write, stores, finished)
             
     device = next(model.parameters()).device
     dtype = next(model.parameters()).dtype
     
     # prepare optimization states
-    if gradient_type == "adam":
-        assert adam_optimizer_state is not None
-        m, v = prepare_optimizer_state(model, adam_optimizer_state, device) 
+    if adam_optimizer_states is not None:
+        if gradient_type != "adam":
+            raise ValueError(f"adam_optimizer_states needs gradient_type='adam', got '{gradient_type}'.")
+        checkpoint_names = list(adam_optimizer_states.keys())
+        optimizer_states = [prepare_optimizer_state(model, adam_optimizer_states[name], device) for name in checkpoint_names]
+    else:
+        checkpoint_names = [None]
+        if gradient_type == "adam":
+            assert adam_optimizer_state is not None
+            m, v = prepare_optimizer_state(model, adam_optimizer_state, device) 
         
         
     projector = get_trak_projector(device)
@@ -163,87 +310,87 @@ def collect_grads(dataloader,
         projectors.append(proj)
         
     count = 0
+    num_rows = len(dataloader) if max_samples is None else min(len(dataloader), max_samples)
     
-    # setup output dir for each dim and keep track in a dictionary
-    output_dirs = {}
-    for dim in proj_dim:
-        output_dir_per_dim = os.path.join(output_dir, f"dim{dim}")
-        output_dirs[dim] = output_dir_per_dim
-        os.makedirs(output_dir_per_dim, exist_ok=True)
-        
-    # max saved checkpoint index for each dim
-    max_index = min(get_max_saved_index(output_dirs[dim], "grads") for dim in proj_dim) 
+    # preallocated output store for each checkpoint and dim, a row is done once every store has it
+    stores = {}
+    for name in checkpoint_names:
+        checkpoint_dir = output_dir if name is None else os.path.join(output_dir, name)
+        for dim in proj_dim:
+            stores[name, dim] = GradientStore(os.path.join(checkpoint_dir, f"dim{dim}"), num_rows, dim)
+    done = np.logical_and.reduce([store.done[:] for store in stores.values()])
+    print(f"{done.sum()}/{num_rows} rows already collected for {len(checkpoint_names)} checkpoint(s)")
     
-    # projected gradients
-    full_grads = []
-    projected_grads = {dim: [] for dim in proj_dim} # initialize dictionary w/ entry for each dim
+    pipeline = ProjectionPipeline(projectors, proj_dim, model_id, device, timer, max_rows=projector_batch_size)
+
+    # full gradients waiting to be projected (per checkpoint) and their output rows
+    full_grads = {name: [] for name in checkpoint_names}
+    rows = []
     
-    for batch in tqdm(dataloader, total=len(dataloader))
-        prepare_batch(batch) 
+    compute_stream = torch.cuda.current_stream(device) if device.type == "cuda" else None
+    for batch in tqdm(dataloader, total=num_rows):
         count += 1 
-    
-        if count <= max_index:
-            print("skipping count", count)
+        if count > num_rows:
+            break
+        if done[count - 1]:
             continue
+        prepare_batch(batch) 
             
-        if gradient_type == "adam":
-            if count == 1:
-                print("Using Adam gradients")
-            vectorized_grads = obtain_gradients_with_adam(model, batch, m, v)
-        elif gradient_type == "sign":
-            if count == 1:
-                print("Using Sign gradients") # What are these?
-            vectorized_grads = obtain_sign_gradients(model, batch)
-        else:
-            if count == 1:
-                print("Using SGD gradients")
-            vectorized_grads = obtain_gradients(model, batch)
+        with timer("gradients", compute_stream):
+            if adam_optimizer_states is not None:
+                if count == 1:
+                    print(f"Using Adam gradients for {len(checkpoint_names)} optimizer states")
+                checkpoint_grads = obtain_gradients_with_adam_states(model, batch, optimizer_states)
+            elif gradient_type == "adam":
+                if count == 1:
+                    print("Using Adam gradients")
+                checkpoint_grads = [obtain_gradients_with_adam(model, batch, m, v)]
+            elif gradient_type == "sign":
+                if count == 1:
+                    print("Using Sign gradients") # What are these?
+                checkpoint_grads = [obtain_sign_gradients(model, batch)]
+            else:
+                if count == 1:
+                    print("Using SGD gradients")
+                checkpoint_grads = [obtain_gradients(model, batch)]
             
-        full_grads.append(vectorized_grads)
+        for name, vectorized_grads in zip(checkpoint_names, checkpoint_grads):
+            full_grads[name].append(vectorized_grads)
+        rows.append(count - 1)
         model.zero_grad()
         
-        # compute projections and clear full grad buffer
-        if count % project_interval == 0:
-            _project(full_grads, projected_grads)
-            full_grads = [] 
-            
-        if count % save_interval == 0:
-            _save(projected_grads, output_dirs)
-            
-        # What does this do??
-        if max_samples is not None and count == max_samples:
-            break
+        # hand the chunk to the projection worker and keep computing gradients meanwhile
+        if len(rows) == project_interval:
+            _save(pipeline.submit(sum(full_grads.values(), []), rows))
+            full_grads = {name: [] for name in checkpoint_names}
+            rows = []
             
     # project remaining grads
-    if len(full_grads) > 0:
-        _project(full_grads, projected_grads)
-        full_grads = []
-        
-    for dim in proj_dim:
-        _save(projected_grads, output_dirs)
+    if len(rows) > 0:
+        _save(pipeline.submit(sum(full_grads.values(), []), rows))
+    _save(pipeline.close())
+    writer.close()
+    timer.report(int((~done[:count]).sum()))
         
     torch.cuda.empty_cache()
-    for dim in proj_dim:
-        output_dir = output_dirs[dim]
-        merge_info(output_dir, prefix="grads", normalize=True)
-        merge_info(output_dir, prefix="grads", normalize=False)
-        
+    for (name, dim), store in stores.items():
+        print(f"Saved {store.num_rows} x {dim} projected gradients to {store.path} (complete: {store.is_complete()})")
     print("Finished")
     
     
     
 def merge_info(output_dir: str, prefix="reps", normalize=True):
-    """ Merge and normalize the representations and gradients into a single file. """
+    """ Merge and normalize the representations and gradients into a single file (legacy grads-N.pt shards). """
     info = os.listdir(output_dir)
     info = [file for file in info if file.startswith(prefix)]
     
-    info.sort(key=lambda x: int(x.split(".")[0].split("-1")[1])) # e.g. reps-100.pt, sort from lowest to highest
+    info.sort(key=lambda x: int(x.split(".")[0].split("-")[1])) # e.g. reps-100.pt, sort from lowest to highest
     merged_data = []
     
     for file in info:
         data = torch.load(os.path.join(output_dir, file))
         if normalize:
-            normalized_data = normalize(data, dim=1)
+            normalized_data = F.normalize(data, dim=1)
             merged_data.append(normalized_data)
         else:
             merged_data.append(data)